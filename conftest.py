@@ -21,6 +21,12 @@ def pytest_addoption(parser):
         default=False,
         help="Keep the database after tests",
     )
+    parser.addoption(
+        "--benchmark",
+        action="store_true",
+        default=False,
+        help="Run benchmarks, which are timing-dependent",
+    )
 
 
 def pytest_configure(config):
@@ -29,6 +35,7 @@ def pytest_configure(config):
     config.addinivalue_line(
         "markers", "legacy_raster: mark test as legacy raster test."
     )
+    config.addinivalue_line("markers", "benchmark: mark test as a benchmark.")
 
 
 def pytest_collection_modifyitems(config, items):
@@ -38,3 +45,8 @@ def pytest_collection_modifyitems(config, items):
         for item in items:
             if "legacy_raster" in item.keywords:
                 item.add_marker(skip_slow)
+    if not config.getoption("--benchmark"):
+        skip_benchmark = pytest.mark.skip(reason="needs --benchmark option to run")
+        for item in items:
+            if "benchmark" in item.keywords:
+                item.add_marker(skip_benchmark)
@@ -0,0 +1,7 @@
+"""
+Tile archives (MBTiles and PMTiles). Archive-backed layers are defined in
+`archives.layer`.
+"""
+
+from .readers import MBTilesArchive, PMTilesArchive, open_archive
+from .writers import MBTilesWriter, PMTilesWriter, archive_writer
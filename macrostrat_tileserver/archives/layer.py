@@ -0,0 +1,62 @@
+from pathlib import Path
+from typing import Any, Optional
+
+import morecantile
+from buildpg import asyncpg
+from pydantic import PrivateAttr
+from timvt.layer import Layer
+
+from ..utils.compression import preferred_encoding
+from .readers import decode_tile, open_archive
+
+
+class ArchiveLayer(Layer):
+    """A static layer served from a local PMTiles or MBTiles archive, without
+    touching the database."""
+
+    type: str = "ArchiveLayer"
+    path: Path
+
+    _archive: Any = PrivateAttr(default=None)
+
+    @classmethod
+    def open(cls, id: str, path: Path) -> "ArchiveLayer":
+        archive = open_archive(path)
+        layer = cls(
+            id=id,
+            path=path,
+            bounds=list(archive.bounds),
+            minzoom=archive.minzoom,
+            maxzoom=archive.maxzoom,
+        )
+        layer._archive = archive
+        return layer
+
+    def get_encoded_tile(
+        self, tile: morecantile.Tile, accept_encoding: str = ""
+    ) -> tuple[bytes, Optional[str]]:
+        """Get tile data, without decompressing it if the client accepts the
+        archive's encoding. Returns the data and its content encoding."""
+        data = self._archive.get(tile.z, tile.x, tile.y)
+        if data is None:
+            return b"", None
+        encoding = self._archive.encoding
+        if encoding is None:
+            return data, None
+        if preferred_encoding(accept_encoding, [encoding]) == encoding:
+            return data, encoding
+        return decode_tile(data, encoding), None
+
+    async def get_tile(
+        self,
+        pool: asyncpg.BuildPgPool,
+        tile: morecantile.Tile,
+        tms: morecantile.TileMatrixSet,
+        **kwargs: Any,
+    ) -> bytes:
+        """Get uncompressed tile data. The database pool is not used."""
+        data, _ = self.get_encoded_tile(tile)
+        return data
+
+    def close(self):
+        self._archive.close()
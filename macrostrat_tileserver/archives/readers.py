@@ -0,0 +1,165 @@
+"""
+Memory-mapped readers for MBTiles and PMTiles tile archives.
+"""
+
+import gzip
+import mmap
+import sqlite3
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+try:
+    from pmtiles.tile import (
+        Compression,
+        deserialize_directory,
+        deserialize_header,
+        find_tile,
+        zxy_to_tileid,
+    )
+except ImportError:
+    deserialize_header = None
+
+_gzip_magic = b"\x1f\x8b"
+
+
+class PMTilesArchive:
+    """Read tiles from a PMTiles (v3) archive.
+
+    The file is memory-mapped, and the root directory (along with recently used leaf
+    directories) is kept in memory, so a tile lookup is a binary search and a slice.
+    """
+
+    def __init__(self, path: Path, max_leaves: int = 256):
+        if deserialize_header is None:
+            raise ImportError("The pmtiles package is required to read PMTiles")
+        self.path = Path(path)
+        self.max_leaves = max_leaves
+
+        self._file = self.path.open("rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.header = deserialize_header(self._mmap[0:127])
+        self._root = self._read_directory(
+            self.header["root_offset"], self.header["root_length"]
+        )
+        self._leaves: OrderedDict[int, list] = OrderedDict()
+
+        self.encoding = None
+        if self.header["tile_compression"] == Compression.GZIP:
+            self.encoding = "gzip"
+
+    @property
+    def bounds(self) -> tuple[float, float, float, float]:
+        h = self.header
+        return (
+            h["min_lon_e7"] / 1e7,
+            h["min_lat_e7"] / 1e7,
+            h["max_lon_e7"] / 1e7,
+            h["max_lat_e7"] / 1e7,
+        )
+
+    @property
+    def minzoom(self) -> int:
+        return self.header["min_zoom"]
+
+    @property
+    def maxzoom(self) -> int:
+        return self.header["max_zoom"]
+
+    def _read_directory(self, offset: int, length: int) -> list:
+        return deserialize_directory(self._mmap[offset : offset + length])
+
+    def _leaf(self, offset: int, length: int) -> list:
+        entries = self._leaves.get(offset)
+        if entries is None:
+            start = self.header["leaf_directory_offset"] + offset
+            entries = self._read_directory(start, length)
+            self._leaves[offset] = entries
+            if len(self._leaves) > self.max_leaves:
+                self._leaves.popitem(last=False)
+        else:
+            self._leaves.move_to_end(offset)
+        return entries
+
+    def get(self, z: int, x: int, y: int) -> Optional[bytes]:
+        """Get tile data as stored in the archive (possibly compressed)."""
+        try:
+            tile_id = zxy_to_tileid(z, x, y)
+        except (ValueError, OverflowError):
+            return None
+        directory = self._root
+        # The spec allows at most three levels of directories
+        for _ in range(3):
+            entry = find_tile(directory, tile_id)
+            if entry is None:
+                return None
+            if entry.run_length > 0:
+                start = self.header["tile_data_offset"] + entry.offset
+                return self._mmap[start : start + entry.length]
+            directory = self._leaf(entry.offset, entry.length)
+        return None
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+
+class MBTilesArchive:
+    """Read tiles from an MBTiles (SQLite) archive, memory-mapped by SQLite."""
+
+    def __init__(self, path: Path, mmap_size: int = 2**30):
+        self.path = Path(path)
+        self._conn = sqlite3.connect(
+            f"file:{self.path}?mode=ro&immutable=1",
+            uri=True,
+            check_same_thread=False,
+        )
+        self._conn.execute(f"PRAGMA mmap_size = {int(mmap_size)}")
+        self.metadata = dict(self._conn.execute("SELECT name, value FROM metadata"))
+
+        self.encoding = None
+        row = self._conn.execute("SELECT tile_data FROM tiles LIMIT 1").fetchone()
+        if row is not None and row[0][:2] == _gzip_magic:
+            self.encoding = "gzip"
+
+    @property
+    def bounds(self) -> tuple[float, float, float, float]:
+        bounds = self.metadata.get("bounds", "-180,-85.0511,180,85.0511")
+        return tuple(float(v) for v in bounds.split(","))
+
+    @property
+    def minzoom(self) -> int:
+        return int(self.metadata.get("minzoom", 0))
+
+    @property
+    def maxzoom(self) -> int:
+        return int(self.metadata.get("maxzoom", 14))
+
+    def get(self, z: int, x: int, y: int) -> Optional[bytes]:
+        """Get tile data as stored in the archive (possibly compressed)."""
+        row = self._conn.execute(
+            "SELECT tile_data FROM tiles "
+            "WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+            (z, x, (1 << z) - 1 - y),
+        ).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def close(self):
+        self._conn.close()
+
+
+def open_archive(path: Path):
+    path = Path(path)
+    if path.suffix == ".pmtiles":
+        return PMTilesArchive(path)
+    if path.suffix == ".mbtiles":
+        return MBTilesArchive(path)
+    raise ValueError(f"Unsupported archive format: {path.suffix}")
+
+
+def decode_tile(data: bytes, encoding: Optional[str]) -> bytes:
+    if encoding == "gzip":
+        return gzip.decompress(data)
+    return data
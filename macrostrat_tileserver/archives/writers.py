@@ -0,0 +1,192 @@
+"""
+Writers for MBTiles and PMTiles tile archives.
+
+Tile data is written out as it arrives rather than held in memory, and identical
+tiles (e.g., empty ocean tiles) are stored once. Tiles are identified by their
+content hash (`tile_etag`), which is already stored alongside cached tiles.
+"""
+
+import sqlite3
+import tempfile
+from pathlib import Path
+from shutil import copyfileobj
+from typing import Any, Optional
+
+try:
+    from pmtiles.tile import Compression, Entry, TileType, zxy_to_tileid
+    from pmtiles.writer import finalize_header
+except ImportError:
+    finalize_header = None
+
+
+class MBTilesWriter:
+    """Write tiles to an MBTiles (SQLite) archive, using the deduplicating
+    `map`/`images` layout."""
+
+    def __init__(self, path: Path, batch_size: int = 1000):
+        self.path = Path(path)
+        self.batch_size = batch_size
+        self.tiles_written = 0
+        self.unique_tiles = 0
+
+        self._conn = sqlite3.connect(self.path)
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS metadata (name text PRIMARY KEY, value text);
+            CREATE TABLE IF NOT EXISTS images (tile_id text PRIMARY KEY, tile_data blob);
+            CREATE TABLE IF NOT EXISTS map (
+                zoom_level integer,
+                tile_column integer,
+                tile_row integer,
+                tile_id text,
+                PRIMARY KEY (zoom_level, tile_column, tile_row)
+            );
+            CREATE VIEW IF NOT EXISTS tiles AS
+            SELECT zoom_level, tile_column, tile_row, tile_data
+            FROM map JOIN images ON images.tile_id = map.tile_id;
+            """
+        )
+        self._written: set[str] = set()
+        self._images: list[tuple] = []
+        self._map: list[tuple] = []
+
+    def write(self, z: int, x: int, y: int, data: bytes, tile_id: str):
+        # MBTiles rows are numbered from the south (TMS scheme)
+        self._map.append((z, x, (1 << z) - 1 - y, tile_id))
+        if tile_id not in self._written:
+            self._written.add(tile_id)
+            self._images.append((tile_id, data))
+            self.unique_tiles += 1
+        self.tiles_written += 1
+        if len(self._map) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        self._conn.executemany(
+            "INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)",
+            self._images,
+        )
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO map VALUES (?, ?, ?, ?)",
+            self._map,
+        )
+        self._conn.commit()
+        self._images = []
+        self._map = []
+
+    def close(self, metadata: dict[str, Any]):
+        self._flush()
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)",
+            [(k, str(v)) for k, v in mbtiles_metadata(metadata).items()],
+        )
+        self._conn.commit()
+        self._conn.close()
+
+
+def mbtiles_metadata(metadata: dict[str, Any]) -> dict[str, Any]:
+    res = {
+        "name": metadata["name"],
+        "format": metadata.get("format", "pbf"),
+        "bounds": ",".join(str(v) for v in metadata["bounds"]),
+        "minzoom": metadata["minzoom"],
+        "maxzoom": metadata["maxzoom"],
+        "type": "overlay",
+    }
+    if "attribution" in metadata:
+        res["attribution"] = metadata["attribution"]
+    return res
+
+
+class PMTilesWriter:
+    """Write tiles to a PMTiles (v3) archive.
+
+    Tile data is spooled to a temporary file; only the directory entries are kept in
+    memory until the archive is finalized.
+    """
+
+    def __init__(self, path: Path):
+        if finalize_header is None:
+            raise ImportError("The pmtiles package is required to write PMTiles")
+        self.path = Path(path)
+        self.tiles_written = 0
+
+        self._data = tempfile.TemporaryFile()
+        self._offset = 0
+        # Content hash -> (offset, length) of tile data
+        self._contents: dict[str, tuple[int, int]] = {}
+        self._entries: list[Entry] = []
+
+    @property
+    def unique_tiles(self) -> int:
+        return len(self._contents)
+
+    def write(self, z: int, x: int, y: int, data: bytes, tile_id: str):
+        location = self._contents.get(tile_id)
+        if location is None:
+            location = (self._offset, len(data))
+            self._data.write(data)
+            self._offset += len(data)
+            self._contents[tile_id] = location
+        self._entries.append(Entry(zxy_to_tileid(z, x, y), *location, 1))
+        self.tiles_written += 1
+
+    def _directory_entries(self) -> list[Entry]:
+        """Sort entries, and collapse runs of consecutive identical tiles."""
+        entries = []
+        for e in sorted(self._entries, key=lambda e: e.tile_id):
+            if entries:
+                last = entries[-1]
+                if last.tile_id == e.tile_id:
+                    # Tile was written twice
+                    entries[-1] = e
+                    continue
+                if (
+                    e.tile_id == last.tile_id + last.run_length
+                    and e.offset == last.offset
+                ):
+                    last.run_length += 1
+                    continue
+            entries.append(e)
+        return entries
+
+    def close(self, metadata: dict[str, Any]):
+        west, south, east, north = metadata["bounds"]
+        header = {
+            "tile_type": TileType.MVT,
+            "tile_compression": Compression.GZIP,
+            "min_lon_e7": int(west * 1e7),
+            "min_lat_e7": int(south * 1e7),
+            "max_lon_e7": int(east * 1e7),
+            "max_lat_e7": int(north * 1e7),
+        }
+        entries = self._directory_entries()
+        if not entries:
+            raise ValueError("No tiles were written to the archive")
+        header_bytes, root_bytes, _metadata, leaves_bytes = finalize_header(
+            header,
+            self.tiles_written,
+            entries,
+            self.unique_tiles,
+            metadata,
+            # Tile data isn't written in tile ID order
+            False,
+            self._offset,
+        )
+        with self.path.open("wb") as f:
+            for part in (header_bytes, root_bytes, _metadata, leaves_bytes):
+                f.write(part)
+            self._data.seek(0)
+            copyfileobj(self._data, f)
+        self._data.close()
+
+
+def archive_writer(path: Path, format: Optional[str] = None):
+    """Create a writer for an archive, based on its file extension."""
+    path = Path(path)
+    format = format or path.suffix.lstrip(".")
+    if format == "mbtiles":
+        return MBTilesWriter(path)
+    if format == "pmtiles":
+        return PMTilesWriter(path)
+    raise ValueError(f"Unsupported archive format: {format}")
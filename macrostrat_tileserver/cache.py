@@ -1,17 +1,78 @@
-from typing import Optional
+from time import monotonic
+from typing import Iterable, NamedTuple, Optional
 
 from buildpg import asyncpg, render
 from morecantile import Tile
-from hashlib import md5
+from hashlib import blake2b
 from json import dumps
-from ctypes import c_int32
+from starlette.concurrency import run_in_threadpool
 
-from .utils import prepared_statement
+from .cache_writer import CachedTileRecord, TileAccessTracker, TileCacheWriter
+from .eviction import TileCacheEvictor
+from .memory_cache import MemoryTileCache
+from .utils import prepared_statement, tile_etag
+from .utils.admission import admission
+from .utils.compression import encode_tile
 
 from macrostrat.utils import get_logger
 
 log = get_logger(__name__)
 
+# Per-worker in-memory cache, configured at application startup
+tile_memory_cache = MemoryTileCache()
+# Write-behind queue for cache inserts, started at application startup
+tile_cache_writer = TileCacheWriter()
+# Tile access times, flushed periodically so that cache reads don't write
+tile_access_tracker = TileAccessTracker()
+# Keeps the cache within its size budget, configured at application startup
+tile_cache_evictor = TileCacheEvictor()
+
+
+class CacheProfile(NamedTuple):
+    id: int
+    name: str
+    # Cache-Control max-age for tiles in this profile, in seconds
+    max_age: Optional[int] = None
+
+
+# Profiles are looked up again after this many seconds, so that changes to
+# `tile_cache.profile` (e.g., to `max_age`) take effect without a restart
+cache_profile_ttl = 60.0
+_cache_profiles: dict[str, tuple[float, CacheProfile]] = {}
+
+
+async def get_cache_profile(
+    pool: asyncpg.BuildPgPool, name: str
+) -> Optional[CacheProfile]:
+    """Get a cache profile from the tile_cache.profile table by name."""
+    if name in _cache_profiles:
+        loaded, profile = _cache_profiles[name]
+        if monotonic() - loaded < cache_profile_ttl:
+            return profile
+    async with pool.acquire() as conn:
+        q, p = render(
+            "SELECT id, name, max_age FROM tile_cache.profile WHERE name = :name",
+            name=name,
+        )
+        row = await conn.fetchrow(q, *p)
+    if row is None:
+        _cache_profiles.pop(name, None)
+        return None
+    profile = CacheProfile(**row)
+    _cache_profiles[name] = (monotonic(), profile)
+    tile_memory_cache.register_profile(profile.id, name)
+    return profile
+
+
+class CachedTile(NamedTuple):
+    # The tile data, which is not fetched if the client already has it
+    content: Optional[bytes]
+    # The Content-Encoding of a pre-compressed variant, if any
+    encoding: Optional[str] = None
+    etag: Optional[str] = None
+    # Whether the tile matches one of the ETags the client already holds
+    not_modified: bool = False
+
 
 async def get_tile_from_cache(
     pool: asyncpg.BuildPgPool,
@@ -19,21 +80,55 @@ async def get_tile_from_cache(
     params: dict[str, str],
     tile: Tile,
     tms: str = "WebMercatorQuad",
-) -> Optional[bytes]:
-    """Get tile data from cache."""
+    encoding: Optional[str] = None,
+    if_none_match: Iterable[str] = (),
+) -> Optional[CachedTile]:
+    """Get tile data from cache, preferring a variant pre-compressed with `encoding`.
+
+    If the tile's ETag is in `if_none_match`, the tile data is not returned.
+    """
+    _hash = create_params_hash(params)
+    etags = list(if_none_match)
+
+    # Check the in-memory cache first
+    key = (layer, tile.z, tile.x, tile.y, _hash)
+    res = tile_memory_cache.get_first(
+        (*key, _encoding) for _encoding in dict.fromkeys((encoding, None))
+    )
+    if res is not None:
+        tile_access_tracker.record(tile.x, tile.y, tile.z, _hash, layer)
+        if res.etag is not None and res.etag in etags:
+            return res._replace(content=None, not_modified=True)
+        return res
+
     # Get the tile from the tile_cache.tile table
-    async with pool.acquire() as conn:
-        q, p = render(
-            prepared_statement("get-cached-tile"),
-            x=tile.x,
-            y=tile.y,
-            z=tile.z,
-            params=create_params_hash(params),
-            tms=tms,
-            layer=layer,
-        )
+    q, p = render(
+        prepared_statement("get-cached-tile"),
+        x=tile.x,
+        y=tile.y,
+        z=tile.z,
+        params=_hash,
+        tms=tms,
+        layer=layer,
+        encoding=encoding,
+        etags=etags,
+    )
+    async with admission.cache_lookup():
+        async with pool.acquire() as conn:
+            row = await conn.fetchrow(q, *p)
 
-        return await conn.fetchval(q, *p)
+    if row is None:
+        return None
+
+    tile_access_tracker.record(tile.x, tile.y, tile.z, _hash, layer)
+    _encoding = encoding if row["has_encoding"] else None
+    if row["not_modified"]:
+        return CachedTile(None, _encoding, row["etag"], not_modified=True)
+
+    content = row["encoded_tile"] if _encoding else row["tile"]
+    res = CachedTile(content, _encoding, row["etag"])
+    tile_memory_cache.set((*key, _encoding), res, size=len(content))
+    return res
 
 
 async def set_cached_tile(
@@ -42,28 +137,56 @@ async def set_cached_tile(
     params: dict[str, str],
     tile: Tile,
     content: bytes,
+    encodings: Iterable[str] = (),
+    etag: Optional[str] = None,
 ):
 
     _hash = create_params_hash(params)
     log.debug("Setting cached tile: %s", _hash)
 
+    if etag is None:
+        etag = tile_etag(content)
+
+    # Compress variants off the event loop; large tiles can take a while
+    variants = await run_in_threadpool(encode_tile, content, encodings)
+
+    key = (layer, tile.z, tile.x, tile.y, _hash)
+    tile_memory_cache.set((*key, None), CachedTile(content, None, etag), len(content))
+    for encoding, encoded in variants.items():
+        res = CachedTile(encoded, encoding, etag)
+        tile_memory_cache.set((*key, encoding), res, len(encoded))
+
+    record = CachedTileRecord(
+        tile.x,
+        tile.y,
+        tile.z,
+        _hash,
+        layer,
+        content,
+        tile_gzip=variants.get("gzip"),
+        tile_br=variants.get("br"),
+        tile_zstd=variants.get("zstd"),
+        etag=etag,
+    )
+
+    if tile_cache_writer.running:
+        await tile_cache_writer.put(record)
+        return
+
     async with pool.acquire() as conn:
-        q, p = render(
-            prepared_statement("set-cached-tile"),
-            x=tile.x,
-            y=tile.y,
-            z=tile.z,
-            params=_hash,
-            tile=content,
-            profile=layer,
-        )
+        q, p = render(prepared_statement("set-cached-tile"), **record._asdict())
         await conn.execute(q, *p)
 
 
 def create_params_hash(params) -> int:
-    """Create a hash from the params, as an integer"""
-    if params is None:
+    """Create a hash from the params, as a signed 64-bit integer.
+
+    Params should be normalized by the layer first, so that equivalent requests
+    produce the same hash.
+    """
+    if not params:
         return 0
-    val = md5(dumps(params, sort_keys=True).encode()).hexdigest()
-    # Restrict to 32 bits
-    return c_int32(int(val, 16)).value
+    val = blake2b(
+        dumps(params, sort_keys=True, separators=(",", ":")).encode(), digest_size=8
+    ).digest()
+    return int.from_bytes(val, "big", signed=True)
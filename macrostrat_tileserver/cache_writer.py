@@ -0,0 +1,260 @@
+"""
+Write-behind batching of tile cache inserts and access times.
+
+Rendered tiles are collected in a bounded queue and written to `tile_cache.tile`
+in multi-row batches (COPY into a temporary staging table, then a single upsert),
+so that a burst of cache misses needs one connection rather than one per tile.
+
+Cache reads are pure SELECTs; the time each tile was last used is accumulated in
+memory and periodically applied in a single bulk UPDATE.
+"""
+
+import asyncio
+from random import random
+from time import perf_counter, time
+from typing import Any, NamedTuple, Optional
+
+from buildpg import asyncpg, render
+from macrostrat.utils import get_logger
+
+from .utils import prepared_statement
+
+log = get_logger(__name__)
+
+
+class CachedTileRecord(NamedTuple):
+    x: int
+    y: int
+    z: int
+    args_hash: int
+    profile: int
+    tile: bytes
+    # Pre-compressed variants
+    tile_gzip: Optional[bytes] = None
+    tile_br: Optional[bytes] = None
+    tile_zstd: Optional[bytes] = None
+    etag: Optional[str] = None
+
+
+class TileCacheWriter:
+    """Queue tiles for the cache and flush them to the database in batches.
+
+    If the queue is full, writers wait up to `put_timeout` seconds for space before
+    the tile is dropped; caching is best-effort, so we prefer shedding writes to
+    holding on to unbounded memory.
+    """
+
+    def __init__(
+        self,
+        max_queue_size: int = 5000,
+        batch_size: int = 200,
+        flush_interval: float = 1.0,
+        put_timeout: float = 5.0,
+    ):
+        self.configure(
+            max_queue_size=max_queue_size,
+            batch_size=batch_size,
+            flush_interval=flush_interval,
+            put_timeout=put_timeout,
+        )
+
+        self._pool: Optional[asyncpg.BuildPgPool] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._batch: list[CachedTileRecord] = []
+
+        self.tiles_written = 0
+        self.batches_written = 0
+        self.dropped = 0
+        self.errors = 0
+        self.last_flush_time = 0.0
+        self.total_flush_time = 0.0
+
+    def configure(
+        self,
+        *,
+        max_queue_size: int = 5000,
+        batch_size: int = 200,
+        flush_interval: float = 1.0,
+        put_timeout: float = 5.0,
+    ):
+        self.max_queue_size = max_queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def start(self, pool: asyncpg.BuildPgPool):
+        """Start the background flush loop."""
+        if self.running or self.max_queue_size <= 0:
+            return
+        self._pool = pool
+        self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self._task = asyncio.ensure_future(self._run())
+
+    async def put(self, record: CachedTileRecord):
+        """Add a tile to the write queue, waiting for space if it is full."""
+        try:
+            await asyncio.wait_for(self._queue.put(record), self.put_timeout)
+        except asyncio.TimeoutError:
+            self.dropped += 1
+            log.warning("Tile cache write queue is full; dropping tile")
+
+    async def close(self):
+        """Stop the flush loop and write everything that is still queued."""
+        if not self.running:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+        # Anything in the current batch may not have been written if we were
+        # cancelled mid-flush. The upsert is idempotent, so write it again.
+        while not self._queue.empty():
+            self._batch.append(self._queue.get_nowait())
+        while self._batch:
+            await self._flush(self._batch[: self.batch_size])
+            self._batch = self._batch[self.batch_size :]
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self._batch.append(await self._queue.get())
+            deadline = loop.time() + self.flush_interval
+            while len(self._batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    record = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                self._batch.append(record)
+            await self._flush(self._batch)
+            self._batch = []
+
+    async def _flush(self, batch: list[CachedTileRecord]):
+        # Multiple writes for the same tile can't be part of one upsert; keep the last
+        records = list({r[:5]: r for r in batch}.values())
+        start = perf_counter()
+        try:
+            async with self._pool.acquire() as conn:
+                async with conn.transaction():
+                    await conn.execute(prepared_statement("create-tile-staging"))
+                    await conn.copy_records_to_table(
+                        "tile_cache_staging",
+                        records=records,
+                        columns=list(CachedTileRecord._fields),
+                    )
+                    await conn.execute(prepared_statement("flush-cached-tiles"))
+        except Exception as exc:
+            self.errors += 1
+            log.error("Failed to write %s tiles to the cache: %s", len(records), exc)
+            return
+        self.last_flush_time = perf_counter() - start
+        self.total_flush_time += self.last_flush_time
+        self.tiles_written += len(records)
+        self.batches_written += 1
+        log.debug(
+            "Wrote %s tiles to the cache in %.1f ms",
+            len(records),
+            self.last_flush_time * 1000,
+        )
+
+    def stats(self) -> dict[str, Any]:
+        mean_flush_time = 0
+        if self.batches_written > 0:
+            mean_flush_time = self.total_flush_time / self.batches_written
+        return {
+            "enabled": self.running,
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "max_queue_size": self.max_queue_size,
+            "tiles_written": self.tiles_written,
+            "batches_written": self.batches_written,
+            "dropped": self.dropped,
+            "errors": self.errors,
+            "last_flush_ms": round(self.last_flush_time * 1000, 1),
+            "mean_flush_ms": round(mean_flush_time * 1000, 1),
+        }
+
+
+class TileAccessTracker:
+    """Accumulate tile access times and counts in memory, to be flushed to `tile_cache.tile`.
+
+    With `sample_rate` below 1, only a fraction of accesses are recorded. Frequently
+    used tiles will still be marked as used, which is all that least-recently-used
+    eviction needs, and access counts remain proportional to the true number of hits.
+    """
+
+    def __init__(self, sample_rate: float = 1.0, max_pending: int = 100000):
+        self.configure(sample_rate=sample_rate, max_pending=max_pending)
+        # Tile key -> (last access time, number of accesses)
+        self._pending: dict[tuple, tuple[float, int]] = {}
+        self.recorded = 0
+        self.dropped = 0
+        self.tiles_updated = 0
+        self.errors = 0
+        self.last_flush_time = 0.0
+
+    def configure(self, *, sample_rate: float = 1.0, max_pending: int = 100000):
+        self.sample_rate = sample_rate
+        self.max_pending = max_pending
+
+    def record(self, x: int, y: int, z: int, args_hash: int, profile: int):
+        if self.sample_rate < 1 and random() >= self.sample_rate:
+            return
+        key = (x, y, z, args_hash, profile)
+        entry = self._pending.get(key)
+        if entry is None and len(self._pending) >= self.max_pending:
+            self.dropped += 1
+            return
+        hits = entry[1] + 1 if entry is not None else 1
+        self._pending[key] = (time(), hits)
+        self.recorded += 1
+
+    async def flush(self, pool: asyncpg.BuildPgPool):
+        """Write accumulated access times in a single UPDATE."""
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+
+        keys = list(pending.keys())
+        columns = list(zip(*keys))
+        q, p = render(
+            prepared_statement("update-tile-access"),
+            x=list(columns[0]),
+            y=list(columns[1]),
+            z=list(columns[2]),
+            args_hash=list(columns[3]),
+            profile=list(columns[4]),
+            last_used=[pending[k][0] for k in keys],
+            hits=[pending[k][1] for k in keys],
+        )
+
+        start = perf_counter()
+        try:
+            async with pool.acquire() as conn:
+                await conn.execute(q, *p)
+        except Exception as exc:
+            self.errors += 1
+            log.error("Failed to update access times for %s tiles: %s", len(keys), exc)
+            return
+        self.last_flush_time = perf_counter() - start
+        self.tiles_updated += len(keys)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "sample_rate": self.sample_rate,
+            "pending": len(self._pending),
+            "recorded": self.recorded,
+            "dropped": self.dropped,
+            "tiles_updated": self.tiles_updated,
+            "errors": self.errors,
+            "last_flush_ms": round(self.last_flush_time * 1000, 1),
+        }
@@ -17,29 +17,43 @@ from timvt.factory import (
     queryparams_to_kwargs,
 )
 from timvt.models.mapbox import TileJSON
-from buildpg import render
 
-from .cache import get_tile_from_cache, set_cached_tile
+from .archives.layer import ArchiveLayer
+from .cache import (
+    CacheProfile,
+    create_params_hash,
+    get_cache_profile,
+    get_tile_from_cache,
+    set_cached_tile,
+)
 from .function_layer import StoredFunction
-from .utils import CacheMode, CacheStatus, TileResponse
+from .utils import (
+    CacheMode,
+    CacheStatus,
+    SingleFlight,
+    TileResponse,
+    request_etags,
+    tile_etag,
+)
+from .utils.admission import admission
+from .utils.compression import preferred_encoding
+from .utils.timeouts import until_disconnected
 
 log = get_logger(__name__)
 
 
 class CachedVectorTilerFactory(VectorTilerFactory):
-
-    async def get_cache_profile_id(self, pool, layer):
-        if layer.profile_id is not None:
-            return layer.profile_id
-        # Set the cache profile id from the database
-        async with pool.acquire() as conn:
-            q, p = render(
-                "SELECT id FROM tile_cache.profile WHERE name = :layer",
-                layer=layer.id,
-            )
-            res = await conn.fetchval(q, *p)
-            layer.profile_id = res
-            return res
+    def __post_init__(self):
+        # Tile renders that are currently in progress, for deduplication. Renders
+        # are cancelled if every client waiting for them disconnects.
+        self.renders = SingleFlight(cancel_abandoned=True)
+        super().__post_init__()
+
+    async def get_cache_profile(self, pool, layer) -> Optional[CacheProfile]:
+        profile = await get_cache_profile(pool, layer.id)
+        if profile is not None:
+            layer.profile_id = profile.id
+        return profile
 
     def register_tiles(self):
         @self.router.get("/{layer}/{z}/{x}/{y}", **TILE_RESPONSE_PARAMS)
@@ -56,14 +70,24 @@ class CachedVectorTilerFactory(VectorTilerFactory):
         ):
             """Return vector tile."""
             pool = request.app.state.pool
+            # Cache lookups and renders can be served by read replicas
+            read_pool = request.app.state.read_pool
             tms = self.supported_tms.get(TileMatrixSetId)
 
             timer = Timer()
 
             kwargs = queryparams_to_kwargs(
-                request.query_params, ignore_keys=["tilematrixsetid"]
+                request.query_params, ignore_keys=["tilematrixsetid", "cache"]
             )
 
+            # Drop parameters that the layer doesn't accept, so that they don't
+            # fragment the cache
+            if hasattr(layer, "normalize_params"):
+                try:
+                    kwargs = layer.normalize_params(kwargs)
+                except ValueError as e:
+                    raise HTTPException(status_code=400, detail=str(e))
+
             should_cache = (
                 isinstance(layer, CachedStoredFunction) and cache != CacheMode.bypass
             )
@@ -75,35 +99,132 @@ class CachedVectorTilerFactory(VectorTilerFactory):
                 except ValueError as e:
                     raise HTTPException(status_code=400, detail=str(e))
 
+            encodings = request.app.state.tile_cache_encodings
+            etags = request_etags(request)
+
+            if isinstance(layer, ArchiveLayer):
+                # Static layers are served from a local archive
+                content, encoding = layer.get_encoded_tile(
+                    tile, request.headers.get("Accept-Encoding", "")
+                )
+                timer._add_step("get_tile")
+                etag = tile_etag(content)
+                return TileResponse(
+                    content,
+                    timer,
+                    content_encoding=encoding,
+                    etag=etag,
+                    not_modified=etag in etags,
+                )
+
+            profile = None
             if should_cache:
-                profile = await self.get_cache_profile_id(pool, layer)
-                content = await get_tile_from_cache(pool, profile, kwargs, tile, None)
+                profile = await self.get_cache_profile(pool, layer)
+                should_cache = profile is not None
+
+            max_age = profile.max_age if profile is not None else None
+
+            if should_cache:
+                encoding = preferred_encoding(
+                    request.headers.get("Accept-Encoding", ""), encodings
+                )
+                cached = await get_tile_from_cache(
+                    read_pool,
+                    profile.id,
+                    kwargs,
+                    tile,
+                    None,
+                    encoding=encoding,
+                    if_none_match=etags,
+                )
                 timer._add_step("check_cache")
-                if content is not None:
-                    return TileResponse(content, timer, cache_status=CacheStatus.hit)
+                if cached is not None:
+                    return TileResponse(
+                        cached.content,
+                        timer,
+                        cache_status=CacheStatus.hit,
+                        content_encoding=cached.encoding,
+                        etag=cached.etag,
+                        max_age=max_age,
+                        not_modified=cached.not_modified,
+                    )
 
             if cache == CacheMode.force:
                 raise HTTPException(
                     status_code=404,
                     detail="Tile not found in cache",
-                    header={
+                    headers={
                         "Server-Timing": timer.server_timings(),
                         "X-Tile-Cache": CacheStatus.miss,
                     },
                 )
 
-            content = await layer.get_tile(pool, tile, tms, **kwargs)
+            render_key = (
+                layer.id,
+                tms.id,
+                tile.z,
+                tile.x,
+                tile.y,
+                create_params_hash(kwargs),
+            )
+            render_pool = pool
+            kwargs_ = kwargs
+            if isinstance(layer, StoredFunction):
+                # Sublayer queries are recorded in the timings of the leading request
+                kwargs_ = {**kwargs, "timer": timer}
+                # Functions that run in a transaction may write, so need the primary
+                if not layer.transactional:
+                    render_pool = read_pool
+            content, is_leader = await until_disconnected(
+                request,
+                self.renders.run(
+                    render_key,
+                    render_layer_tile,
+                    layer,
+                    render_pool,
+                    tile,
+                    tms,
+                    **kwargs_,
+                ),
+            )
+            etag = tile_etag(content)
+
+            if not is_leader:
+                # Another request rendered (and will cache) this tile
+                timer._add_step("coalesced")
+                return TileResponse(
+                    content,
+                    timer,
+                    cache_status=CacheStatus.coalesced,
+                    etag=etag,
+                    max_age=max_age,
+                    not_modified=etag in etags,
+                )
+
             timer._add_step("get_tile")
 
             cache_status = CacheStatus.bypass
             if should_cache:
-                profile = await self.get_cache_profile_id(pool, layer)
                 background_tasks.add_task(
-                    set_cached_tile, pool, profile, kwargs, tile, content
+                    set_cached_tile,
+                    pool,
+                    profile.id,
+                    kwargs,
+                    tile,
+                    content,
+                    encodings,
+                    etag,
                 )
                 cache_status = CacheStatus.miss
 
-            return TileResponse(content, timer, cache_status=cache_status)
+            return TileResponse(
+                content,
+                timer,
+                cache_status=cache_status,
+                etag=etag,
+                max_age=max_age,
+                not_modified=etag in etags,
+            )
 
         @self.router.get(
             "/{TileMatrixSetId}/{layer}/tilejson.json",
@@ -171,6 +292,13 @@ class CachedVectorTilerFactory(VectorTilerFactory):
             return res
 
 
+async def render_layer_tile(layer, pool, tile: Tile, tms, **kwargs):
+    """Render a tile for a layer, once admitted."""
+    # Coalesced requests share the admission of the request that started the render
+    async with admission.render(layer.id):
+        return await layer.get_tile(pool, tile, tms, **kwargs)
+
+
 def _first_value(values: List[Any], default: Any = None):
     """Return the first not None value."""
     return next(filter(lambda x: x is not None, values), default)
@@ -1,9 +1,10 @@
 from os import environ
 from macrostrat.database import Database
 from macrostrat.utils import relative_path
-from typer import Typer
+from typer import BadParameter, Exit, Option, Typer
 from dotenv import load_dotenv
 from pathlib import Path
+from typing import Optional
 
 load_dotenv()
 
@@ -48,12 +49,177 @@ def create_mapnik_xml(outdir: Path):
     # Note: Carto NodeJS module must be installed globally for this to work
     from .main import app
 
-    from .image_tiles.mapnik_styles import make_mapnik_xml
+    from .image_tiles.mapnik_styles import build_mapnik_styles
 
     outdir.mkdir(parents=True, exist_ok=True)
     # This makes files without database connection information,
     # for testing purposes essentially
-    for scale in ("large", "medium", "small", "tiny"):
-        xml = make_mapnik_xml(scale)
+    styles = build_mapnik_styles(("large", "medium", "small", "tiny"))
+    for scale, xml in styles.items():
         with (outdir / f"{scale}.xml").open("w") as f:
             f.write(xml)
+
+
+@_cli.command(name="invalidate-source")
+def invalidate_source(source_id: int):
+    """Remove cached tiles for a map source that has changed"""
+    import asyncio
+
+    import asyncpg
+
+    from .invalidation import invalidate_source_tiles
+
+    async def _invalidate():
+        conn = await asyncpg.connect(environ.get("DATABASE_URL"))
+        try:
+            # Running tileservers are notified to purge their in-memory caches
+            n_deleted = await invalidate_source_tiles(conn, source_id)
+        finally:
+            await conn.close()
+        print(f"Removed {n_deleted} cached tiles for source {source_id}")
+
+    asyncio.run(_invalidate())
+
+
+@_cli.command(name="seed")
+def seed(
+    layer: str,
+    minzoom: int = 0,
+    maxzoom: int = 10,
+    bbox: Optional[str] = Option(None, help="Bounds as west,south,east,north"),
+    source_id: Optional[int] = Option(None, help="Seed tiles covering a map source"),
+    param: list[str] = Option([], help="Layer parameter as key=value"),
+    concurrency: Optional[int] = Option(
+        None, help="Tiles rendered at once (defaults to the database pool size)"
+    ),
+    checkpoint: Optional[Path] = Option(
+        None, help="Progress file (defaults to .seed-<layer>.json)"
+    ),
+):
+    """Render tiles for a cached layer into the tile cache"""
+    import asyncio
+
+    from timvt.db import close_db_connection, connect_to_db
+
+    from .cache import tile_cache_writer
+    from .main import app, db_settings
+    from .seed import SeedCheckpoint, bbox_tiles, seed_tiles, source_tiles
+
+    _layer = app.state.function_catalog.get(layer)
+    if _layer is None:
+        raise BadParameter(f"Layer {layer} not found", param_hint="layer")
+    params = dict(p.split("=", 1) for p in param)
+
+    job = dict(layer=layer, minzoom=minzoom, maxzoom=maxzoom, params=params)
+    if source_id is not None:
+        job["source_id"] = source_id
+    else:
+        bounds = (-180, -85.0511, 180, 85.0511)
+        if bbox is not None:
+            bounds = tuple(float(v) for v in bbox.split(","))
+        job["bbox"] = list(bounds)
+
+    if checkpoint is None:
+        checkpoint = Path(f".seed-{layer}.json")
+    progress = SeedCheckpoint(checkpoint, job)
+    if progress.completed > 0:
+        print(f"Resuming after {progress.completed} tiles")
+
+    async def _seed():
+        await connect_to_db(app, db_settings)
+        pool = app.state.pool
+        tile_cache_writer.configure(
+            max_queue_size=db_settings.tile_cache_write_queue_size,
+            batch_size=db_settings.tile_cache_write_batch_size,
+            flush_interval=db_settings.tile_cache_write_interval,
+        )
+        tile_cache_writer.start(pool)
+        try:
+            if source_id is not None:
+                tiles = source_tiles(pool, source_id, minzoom, maxzoom)
+            else:
+                tiles = bbox_tiles(bounds, minzoom, maxzoom)
+            return await seed_tiles(
+                pool,
+                _layer,
+                tiles,
+                params,
+                # Leave a connection for the cache writer
+                concurrency=concurrency or max(db_settings.db_max_conn_size - 1, 1),
+                checkpoint=progress,
+                encodings=db_settings.tile_cache_encodings,
+            )
+        finally:
+            await tile_cache_writer.close()
+            await close_db_connection(app)
+
+    n_seeded, n_failed = asyncio.run(_seed())
+    print(f"Seeded {n_seeded} tiles")
+    if n_failed > 0:
+        print(f"{n_failed} tiles failed; run the command again to retry them")
+        raise Exit(1)
+    progress.remove()
+
+
+@_cli.command(name="export")
+def export(
+    layer: str,
+    output: Path,
+    minzoom: int = 0,
+    maxzoom: int = 10,
+    bbox: Optional[str] = Option(None, help="Bounds as west,south,east,north"),
+    param: list[str] = Option([], help="Layer parameter as key=value"),
+    concurrency: Optional[int] = Option(
+        None, help="Tiles rendered at once (defaults to the database pool size)"
+    ),
+):
+    """Export tiles for a layer to an MBTiles or PMTiles archive"""
+    import asyncio
+
+    from timvt.db import close_db_connection, connect_to_db
+
+    from .archives import archive_writer
+    from .export import export_tiles
+    from .main import app, db_settings
+
+    _layer = app.state.function_catalog.get(layer)
+    if _layer is None:
+        raise BadParameter(f"Layer {layer} not found", param_hint="layer")
+    params = dict(p.split("=", 1) for p in param)
+
+    bounds = (-180, -85.0511, 180, 85.0511)
+    if bbox is not None:
+        bounds = tuple(float(v) for v in bbox.split(","))
+
+    try:
+        writer = archive_writer(output)
+    except ValueError as e:
+        raise BadParameter(str(e), param_hint="output")
+
+    async def _export():
+        await connect_to_db(app, db_settings)
+        try:
+            return await export_tiles(
+                app.state.pool,
+                _layer,
+                writer,
+                bounds,
+                minzoom,
+                maxzoom,
+                params,
+                concurrency=concurrency or db_settings.db_max_conn_size,
+            )
+        finally:
+            await close_db_connection(app)
+
+    counts = asyncio.run(_export())
+    writer.close(
+        dict(name=layer, bounds=bounds, minzoom=minzoom, maxzoom=maxzoom, format="pbf")
+    )
+    print(
+        f"Exported {writer.tiles_written} tiles ({writer.unique_tiles} unique) "
+        f"to {output}: {counts['cached']} from the cache, {counts['rendered']} rendered"
+    )
+    if counts["failed"] > 0:
+        print(f"{counts['failed']} tiles failed to render")
+        raise Exit(1)
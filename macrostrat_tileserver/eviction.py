@@ -0,0 +1,199 @@
+"""
+Size-aware eviction of tiles from the PostgreSQL tile cache.
+
+The cache is bounded by the total size of stored tiles (including pre-compressed
+variants) rather than a row count. Each profile in `tile_cache.profile` can also set
+- `max_size`: a quota that its tiles may not exceed,
+- `min_size`: storage reserved for it when evicting to fit the overall budget, and
+- `pinned_maxzoom`: a zoom level at or below which tiles are never evicted.
+
+Tiles are deleted in small batches, in least-recently-used or least-frequently-used
+order, so that eviction never holds locks on a large part of the cache. The storage
+used by each profile is read from counters maintained by triggers
+(`tile_cache.profile_usage`), so checking the budget doesn't scan the cache.
+"""
+
+import asyncio
+from enum import Enum
+from math import ceil
+from time import perf_counter
+from typing import Any, NamedTuple, Optional
+
+from buildpg import asyncpg, render
+from macrostrat.utils import get_logger
+
+from .utils import prepared_statement
+
+log = get_logger(__name__)
+
+# Arbitrary key for the advisory lock that keeps workers from evicting concurrently
+_eviction_lock_id = 0x74696C65
+
+
+class EvictionPolicy(str, Enum):
+    LRU = "lru"
+    LFU = "lfu"
+
+
+_order_by = {
+    EvictionPolicy.LRU: "last_used",
+    EvictionPolicy.LFU: "hits, last_used",
+}
+
+
+class ProfileUsage(NamedTuple):
+    profile: int
+    size: int
+    # Size of tiles that aren't pinned
+    evictable: int
+    max_size: Optional[int] = None
+    min_size: Optional[int] = None
+    pinned_maxzoom: Optional[int] = None
+
+
+def plan_eviction(usage: list[ProfileUsage], max_size: int) -> dict[int, int]:
+    """Decide how many bytes to evict from each profile.
+
+    Profiles are first brought within their own quotas. If the cache is still over
+    budget, the remainder is evicted from each profile in proportion to the storage
+    it uses above its reservation, so that the largest profiles shrink the most.
+    """
+    to_free = {}
+    for u in usage:
+        over_quota = 0
+        if u.max_size is not None:
+            over_quota = max(0, u.size - u.max_size)
+        to_free[u.profile] = min(over_quota, u.evictable)
+
+    excess = sum(u.size for u in usage) - sum(to_free.values()) - max_size
+    if max_size > 0 and excess > 0:
+        available = {}
+        for u in usage:
+            remaining = u.size - to_free[u.profile]
+            above_reservation = remaining - (u.min_size or 0)
+            available[u.profile] = max(
+                0, min(u.evictable - to_free[u.profile], above_reservation)
+            )
+        total_available = sum(available.values())
+        for profile, n in available.items():
+            if n == 0:
+                continue
+            share = ceil(excess * n / total_available)
+            to_free[profile] += min(share, n)
+
+    return {k: v for k, v in to_free.items() if v > 0}
+
+
+class TileCacheEvictor:
+    """Keep the tile cache within its size budget."""
+
+    def __init__(
+        self,
+        max_size: int = 0,
+        policy: EvictionPolicy = EvictionPolicy.LRU,
+        batch_size: int = 1000,
+        max_batches: int = 100,
+        batch_pause: float = 0.05,
+    ):
+        self.configure(
+            max_size=max_size,
+            policy=policy,
+            batch_size=batch_size,
+            max_batches=max_batches,
+            batch_pause=batch_pause,
+        )
+        self.runs = 0
+        self.tiles_evicted = 0
+        self.bytes_evicted = 0
+        self.errors = 0
+        self.last_run_time = 0.0
+        self.last_usage: dict[int, int] = {}
+
+    def configure(
+        self,
+        *,
+        max_size: int = 0,
+        policy: EvictionPolicy = EvictionPolicy.LRU,
+        batch_size: int = 1000,
+        max_batches: int = 100,
+        batch_pause: float = 0.05,
+    ):
+        """A `max_size` of zero disables the overall budget, but per-profile quotas
+        are still enforced. At most `max_batches` batches are deleted per run; any
+        remaining excess is evicted on the next run."""
+        self.max_size = max_size
+        self.policy = EvictionPolicy(policy)
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+        self.batch_pause = batch_pause
+
+    async def run(self, pool: asyncpg.BuildPgPool):
+        start = perf_counter()
+        try:
+            async with pool.acquire() as conn:
+                locked = await conn.fetchval(
+                    "SELECT pg_try_advisory_lock($1)", _eviction_lock_id
+                )
+                if not locked:
+                    # Another worker is already evicting tiles
+                    return
+                try:
+                    await self._run(conn)
+                finally:
+                    await conn.execute(
+                        "SELECT pg_advisory_unlock($1)", _eviction_lock_id
+                    )
+        except Exception as exc:
+            self.errors += 1
+            log.error("Failed to evict tiles from the cache: %s", exc)
+            return
+        self.runs += 1
+        self.last_run_time = perf_counter() - start
+
+    async def _run(self, conn):
+        rows = await conn.fetch(prepared_statement("get-cache-usage"))
+        usage = [ProfileUsage(**row) for row in rows]
+        self.last_usage = {u.profile: u.size for u in usage}
+        plan = plan_eviction(usage, self.max_size)
+        if not plan:
+            return
+
+        pinned = {u.profile: u.pinned_maxzoom for u in usage}
+        sql = prepared_statement("evict-tiles").replace(
+            ":order_by", _order_by[self.policy]
+        )
+        n_batches = 0
+        for profile, target in plan.items():
+            freed = 0
+            while freed < target and n_batches < self.max_batches:
+                q, p = render(
+                    sql,
+                    profile=profile,
+                    pinned_maxzoom=(
+                        pinned[profile] if pinned[profile] is not None else -1
+                    ),
+                    batch_size=self.batch_size,
+                )
+                n_tiles, size = await conn.fetchrow(q, *p)
+                n_batches += 1
+                if n_tiles == 0:
+                    break
+                freed += size
+                self.tiles_evicted += n_tiles
+                self.bytes_evicted += size
+                # Give other queries a chance at the tiles we've just unlocked
+                await asyncio.sleep(self.batch_pause)
+            log.info("Evicted %s bytes of tiles from profile %s", freed, profile)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "max_size": self.max_size,
+            "policy": self.policy.value,
+            "size": sum(self.last_usage.values()),
+            "profiles": self.last_usage,
+            "runs": self.runs,
+            "tiles_evicted": self.tiles_evicted,
+            "bytes_evicted": self.bytes_evicted,
+            "errors": self.errors,
+            "last_run_ms": round(self.last_run_time * 1000, 1),
+        }
@@ -0,0 +1,119 @@
+"""
+Export tiles for a layer to an MBTiles or PMTiles archive.
+
+Tiles are read in bulk from the tile cache where they are present, and rendered
+through the layer where they are missing.
+"""
+
+import asyncio
+from typing import Any, Optional
+
+import morecantile
+from buildpg import asyncpg, render
+from macrostrat.utils import get_logger
+from morecantile import Tile
+
+from .cache import create_params_hash, get_cache_profile
+from .invalidation import tile_ranges
+from .utils import prepared_statement, tile_etag
+from .utils.compression import encode_tile
+
+log = get_logger(__name__)
+
+tms = morecantile.tms.get("WebMercatorQuad")
+
+
+def _gzip(content: bytes) -> bytes:
+    # Archive tiles are conventionally gzip-compressed
+    return encode_tile(content, ["gzip"])["gzip"]
+
+
+async def export_tiles(
+    pool: asyncpg.BuildPgPool,
+    layer,
+    writer,
+    bounds,
+    minzoom: int,
+    maxzoom: int,
+    params: Optional[dict[str, Any]] = None,
+    *,
+    concurrency: int = 10,
+    fetch_size: int = 500,
+) -> dict[str, int]:
+    """Write tiles covering a bounding box to an archive writer."""
+    params = layer.normalize_params(params or {})
+    profile = await get_cache_profile(pool, layer.id)
+    counts = {"cached": 0, "rendered": 0, "empty": 0, "failed": 0}
+
+    for z, xmin, xmax, ymin, ymax in tile_ranges(bounds, minzoom, maxzoom):
+        found = set()
+        if profile is not None:
+            q, p = render(
+                prepared_statement("export-cached-tiles"),
+                profile=profile.id,
+                args_hash=create_params_hash(params),
+                z=z,
+                xmin=xmin,
+                xmax=xmax,
+                ymin=ymin,
+                ymax=ymax,
+            )
+            async with pool.acquire() as conn:
+                async with conn.transaction():
+                    async for row in conn.cursor(q, *p, prefetch=fetch_size):
+                        found.add((row["x"], row["y"]))
+                        if len(row["tile"]) == 0:
+                            counts["empty"] += 1
+                            continue
+                        writer.write(
+                            z,
+                            row["x"],
+                            row["y"],
+                            row["tile_gzip"] or _gzip(row["tile"]),
+                            row["etag"] or tile_etag(row["tile"]),
+                        )
+                        counts["cached"] += 1
+
+        missing = (
+            Tile(x, y, z)
+            for x in range(xmin, xmax + 1)
+            for y in range(ymin, ymax + 1)
+            if (x, y) not in found
+        )
+        await _render_tiles(pool, layer, writer, missing, params, concurrency, counts)
+        log.info("Exported zoom level %s: %s", z, counts)
+
+    return counts
+
+
+async def _render_tiles(pool, layer, writer, tiles, params, concurrency, counts):
+    """Render tiles with a pool of workers, keeping only a few tiles in memory."""
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+
+    async def worker():
+        while True:
+            tile = await queue.get()
+            if tile is None:
+                return
+            try:
+                content = await layer.get_tile(pool, tile, tms, **params)
+            except Exception as exc:
+                counts["failed"] += 1
+                log.error("Failed to render tile %s: %s", tile, exc)
+                continue
+            if not content:
+                counts["empty"] += 1
+                continue
+            writer.write(tile.z, tile.x, tile.y, _gzip(content), tile_etag(content))
+            counts["rendered"] += 1
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(concurrency)]
+    try:
+        for tile in tiles:
+            await queue.put(tile)
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    finally:
+        for w in workers:
+            w.cancel()
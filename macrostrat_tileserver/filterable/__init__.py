@@ -1,11 +1,23 @@
 from pathlib import Path
 from typing import List
 
-from buildpg import V, render
+from buildpg import V
 from fastapi import APIRouter, Request, Query
 from macrostrat.utils import get_logger
-
-from ..utils import scales_for_zoom, MapCompilation, get_layer_sql, VectorTileResponse
+from macrostrat.utils.timer import Timer
+
+from ..utils import (
+    scales_for_zoom,
+    MapCompilation,
+    get_layer_sql,
+    request_etags,
+    tile_etag,
+    TileResponse,
+)
+from ..utils.admission import admission
+from ..utils.statements import compile_statement, statements
+from ..utils.sublayers import sublayer_runner
+from ..utils.timeouts import query_timeouts, until_disconnected
 
 log = get_logger(__name__)
 
@@ -16,15 +28,16 @@ __here__ = Path(__file__).parent
 
 @router.get("/{compilation}/{z}/{x}/{y}")
 async def get_tile(
-        request: Request,
-        compilation: MapCompilation,
-        z: int,
-        x: int,
-        y: int,
-        lithology: List[str] = Query(None)
+    request: Request,
+    compilation: MapCompilation,
+    z: int,
+    x: int,
+    y: int,
+    lithology: List[str] = Query(None),
 ):
     """Get a tile from the tileserver."""
-    pool = request.app.state.pool
+    pool = request.app.state.read_pool
+    timer = Timer()
 
     mapsize, linesize = scales_for_zoom(z)
 
@@ -36,23 +49,34 @@ async def get_tile(
         y=y,
         mapsize=mapsize,
         linesize=linesize,
+        timeout=query_timeouts.timeout_for("filterable", z),
     )
 
-    async with pool.acquire() as con:
-        units_ = await run_layer_query(
+    # Sublayers are queried concurrently, on separate connections
+    queries = {
+        "units": lambda con: run_layer_query(
             con,
             "units",
-            compilation=V(compilation_name + ".polygons"),
+            compilation=compilation_name + ".polygons",
             lithology=lithology,
-            **params
-        )
-        lines_ = await run_layer_query(
-            con,
-            "lines",
-            compilation=V(compilation_name + ".lines"),
-            **params
+            **params,
+        ),
+        "lines": lambda con: run_layer_query(
+            con, "lines", compilation=compilation_name + ".lines", **params
+        ),
+    }
+    # The tile coroutine is only created once admitted, so that it isn't left
+    # un-awaited when the request is shed
+    async with admission.render("filterable"):
+        content = await until_disconnected(
+            request, sublayer_runner.run(pool, queries, timer=timer)
         )
-    return VectorTileResponse(units_, lines_)
+
+    etag = tile_etag(content)
+    return TileResponse(
+        content, timer, etag=etag, not_modified=etag in request_etags(request)
+    )
+
 
 def build_lithology_clause(lithology: List[str]):
     """Build a WHERE clause to filter by lithology."""
@@ -71,10 +95,18 @@ def build_lithology_clause(lithology: List[str]):
     return f"({q})"
 
 
-async def run_layer_query(con, layer_name, **params):
-    query = get_layer_sql( __here__ / "queries",  layer_name)
-    if ":where_lithology" in query:
-        lith_clause = build_lithology_clause(params.get("lithology"))
-        query = query.replace(":where_lithology", lith_clause)
-    q, p = render(query, layer_name=layer_name, **params)
-    return await con.fetchval(q, *p)
+async def run_layer_query(con, layer_name, *, compilation, **params):
+    # The lithology clause only changes shape when lithologies are given
+    filter_lithology = bool(params.get("lithology"))
+
+    def build():
+        query = get_layer_sql(__here__ / "queries", layer_name)
+        if ":where_lithology" in query:
+            lith_clause = build_lithology_clause(params.get("lithology"))
+            query = query.replace(":where_lithology", lith_clause)
+        return compile_statement(query, compilation=V(compilation))
+
+    statement = statements.get(
+        ("filterable", layer_name, compilation, filter_lithology), build
+    )
+    return await statements.fetchval(con, statement, layer_name=layer_name, **params)
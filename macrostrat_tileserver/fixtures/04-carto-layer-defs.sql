@@ -75,7 +75,8 @@ SELECT
 FROM maps.legend AS l;
 
 
-CREATE OR REPLACE FUNCTION tile_layers.carto_slim(
+
+CREATE OR REPLACE FUNCTION tile_layers.carto_slim_bedrock(
   -- bounding box
   x integer,
   y integer,
@@ -86,15 +87,12 @@ CREATE OR REPLACE FUNCTION tile_layers.carto_slim(
 RETURNS bytea
 AS $$
 DECLARE
-srid integer;
-features record;
 mapsize text;
 linesize text[];
 mercator_bbox geometry;
 projected_bbox geometry;
-bedrock bytea;
-lines bytea;
 tolerance double precision;
+bedrock bytea;
 BEGIN
 
 mercator_bbox := tile_utils.envelope(x, y, z);
@@ -152,6 +150,54 @@ SELECT
 INTO bedrock
 FROM expanded;
 
+RETURN bedrock;
+
+END;
+$$ LANGUAGE plpgsql IMMUTABLE;
+
+
+CREATE OR REPLACE FUNCTION tile_layers.carto_slim_lines(
+  -- bounding box
+  x integer,
+  y integer,
+  z integer,
+  -- additional parameters
+  query_params json
+)
+RETURNS bytea
+AS $$
+DECLARE
+mapsize text;
+linesize text[];
+mercator_bbox geometry;
+projected_bbox geometry;
+tolerance double precision;
+lines bytea;
+BEGIN
+
+mercator_bbox := tile_utils.envelope(x, y, z);
+tolerance := 6;
+
+projected_bbox := ST_Transform(
+  mercator_bbox,
+  4326
+);
+
+IF z < 3 THEN
+  -- Select from carto.tiny table
+  mapsize := 'tiny';
+  linesize := ARRAY['tiny'];
+ELSIF z < 6 THEN
+  mapsize := 'small';
+  linesize := ARRAY['tiny', 'small'];
+ELSIF z < 9 THEN
+  mapsize := 'medium';
+  linesize := ARRAY['small', 'medium'];
+ELSE
+  mapsize := 'large';
+  linesize := ARRAY['medium', 'large'];
+END IF;
+
 -- LINES
 WITH mvt_features AS (
   SELECT
@@ -187,14 +233,31 @@ SELECT
   ST_AsMVT(expanded, 'lines') INTO lines
 FROM expanded;
 
-RETURN bedrock || lines;
+RETURN lines;
 
 END;
 $$ LANGUAGE plpgsql IMMUTABLE;
 
 
+-- Sublayers are separate functions, so that the tileserver can run them
+-- concurrently on separate connections
+CREATE OR REPLACE FUNCTION tile_layers.carto_slim(
+  -- bounding box
+  x integer,
+  y integer,
+  z integer,
+  -- additional parameters
+  query_params json
+)
+RETURNS bytea
+AS $$
+SELECT tile_layers.carto_slim_bedrock(x, y, z, query_params)
+  || tile_layers.carto_slim_lines(x, y, z, query_params);
+$$ LANGUAGE sql IMMUTABLE;
+
+
 --- CARTO
-CREATE OR REPLACE FUNCTION tile_layers.carto(
+CREATE OR REPLACE FUNCTION tile_layers.carto_bedrock(
   -- bounding box
   x integer,
   y integer,
@@ -205,14 +268,11 @@ CREATE OR REPLACE FUNCTION tile_layers.carto(
 RETURNS bytea
 AS $$
 DECLARE
-srid integer;
-features record;
 mapsize text;
 linesize text[];
 mercator_bbox geometry;
 projected_bbox geometry;
 bedrock bytea;
-lines bytea;
 BEGIN
 
 mercator_bbox := tile_utils.envelope(x, y, z);
@@ -288,6 +348,52 @@ SELECT
 INTO bedrock
 FROM expanded;
 
+RETURN bedrock;
+
+END;
+$$ LANGUAGE plpgsql IMMUTABLE;
+
+
+CREATE OR REPLACE FUNCTION tile_layers.carto_lines(
+  -- bounding box
+  x integer,
+  y integer,
+  z integer,
+  -- additional parameters
+  query_params json
+)
+RETURNS bytea
+AS $$
+DECLARE
+mapsize text;
+linesize text[];
+mercator_bbox geometry;
+projected_bbox geometry;
+lines bytea;
+BEGIN
+
+mercator_bbox := tile_utils.envelope(x, y, z);
+
+projected_bbox := ST_Transform(
+  mercator_bbox,
+  4326
+);
+
+IF z < 3 THEN
+  -- Select from carto.tiny table
+  mapsize := 'tiny';
+  linesize := ARRAY['tiny'];
+ELSIF z < 6 THEN
+  mapsize := 'small';
+  linesize := ARRAY['tiny', 'small'];
+ELSIF z < 9 THEN
+  mapsize := 'medium';
+  linesize := ARRAY['small', 'medium'];
+ELSE
+  mapsize := 'large';
+  linesize := ARRAY['medium', 'large'];
+END IF;
+
 -- LINES
 WITH mvt_features AS (
   SELECT
@@ -323,11 +429,28 @@ SELECT
   ST_AsMVT(expanded, 'lines') INTO lines
 FROM expanded;
 
-RETURN bedrock || lines;
+RETURN lines;
 
 END;
 $$ LANGUAGE plpgsql IMMUTABLE;
 
+
+-- Sublayers are separate functions, so that the tileserver can run them
+-- concurrently on separate connections
+CREATE OR REPLACE FUNCTION tile_layers.carto(
+  -- bounding box
+  x integer,
+  y integer,
+  z integer,
+  -- additional parameters
+  query_params json
+)
+RETURNS bytea
+AS $$
+SELECT tile_layers.carto_bedrock(x, y, z, query_params)
+  || tile_layers.carto_lines(x, y, z, query_params);
+$$ LANGUAGE sql IMMUTABLE;
+
 CREATE OR REPLACE FUNCTION tile_layers.tile_geom(
   geom geometry,
   bbox geometry
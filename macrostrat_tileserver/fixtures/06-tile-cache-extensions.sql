@@ -0,0 +1,192 @@
+/**
+  Extensions to the tile cache schema defined in postgis-tile-utils
+  (03-tile-cache.sql) that are specific to this tileserver.
+*/
+
+/* Parameter hashes are 64 bits wide, to make collisions unlikely at our scale */
+DO $$
+BEGIN
+  IF (
+    SELECT data_type FROM information_schema.columns
+    WHERE table_schema = 'tile_cache'
+      AND table_name = 'tile'
+      AND column_name = 'args_hash'
+  ) <> 'bigint' THEN
+    ALTER TABLE tile_cache.tile ALTER COLUMN args_hash TYPE bigint;
+  END IF;
+END $$;
+
+/* Pre-compressed variants of each tile, matching HTTP Content-Encoding values */
+ALTER TABLE tile_cache.tile
+  ADD COLUMN IF NOT EXISTS tile_gzip bytea,
+  ADD COLUMN IF NOT EXISTS tile_br bytea,
+  ADD COLUMN IF NOT EXISTS tile_zstd bytea;
+
+/* Content hash of each tile, used as an HTTP ETag */
+ALTER TABLE tile_cache.tile
+  ADD COLUMN IF NOT EXISTS etag text;
+
+/* Cache-Control max-age (in seconds) for tiles in each profile */
+ALTER TABLE tile_cache.profile
+  ADD COLUMN IF NOT EXISTS max_age integer;
+
+/* Storage used by each cached tile, including its pre-compressed variants */
+ALTER TABLE tile_cache.tile
+  ADD COLUMN IF NOT EXISTS size integer GENERATED ALWAYS AS (
+    coalesce(octet_length(tile), 0)
+    + coalesce(octet_length(tile_gzip), 0)
+    + coalesce(octet_length(tile_br), 0)
+    + coalesce(octet_length(tile_zstd), 0)
+  ) STORED;
+
+/* Number of (sampled) accesses, for least-frequently-used eviction */
+ALTER TABLE tile_cache.tile
+  ADD COLUMN IF NOT EXISTS hits integer NOT NULL DEFAULT 0;
+
+CREATE INDEX IF NOT EXISTS tile_profile_last_used_idx
+  ON tile_cache.tile (profile, last_used);
+
+CREATE INDEX IF NOT EXISTS tile_profile_hits_idx
+  ON tile_cache.tile (profile, hits, last_used);
+
+/* Eviction settings for each profile (sizes in bytes):
+  - max_size: quota that the profile's tiles may not exceed
+  - min_size: storage reserved for the profile when evicting to fit the overall budget
+  - pinned_maxzoom: tiles at or below this zoom level are never evicted */
+ALTER TABLE tile_cache.profile
+  ADD COLUMN IF NOT EXISTS max_size bigint,
+  ADD COLUMN IF NOT EXISTS min_size bigint,
+  ADD COLUMN IF NOT EXISTS pinned_maxzoom integer;
+
+/* Storage used by each profile at each zoom level, kept up to date by triggers so that
+  eviction doesn't need to scan the tile table. Counters are updated once per statement
+  (e.g., per batch of cache writes or evictions) rather than once per tile. */
+CREATE OR REPLACE FUNCTION tile_cache.update_profile_usage()
+RETURNS trigger AS $$
+BEGIN
+  IF TG_OP = 'TRUNCATE' THEN
+    DELETE FROM tile_cache.profile_usage;
+    RETURN NULL;
+  END IF;
+
+  IF TG_OP IN ('UPDATE', 'DELETE') THEN
+    INSERT INTO tile_cache.profile_usage AS u (profile, z, size, n_tiles)
+    SELECT profile, z, -coalesce(sum(size), 0), -count(*)
+    FROM old_tiles
+    GROUP BY profile, z
+    ON CONFLICT (profile, z) DO UPDATE
+    SET size = u.size + EXCLUDED.size,
+        n_tiles = u.n_tiles + EXCLUDED.n_tiles;
+  END IF;
+
+  IF TG_OP IN ('INSERT', 'UPDATE') THEN
+    INSERT INTO tile_cache.profile_usage AS u (profile, z, size, n_tiles)
+    SELECT profile, z, coalesce(sum(size), 0), count(*)
+    FROM new_tiles
+    GROUP BY profile, z
+    ON CONFLICT (profile, z) DO UPDATE
+    SET size = u.size + EXCLUDED.size,
+        n_tiles = u.n_tiles + EXCLUDED.n_tiles;
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+/* The counters are created and filled in one statement, together with their triggers,
+  so that concurrent cache writes can't be missed. */
+DO $$
+BEGIN
+  IF to_regclass('tile_cache.profile_usage') IS NULL THEN
+    CREATE TABLE tile_cache.profile_usage (
+      profile integer NOT NULL,
+      z integer NOT NULL,
+      size bigint NOT NULL DEFAULT 0,
+      n_tiles bigint NOT NULL DEFAULT 0,
+      PRIMARY KEY (profile, z)
+    );
+
+    CREATE TRIGGER tile_usage_insert
+      AFTER INSERT ON tile_cache.tile
+      REFERENCING NEW TABLE AS new_tiles
+      FOR EACH STATEMENT EXECUTE FUNCTION tile_cache.update_profile_usage();
+
+    CREATE TRIGGER tile_usage_update
+      AFTER UPDATE ON tile_cache.tile
+      REFERENCING OLD TABLE AS old_tiles NEW TABLE AS new_tiles
+      FOR EACH STATEMENT EXECUTE FUNCTION tile_cache.update_profile_usage();
+
+    CREATE TRIGGER tile_usage_delete
+      AFTER DELETE ON tile_cache.tile
+      REFERENCING OLD TABLE AS old_tiles
+      FOR EACH STATEMENT EXECUTE FUNCTION tile_cache.update_profile_usage();
+
+    CREATE TRIGGER tile_usage_truncate
+      AFTER TRUNCATE ON tile_cache.tile
+      FOR EACH STATEMENT EXECUTE FUNCTION tile_cache.update_profile_usage();
+
+    INSERT INTO tile_cache.profile_usage (profile, z, size, n_tiles)
+    SELECT profile, z, coalesce(sum(size), 0), count(*)
+    FROM tile_cache.tile
+    GROUP BY profile, z;
+  END IF;
+END $$;
+
+/* Requests to invalidate the cached tiles of map sources, with the footprints the
+  sources had before they changed (so that tiles outside a shrunken or deleted footprint
+  are removed too). Tileserver workers claim each request, so that only one of them
+  deletes the tiles. */
+CREATE TABLE IF NOT EXISTS tile_cache.source_invalidation (
+  source_id integer PRIMARY KEY,
+  previous_footprint geometry,
+  requested timestamptz NOT NULL DEFAULT clock_timestamp()
+);
+
+CREATE OR REPLACE FUNCTION tile_cache.invalidate_source(
+  _source_id integer,
+  _previous_footprint geometry DEFAULT NULL
+)
+RETURNS void AS $$
+BEGIN
+  INSERT INTO tile_cache.source_invalidation AS i (source_id, previous_footprint)
+  VALUES (_source_id, _previous_footprint)
+  ON CONFLICT (source_id) DO UPDATE
+  SET
+    previous_footprint = CASE
+      WHEN i.previous_footprint IS NULL THEN EXCLUDED.previous_footprint
+      WHEN EXCLUDED.previous_footprint IS NULL THEN i.previous_footprint
+      ELSE ST_Union(i.previous_footprint, EXCLUDED.previous_footprint)
+    END,
+    requested = clock_timestamp();
+  -- Delivered when the transaction commits, once the source's new footprint is visible
+  PERFORM pg_notify(
+    'tile_cache_invalidation',
+    json_build_object('source_id', _source_id)::text
+  );
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION tile_cache.source_footprint_changed()
+RETURNS trigger AS $$
+BEGIN
+  PERFORM tile_cache.invalidate_source(OLD.source_id, OLD.rgeom);
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+BEGIN
+  IF to_regclass('maps.sources') IS NOT NULL THEN
+    DROP TRIGGER IF EXISTS source_footprint_updated ON maps.sources;
+    CREATE TRIGGER source_footprint_updated
+      AFTER UPDATE OF rgeom ON maps.sources
+      FOR EACH ROW
+      WHEN (OLD.rgeom IS DISTINCT FROM NEW.rgeom)
+      EXECUTE FUNCTION tile_cache.source_footprint_changed();
+
+    DROP TRIGGER IF EXISTS source_footprint_deleted ON maps.sources;
+    CREATE TRIGGER source_footprint_deleted
+      AFTER DELETE ON maps.sources
+      FOR EACH ROW
+      EXECUTE FUNCTION tile_cache.source_footprint_changed();
+  END IF;
+END $$;
@@ -1,9 +1,11 @@
 import json
-from typing import Any, Dict, List, Optional
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional
 
 import morecantile
+from asyncpg import UndefinedFunctionError
 from buildpg import Func
-from buildpg import asyncpg, clauses, render
+from buildpg import asyncpg, clauses
 
 from timvt.errors import (
     MissingEPSGCode,
@@ -11,6 +13,12 @@ from timvt.errors import (
 from timvt.settings import TileSettings
 from timvt.layer import Function
 from macrostrat.utils import get_logger
+from macrostrat.utils.timer import Timer
+from pydantic import PrivateAttr
+
+from .utils.statements import Statement, compile_statement, statements
+from .utils.sublayers import sublayer_runner
+from .utils.timeouts import query_timeouts
 
 log = get_logger(__name__)
 
@@ -19,7 +27,13 @@ tile_settings = TileSettings()
 
 
 class StoredFunction(Function):
-    def __init__(self, function_name: str):
+    def __init__(
+        self,
+        function_name: str,
+        parameters: Optional[Dict[str, Callable[[Any], Any]]] = None,
+        transactional: bool = False,
+        sublayers: Optional[Dict[str, str]] = None,
+    ):
         if "." in function_name:
             id = function_name.split(".")[1]
         id = id.replace("_", "-")
@@ -28,36 +42,83 @@ class StoredFunction(Function):
             sql="",
             id=id,
             function_name=function_name,
+            parameters=parameters,
+            transactional=transactional,
+            sublayers=sublayers,
         )
 
     type: str = "StoredFunction"
+    # Query parameters accepted by the function, mapped to a type conversion.
+    # If not set, all parameters are passed through.
+    parameters: Optional[Dict[str, Callable[[Any], Any]]] = None
+    # Run the function in a transaction that is rolled back, for functions that
+    # may modify state (e.g., create temporary tables). Other functions run as a
+    # single statement, possibly on a read replica, so they must be read-only (e.g.,
+    # the IMMUTABLE functions defined in our fixtures).
+    transactional: bool = False
+    # Functions that generate each sublayer of the tile, by layer name. If set, they
+    # are run concurrently and joined, instead of calling the combined function.
+    sublayers: Optional[Dict[str, str]] = None
+    # Set when the sublayer functions aren't defined in the database (e.g., fixtures
+    # from before they were split out), so that the combined function is used instead
+    _sublayers_missing: bool = PrivateAttr(default=False)
+
+    def normalize_params(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        """Reduce request parameters to the canonical form accepted by the function.
+        Unknown parameters are dropped, and values are converted to their declared types.
+        """
+        if self.parameters is None:
+            return params
+
+        res = {}
+        for key, convert in sorted(self.parameters.items()):
+            value = params.get(key)
+            if value is None:
+                continue
+            try:
+                if isinstance(value, list):
+                    res[key] = [convert(v) for v in value]
+                else:
+                    res[key] = convert(value)
+            except (TypeError, ValueError):
+                raise ValueError(f"Invalid value for parameter {key}: {value}")
+        return res
+
+    def statement(self, function_name: Optional[str] = None) -> Statement:
+        """The query for this layer's tiles (or a sublayer function), built once and
+        shared by all requests."""
+        function_name = function_name or self.function_name
+
+        def build():
+            sql_query = clauses.Select(
+                Func(
+                    function_name,
+                    ":x",
+                    ":y",
+                    ":z",
+                    ":query_params::text::json",
+                ),
+            )
+            return compile_statement(str(sql_query))
+
+        return statements.get(("function", function_name), build)
+
+    def query_values(self, tile: morecantile.Tile, **kwargs: Any) -> dict[str, Any]:
+        kwargs = self.normalize_params(kwargs)
+        return dict(x=tile.x, y=tile.y, z=tile.z, query_params=json.dumps(kwargs))
 
     def render_query(
         self, tile: morecantile.Tile, tms: morecantile.TileMatrixSet, **kwargs: Any
     ):
-        # Build the query
-        sql_query = clauses.Select(
-            Func(
-                self.function_name,
-                ":x",
-                ":y",
-                ":z",
-                ":query_params::text::json",
-            ),
-        )
-        return render(
-            str(sql_query),
-            x=tile.x,
-            y=tile.y,
-            z=tile.z,
-            query_params=json.dumps(kwargs),
-        )
+        statement = self.statement()
+        return statement.sql, statement.args(self.query_values(tile, **kwargs))
 
     async def get_tile(
         self,
         pool: asyncpg.BuildPgPool,
         tile: morecantile.Tile,
         tms: morecantile.TileMatrixSet,
+        timer: Timer = None,
         **kwargs: Any,
     ):
         """Get Tile Data."""
@@ -68,17 +129,59 @@ class StoredFunction(Function):
                 f"{tms.identifier}'s CRS does not have a valid EPSG code."
             )
 
-        q, p = self.render_query(tile, tms, **kwargs)
-        log.debug("Executing query: %s, %s", q, p)
+        values = self.query_values(tile, **kwargs)
+        timeout = query_timeouts.timeout_for(self.id, tile.z)
+        if self._use_sublayers:
+            try:
+                return await sublayer_runner.run(
+                    pool,
+                    {
+                        name: partial(
+                            self._fetch,
+                            statement=self.statement(func),
+                            timeout=timeout,
+                            **values,
+                        )
+                        for name, func in self.sublayers.items()
+                    },
+                    timer=timer,
+                    step="query",
+                )
+            except UndefinedFunctionError as err:
+                log.warning(
+                    "Sublayer functions for %s are not defined (%s); re-run "
+                    "`tileserver create-fixtures` to query them concurrently",
+                    self.function_name,
+                    err,
+                )
+                self._sublayers_missing = True
+
+        statement = self.statement()
+        log.debug("Executing query: %s, %s", statement.sql, values)
         async with pool.acquire() as conn:
-            transaction = conn.transaction()
-            await transaction.start()
-            # execute the query
-            content = await conn.fetchval(q, *p)
-            # rollback
-            await transaction.rollback()
+            return await self._fetch(conn, statement, timeout=timeout, **values)
 
-        return content
+    @property
+    def _use_sublayers(self) -> bool:
+        return (
+            self.sublayers is not None
+            and sublayer_runner.concurrent
+            and not self._sublayers_missing
+        )
+
+    async def _fetch(
+        self, conn, statement: Statement, timeout: float = None, **values: Any
+    ):
+        if not self.transactional:
+            return await statements.fetchval(conn, statement, timeout=timeout, **values)
+
+        transaction = conn.transaction()
+        await transaction.start()
+        try:
+            return await statements.fetchval(conn, statement, timeout=timeout, **values)
+        finally:
+            # Discard any changes, including when the function fails
+            await transaction.rollback()
 
     async def validate_request(
         self,
@@ -1,34 +1,67 @@
 from fastapi import Request
 from morecantile import Tile
 from timvt.dependencies import TileParams
-from fastapi import Depends, BackgroundTasks
+from fastapi import Depends, BackgroundTasks, Path
 from macrostrat.utils import get_logger
+from ..utils import CacheMode
+from .config import ImageFormat, ImageRenderer
+from .core import ImageTileSubsystem
 
 log = get_logger(__name__)
 
-image_tiler = None
-try:
-    from .core import ImageTileSubsystem
+image_tiler = ImageTileSubsystem()
 
-    image_tiler = ImageTileSubsystem()
-except ImportError:
-    log.info("Mapnik not available; image tile subsystem disabled")
 
+async def prepare_image_tile_subsystem(**kwargs):
+    await image_tiler.start(**kwargs)
 
-def prepare_image_tile_subsystem():
-    if image_tiler is not None:
-        image_tiler.build_layer_cache()
+
+def shutdown_image_tile_subsystem():
+    image_tiler.renders.close()
+
+
+def image_tile_stats():
+    if not image_tiler.enabled:
+        return None
+    return image_tiler.renders.stats()
 
 
 def MapnikLayerFactory(app):
-    @app.get("/carto/{z}/{x}/{y}.png")
-    @app.get("/carto-slim/{z}/{x}/{y}.png")
+    for format in ImageFormat:
+        _register_image_routes(app, format)
+
+
+def _register_image_routes(app, format: ImageFormat):
+    ext = format.value
+
+    # High-DPI routes come first, so that "{y}@2x" isn't matched as a tile row
+    @app.get(f"/carto/{{z}}/{{x}}/{{y}}@{{scale_factor}}x.{ext}")
+    @app.get(f"/carto-slim/{{z}}/{{x}}/{{y}}@{{scale_factor}}x.{ext}")
+    async def scaled_tile(
+        request: Request,
+        background_tasks: BackgroundTasks,
+        tile: Tile = Depends(TileParams),
+        scale_factor: int = Path(..., ge=1, le=2),
+        cache: CacheMode = CacheMode.prefer,
+    ):
+        """Return high-DPI image tile."""
+        if not image_tiler.enabled:
+            return "Image tiles not available", 404
+        return await image_tiler.handle_tile_request(
+            request, background_tasks, tile, cache, scale_factor, format
+        )
+
+    @app.get(f"/carto/{{z}}/{{x}}/{{y}}.{ext}")
+    @app.get(f"/carto-slim/{{z}}/{{x}}/{{y}}.{ext}")
     async def tile(
         request: Request,
         background_tasks: BackgroundTasks,
         tile: Tile = Depends(TileParams),
+        cache: CacheMode = CacheMode.prefer,
     ):
-        """Return vector tile."""
-        if image_tiler is None:
-            return "Mapnik not available", 404
-        return await image_tiler.handle_tile_request(request, background_tasks, tile)
+        """Return image tile."""
+        if not image_tiler.enabled:
+            return "Image tiles not available", 404
+        return await image_tiler.handle_tile_request(
+            request, background_tasks, tile, cache, 1, format
+        )
@@ -1,3 +1,37 @@
+from enum import Enum
+
+# Size of image tiles, in pixels
+tile_size = 512
+
+
+class ImageRenderer(str, Enum):
+    """How image tiles are drawn: with Mapnik querying PostGIS directly, or by
+    rasterizing the corresponding `carto` vector tiles."""
+
+    MAPNIK = "mapnik"
+    VECTOR = "vector"
+
+
+class ImageFormat(str, Enum):
+    PNG = "png"
+    WEBP = "webp"
+    JPEG = "jpg"
+
+    @property
+    def media_type(self) -> str:
+        if self == ImageFormat.JPEG:
+            return "image/jpeg"
+        return f"image/{self.value}"
+
+
+def variant_params(scale_factor: int, format: ImageFormat):
+    """Cache parameters for a variant of an image tile. Standard-resolution PNGs
+    have none, so they share cache entries with tiles cached before variants."""
+    if scale_factor == 1 and format == ImageFormat.PNG:
+        return None
+    return {"format": format.value, "scale_factor": scale_factor}
+
+
 # All of our burwell scales
 scales = ["tiny", "small", "medium", "large"]
 
@@ -27,3 +61,12 @@ layer_order = {
     "medium": ["small", "medium"],
     "large": ["medium", "large"],
 }
+
+
+def metatile_origin(tile, metatile_size: int) -> tuple[int, int, int]:
+    """Get the top-left tile and width (in tiles) of the metatile containing a tile.
+
+    Metatiles are clipped to the size of the tile grid at low zoom levels.
+    """
+    n = min(metatile_size, 2**tile.z)
+    return (tile.x // n) * n, (tile.y // n) * n, n
@@ -1,16 +1,40 @@
+import asyncio
 from fastapi import Request
 from morecantile import Tile, tms
-from mapnik import Map, load_map_from_string, Image, render, Box2d
 from timvt.dependencies import TileParams
 from timvt.settings import TileSettings
 import time
-from .mapnik_styles import make_mapnik_xml
-from .config import scales, scale_for_zoom
+from .mapnik_styles import build_mapnik_styles, default_cache_dir
+from .config import (
+    ImageFormat,
+    ImageRenderer,
+    metatile_origin,
+    scales,
+    variant_params,
+)
+from .render_pool import RenderPool, RenderPoolFull
+from .vector_render import init_vector_worker, render_vector_tile
+from . import vector_render
 from fastapi import Depends, BackgroundTasks, HTTPException
+from macrostrat.utils import get_logger
 from macrostrat.utils.timer import Timer
 from timvt.resources.enums import MimeTypes
-from ..cache import get_tile_from_cache, set_cached_tile
-from ..utils import TileResponse, CacheStatus, CacheMode
+from ..cache import get_cache_profile, get_tile_from_cache, set_cached_tile
+from ..cached_tiler import render_layer_tile
+from ..utils import TileResponse, CacheStatus, CacheMode, request_etags, tile_etag
+from ..utils.single_flight import SingleFlight
+from ..utils.timeouts import until_disconnected
+from macrostrat.database import Database
+from os import environ
+from pathlib import Path
+from typing import Optional
+
+try:
+    from .render import init_worker, render_metatile, render_tile
+except ImportError:
+    init_worker = None
+
+log = get_logger(__name__)
 
 tile_settings = TileSettings()
 
@@ -25,44 +49,158 @@ class ImageTileSubsystem:
 
     This "v2" implementation of the image tile system replaces the much less efficient "v1" version
     that was implemented in NodeJS.
+
+    Alternatively, image tiles can be drawn from the `carto` vector tiles (using Pillow
+    rather than Mapnik), which keeps the database out of raster rendering.
     """
 
     layer_cache = {}
+    # Mapnik renders are CPU-bound, so they run in separate processes
+    renders = RenderPool()
+    # Requests for tiles in a metatile that is already being rendered wait for it
+    metatiles = SingleFlight()
+    metatile_size = 1
+    renderer = ImageRenderer.MAPNIK
+    # Layer that image tiles are drawn from by the vector renderer
+    vector_layer = "carto"
+    vector_tiles = SingleFlight(cancel_abandoned=True)
+    enabled = False
 
-    def build_layer_cache(self):
+    def build_layer_cache(self, cache_dir: Path = default_cache_dir):
         ## Generate mapnik XML files
-        for scale in scales:
-            # Log timings
-            t = time.time()
-            self.layer_cache[scale] = make_mapnik_xml(scale, db.engine.url)
-            print(
-                f"Generated mapnik XML for scale {scale} in {time.time() - t} seconds"
+        t = time.time()
+        self.layer_cache.update(
+            build_mapnik_styles(scales, db.engine.url, cache_dir=cache_dir)
+        )
+        print(
+            f"Prepared mapnik XML for {len(scales)} scales in {time.time() - t} seconds"
+        )
+
+    async def start(
+        self,
+        processes: int = 2,
+        max_queue_size: int = 16,
+        timeout=30.0,
+        metatile_size: int = 1,
+        style_cache_dir: Path = None,
+        renderer: ImageRenderer = ImageRenderer.MAPNIK,
+    ):
+        """Build styles and start the rendering processes."""
+        self.renderer = renderer
+        if renderer == ImageRenderer.VECTOR:
+            if vector_render.Image is None:
+                log.info("Pillow not available; image tile subsystem disabled")
+                return
+            style = (Path(__file__).parent / "style.mss").read_text()
+            initializer, initargs = init_vector_worker, (style,)
+        else:
+            if init_worker is None:
+                log.info("Mapnik not available; image tile subsystem disabled")
+                return
+            # Compiling styles blocks on subprocesses, so keep it off the event loop
+            await asyncio.to_thread(
+                self.build_layer_cache, style_cache_dir or default_cache_dir
             )
+            self.metatile_size = max(metatile_size, 1)
+            initializer = init_worker
+            initargs = (self.layer_cache, self.metatile_size)
 
-    def get_tile(self, tile: Tile, tms) -> bytes:
-        quad = tms.get("WebMercatorQuad")
-        bbox = quad.xy_bounds(tile)
+        self.renders.configure(
+            processes=processes, max_queue_size=max_queue_size, timeout=timeout
+        )
+        await self.renders.start(initializer=initializer, initargs=initargs)
+        self.enabled = True
 
-        # Get map scale for this zoom level
-        scale = scale_for_zoom(tile.z)
+    async def get_vector_tile(
+        self, request: Request, background_tasks: BackgroundTasks, tile: Tile
+    ) -> bytes:
+        """Get the vector tile that an image tile is drawn from, preferring the cache.
+        Vector tiles rendered here are cached for the vector tile endpoints as well."""
+        pool = request.app.state.pool
+        read_pool = request.app.state.read_pool
+        layer = request.app.state.function_catalog.get(self.vector_layer)
+        profile = await get_cache_profile(pool, layer.id)
+        if profile is not None:
+            cached = await get_tile_from_cache(read_pool, profile.id, {}, tile, None)
+            if cached is not None:
+                return cached.content
 
-        # Path to mapnik XML file
+        # Renders are admitted and time-limited like those of the vector tile endpoints
+        quad = tms.get("WebMercatorQuad")
+        render_pool = pool if layer.transactional else read_pool
+        content, is_leader = await until_disconnected(
+            request,
+            self.vector_tiles.run(
+                (tile.z, tile.x, tile.y),
+                render_layer_tile,
+                layer,
+                render_pool,
+                tile,
+                quad,
+            ),
+        )
+        if is_leader and profile is not None:
+            background_tasks.add_task(
+                set_cached_tile,
+                pool,
+                profile.id,
+                {},
+                tile,
+                content,
+                request.app.state.tile_cache_encodings,
+            )
+        return content
 
-        # Load mapnik XML
-        map = Map(512, 512)
-        load_map_from_string(map, self.layer_cache[scale])
-        # Set bbox of map
+    async def render_tiles(
+        self,
+        request: Request,
+        background_tasks: BackgroundTasks,
+        tile: Tile,
+        timer: Timer = None,
+        scale_factor: int = 1,
+        format: ImageFormat = ImageFormat.PNG,
+    ) -> tuple[bytes, dict[Tile, bytes]]:
+        """Render a tile, along with the rest of its metatile if metatiling is enabled.
 
-        # map.zoom_all()
+        Returns the tile's content and the tiles rendered on behalf of this request,
+        which should be written to the cache. Requests that join a metatile render
+        already in progress get no tiles to cache, since the first request caches them.
+        """
+        fmt = format.value
+        if self.renderer == ImageRenderer.VECTOR:
+            data = await self.get_vector_tile(request, background_tasks, tile)
+            if timer is not None:
+                timer._add_step("vector_tile")
+            content = await self.renders.run(
+                render_vector_tile, data, tile.z, scale_factor, fmt, timer=timer
+            )
+            return content, {tile: content}
 
-        box = Box2d(bbox.left, bbox.top, bbox.right, bbox.bottom)
-        map.zoom_to_box(box)
+        if self.metatile_size == 1:
+            content = await self.renders.run(
+                render_tile, tile.z, tile.x, tile.y, scale_factor, fmt, timer=timer
+            )
+            return content, {tile: content}
 
-        # Render map to image
-        im = Image(512, 512)
-        render(map, im)
-        # Return image as binary
-        return im.tostring("png")
+        mx, my, n = metatile_origin(tile, self.metatile_size)
+        tiles, is_leader = await self.metatiles.run(
+            (tile.z, mx, my, scale_factor, fmt),
+            self.renders.run,
+            render_metatile,
+            tile.z,
+            mx,
+            my,
+            n,
+            scale_factor,
+            fmt,
+            timer=timer,
+        )
+        content = tiles[(tile.x, tile.y)]
+        if not is_leader:
+            if timer is not None:
+                timer._add_step("render_wait")
+            return content, {}
+        return content, {Tile(x, y, tile.z): v for (x, y), v in tiles.items()}
 
     async def handle_tile_request(
         self,
@@ -70,19 +208,41 @@ class ImageTileSubsystem:
         background_tasks: BackgroundTasks,
         tile: Tile = Depends(TileParams),
         cache: CacheMode = CacheMode.prefer,
+        scale_factor: int = 1,
+        format: ImageFormat = ImageFormat.PNG,
     ):
         """Return vector tile."""
         pool = request.app.state.pool
 
         timer = Timer()
+        # Each resolution and format is cached separately
+        params = variant_params(scale_factor, format)
+
+        etags = request_etags(request)
+        profile = await get_cache_profile(pool, "carto-image")
+        max_age = profile.max_age if profile is not None else None
+        should_cache = profile is not None and cache != CacheMode.bypass
 
         # If cache is not bypassed and the tile is in the cache, return it
-        if cache != CacheMode.bypass:
-            content = await get_tile_from_cache(pool, "carto-image", tile, None)
+        if should_cache:
+            cached = await get_tile_from_cache(
+                request.app.state.read_pool,
+                profile.id,
+                params,
+                tile,
+                None,
+                if_none_match=etags,
+            )
             timer._add_step("check_cache")
-            if content is not None:
+            if cached is not None:
                 return TileResponse(
-                    content, timer, cache_status=CacheStatus.hit, media_type="image/png"
+                    cached.content,
+                    timer,
+                    cache_status=CacheStatus.hit,
+                    media_type=format.media_type,
+                    etag=cached.etag,
+                    max_age=max_age,
+                    not_modified=cached.not_modified,
                 )
 
         # If the cache is forced and the tile is not in the cache, return a 404
@@ -90,20 +250,53 @@ class ImageTileSubsystem:
             raise HTTPException(
                 status_code=404,
                 detail="Tile not found in cache",
-                header={
+                headers={
                     "Server-Timing": timer.server_timings(),
                     "X-Tile-Cache": CacheStatus.miss,
                 },
             )
 
-        content = self.get_tile(tile, tms)
-        timer._add_step("get_tile")
-
-        if cache != CacheMode.bypass:
-            background_tasks.add_task(
-                set_cached_tile, pool, "carto-image", tile, content
+        try:
+            content, rendered = await self.render_tiles(
+                request, background_tasks, tile, timer, scale_factor, format
             )
+        except RenderPoolFull:
+            raise HTTPException(
+                status_code=503,
+                detail="Too many tiles are being rendered",
+                headers={"Retry-After": "1", "Server-Timing": timer.server_timings()},
+            )
+        except asyncio.TimeoutError:
+            raise HTTPException(
+                status_code=504,
+                detail="Tile rendering timed out",
+                headers={"Server-Timing": timer.server_timings()},
+            )
+        etag = tile_etag(content)
+
+        cache_status = CacheStatus.bypass
+        if should_cache:
+            background_tasks.add_task(_cache_tiles, pool, profile.id, params, rendered)
+            cache_status = CacheStatus.miss
 
         return TileResponse(
-            content, timer, cache_status=CacheStatus.miss, media_type="image/png"
+            content,
+            timer,
+            cache_status=cache_status,
+            media_type=format.media_type,
+            etag=etag,
+            max_age=max_age,
+            not_modified=etag in etags,
+        )
+
+
+async def _cache_tiles(
+    pool, profile_id: int, params: Optional[dict], tiles: dict[Tile, bytes]
+):
+    """Write all of the tiles from a render to the cache together."""
+    await asyncio.gather(
+        *(
+            set_cached_tile(pool, profile_id, params, tile, content)
+            for tile, content in tiles.items()
         )
+    )
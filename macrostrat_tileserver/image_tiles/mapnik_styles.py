@@ -1,18 +1,27 @@
 """
 Generate mapnik XML for each map scale.
-The stylesheets are regenerated every time the server is restarted.
+Compiled stylesheets are cached on disk, keyed by the inputs to the carto compiler,
+so they are only rebuilt when the style, layer definitions or compiler change.
 """
 
+import fcntl
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from hashlib import sha256
 from os import environ
 from pathlib import Path
 from subprocess import check_output, CalledProcessError
 from json import dumps
 from .config import layer_order
 from textwrap import dedent
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, gettempdir
 
 __here__ = Path(__file__).parent
 
+default_cache_dir = Path(gettempdir()) / "macrostrat-mapnik-styles"
+
 
 def make_carto_stylesheet(scale, db_url):
     pg_credentials = get_credentials(db_url)
@@ -117,19 +126,76 @@ def make_carto_stylesheet(scale, db_url):
     }
 
 
-def make_mapnik_xml(scale, db_url=None):
-    """Make a mapnik xml file for a given scale"""
-    carto = make_carto_stylesheet(scale, db_url)
-    # Call out to carto to convert the cartoCSS to mapnik xml
-    fn = f"/tmp/carto_{scale}.mml"
-    with open(fn, "w") as f:
-        f.write(dumps(carto))
+@lru_cache(maxsize=None)
+def carto_version() -> str:
+    return check_output(["carto", "--version"]).decode("utf-8").strip()
+
+
+def compile_carto(mml: str, workdir: Path = None) -> str:
+    """Call out to carto to convert a carto project to mapnik xml"""
+    with NamedTemporaryFile("w", suffix=".mml", dir=workdir) as f:
+        f.write(mml)
+        f.flush()
+        try:
+            return check_output(["carto", f.name]).decode("utf-8")
+        except CalledProcessError as exc:
+            print("Status : FAIL", exc.returncode, exc.output)
+            raise exc
+
+
+def style_cache_key(mml: str) -> str:
+    """Hash of everything that determines the compiled stylesheet. The MML
+    embeds the CartoCSS from `style.mss`."""
+    key = sha256(mml.encode("utf-8"))
+    key.update(carto_version().encode("utf-8"))
+    return key.hexdigest()[:16]
 
-    try:
-        return check_output(["carto", f.name]).decode("utf-8")
-    except CalledProcessError as exc:
-        print("Status : FAIL", exc.returncode, exc.output)
-        raise exc
+
+@contextmanager
+def _file_lock(path: Path):
+    with path.open("w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def make_mapnik_xml(scale, db_url=None, cache_dir: Path = None):
+    """Make a mapnik xml file for a given scale.
+
+    If a cache directory is given, compiled styles are reused across restarts and
+    shared between server processes; only one process compiles a missing style
+    while the others wait for it.
+    """
+    mml = dumps(make_carto_stylesheet(scale, db_url), sort_keys=True)
+    if cache_dir is None:
+        return compile_carto(mml)
+
+    cache_dir = Path(cache_dir)
+    # Styles include database credentials
+    cache_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+    path = cache_dir / f"{scale}-{style_cache_key(mml)}.xml"
+    if path.exists():
+        return path.read_text()
+
+    with _file_lock(path.with_suffix(".lock")):
+        # Another process may have built the style while we waited for the lock
+        if path.exists():
+            return path.read_text()
+        xml = compile_carto(mml, workdir=cache_dir)
+        with NamedTemporaryFile("w", dir=cache_dir, delete=False) as f:
+            f.write(xml)
+        os.replace(f.name, path)
+    return xml
+
+
+def build_mapnik_styles(scales, db_url=None, cache_dir: Path = None) -> dict[str, str]:
+    """Make mapnik xml for several scales, compiling in parallel."""
+    scales = list(scales)
+    with ThreadPoolExecutor(max_workers=len(scales) or 1) as executor:
+        styles = executor.map(lambda s: make_mapnik_xml(s, db_url, cache_dir), scales)
+        return dict(zip(scales, styles))
 
 
 def get_credentials(db_url=None):
@@ -0,0 +1,120 @@
+"""
+Mapnik rendering, which runs in the worker processes of a `RenderPool`.
+"""
+
+from collections import defaultdict
+from contextlib import contextmanager
+from queue import Empty, SimpleQueue
+
+from mapnik import Box2d, Image, Map, load_map_from_string, render
+from morecantile import Tile, tms
+
+from .config import scale_for_zoom, scales, tile_size
+
+
+class MapPool:
+    """Parsed Mapnik maps for each scale, reused across renders.
+
+    Parsing a style and connecting its PostGIS datasources is expensive, so maps are
+    checked out for a render and returned afterwards, rather than being rebuilt for
+    each tile. Each render positions the map with `zoom_to_box`. Maps are kept
+    separately for each image size, so single tiles and metatiles don't resize a
+    shared map.
+    """
+
+    def __init__(self, styles: dict[str, str]):
+        self.styles = styles
+        self._maps: dict[tuple[str, int], SimpleQueue] = defaultdict(SimpleQueue)
+        self.maps_created = 0
+
+    def _create(self, scale: str, size: int) -> Map:
+        map = Map(size, size)
+        load_map_from_string(map, self.styles[scale])
+        self.maps_created += 1
+        return map
+
+    def preload(self, size: int = tile_size):
+        """Create a map for each scale ahead of the first render."""
+        for scale in self.styles:
+            self._maps[(scale, size)].put(self._create(scale, size))
+
+    @contextmanager
+    def checkout(self, scale: str, size: int = tile_size):
+        key = (scale, size)
+        try:
+            map = self._maps[key].get_nowait()
+        except Empty:
+            map = self._create(scale, size)
+        try:
+            yield map
+        finally:
+            self._maps[key].put(map)
+
+
+# Set when a worker process starts
+_maps: MapPool = None
+
+
+def init_worker(layer_cache: dict[str, str], metatile_size: int = 1):
+    global _maps
+    _maps = MapPool({k: v for k, v in layer_cache.items() if k in scales})
+    _maps.preload(tile_size * metatile_size)
+
+
+# Mapnik image encodings for each output format
+_formats = {"png": "png", "webp": "webp", "jpg": "jpeg85"}
+
+
+def render_tile(
+    z: int, x: int, y: int, scale_factor: int = 1, format: str = "png"
+) -> bytes:
+    tile = Tile(x, y, z)
+    quad = tms.get("WebMercatorQuad")
+    bbox = quad.xy_bounds(tile)
+
+    # Get map scale for this zoom level
+    scale = scale_for_zoom(tile.z)
+
+    size = tile_size * scale_factor
+    with _maps.checkout(scale, size) as map:
+        # Set bbox of map
+        box = Box2d(bbox.left, bbox.top, bbox.right, bbox.bottom)
+        map.zoom_to_box(box)
+
+        # Render map to image, scaling line widths for high-DPI tiles
+        im = Image(size, size)
+        render(map, im, scale_factor)
+    # Return image as binary
+    return im.tostring(_formats[format])
+
+
+def render_metatile(
+    z: int, mx: int, my: int, n: int, scale_factor: int = 1, format: str = "png"
+) -> dict[tuple[int, int], bytes]:
+    """Render an n×n block of tiles in a single pass, starting at tile (mx, my).
+
+    Returns image data for each tile, keyed by (x, y).
+    """
+    quad = tms.get("WebMercatorQuad")
+    top_left = quad.xy_bounds(Tile(mx, my, z))
+    bottom_right = quad.xy_bounds(Tile(mx + n - 1, my + n - 1, z))
+
+    scale = scale_for_zoom(z)
+    px = tile_size * scale_factor
+    size = px * n
+
+    with _maps.checkout(scale, size) as map:
+        box = Box2d(
+            top_left.left, top_left.top, bottom_right.right, bottom_right.bottom
+        )
+        map.zoom_to_box(box)
+
+        im = Image(size, size)
+        render(map, im, scale_factor)
+
+    # Slice the metatile into individual tiles
+    return {
+        (mx + i, my + j): im.view(i * px, j * px, px, px).tostring(_formats[format])
+        for i in range(n)
+        for j in range(n)
+    }
@@ -0,0 +1,167 @@
+"""
+A pool of worker processes for CPU-bound tile rendering, so that renders don't block
+the event loop.
+"""
+
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from time import perf_counter
+from typing import Any, Callable, Optional
+
+from macrostrat.utils import get_logger
+from macrostrat.utils.timer import Timer
+
+log = get_logger(__name__)
+
+
+class RenderPoolFull(Exception):
+    """Too many renders are already waiting for a worker."""
+
+
+def _timed(func: Callable, *args) -> tuple[Any, float]:
+    start = perf_counter()
+    res = func(*args)
+    return res, perf_counter() - start
+
+
+def _ready():
+    return True
+
+
+class RenderPool:
+    """Dispatch renders to a fixed set of warm worker processes.
+
+    At most `max_queue_size` renders wait for a free worker; beyond that, renders are
+    rejected so that the server sheds load instead of building an unbounded backlog.
+
+    Renders that time out before they start are cancelled. A render that has already
+    started can't be interrupted, so it keeps its worker busy until it finishes; these
+    are counted as `abandoned` in `stats()`, and still count towards the queue limit.
+    """
+
+    def __init__(self, processes: int = 2, max_queue_size: int = 16, timeout=30.0):
+        self.configure(
+            processes=processes, max_queue_size=max_queue_size, timeout=timeout
+        )
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._pending = 0
+        self.renders = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.abandoned = 0
+        self._abandoned_running = 0
+        self.total_queue_time = 0.0
+        self.total_render_time = 0.0
+
+    def configure(
+        self, *, processes: int = 2, max_queue_size: int = 16, timeout: float = 30.0
+    ):
+        self.processes = processes
+        self.max_queue_size = max_queue_size
+        self.timeout = timeout
+
+    async def start(self, initializer: Callable = None, initargs: tuple = ()):
+        """Start the worker processes, and wait until they are ready."""
+        if self._executor is not None:
+            return
+        # Workers are spawned rather than forked, so that they don't inherit the
+        # event loop or database connections.
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.processes,
+            mp_context=get_context("spawn"),
+            initializer=initializer,
+            initargs=initargs,
+        )
+        # Processes are spawned on demand, so submit a task for each one
+        await asyncio.gather(
+            *(
+                asyncio.wrap_future(self._executor.submit(_ready))
+                for _ in range(self.processes)
+            )
+        )
+
+    def close(self):
+        if self._executor is None:
+            return
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = None
+
+    def _release(self):
+        self._pending -= 1
+
+    def _release_abandoned(self):
+        self._abandoned_running -= 1
+
+    def _on_done(self, loop: asyncio.AbstractEventLoop, release: Callable):
+        # Called from the executor's management thread
+        if not loop.is_closed():
+            loop.call_soon_threadsafe(release)
+
+    async def run(self, func: Callable, *args, timer: Timer = None) -> Any:
+        """Run a function in a worker process.
+
+        If a timer is given, time spent waiting for a worker and time spent rendering
+        are recorded as separate steps.
+        """
+        if self._pending >= self.processes + self.max_queue_size:
+            self.rejected += 1
+            raise RenderPoolFull()
+
+        loop = asyncio.get_running_loop()
+        self._pending += 1
+        start = perf_counter()
+        future = self._executor.submit(_timed, func, *args)
+        future.add_done_callback(lambda _: self._on_done(loop, self._release))
+        try:
+            # Renders that haven't started yet are cancelled on timeout
+            res, render_time = await asyncio.wait_for(
+                asyncio.wrap_future(future), self.timeout
+            )
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            if not future.cancelled():
+                # The render had started, so its worker stays busy until it finishes
+                self.abandoned += 1
+                self._abandoned_running += 1
+                future.add_done_callback(
+                    lambda _: self._on_done(loop, self._release_abandoned)
+                )
+                log.warning(
+                    "Render timed out after %s s; its worker is still busy",
+                    self.timeout,
+                )
+            raise
+
+        queue_time = max(perf_counter() - start - render_time, 0)
+        self.renders += 1
+        self.total_queue_time += queue_time
+        self.total_render_time += render_time
+        if timer is not None:
+            _add_render_steps(timer, render_time)
+        return res
+
+    def stats(self) -> dict[str, Any]:
+        n = max(self.renders, 1)
+        return {
+            "processes": self.processes,
+            "in_progress": self._pending,
+            "max_queue_size": self.max_queue_size,
+            "renders": self.renders,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+            "abandoned": self.abandoned,
+            "abandoned_running": self._abandoned_running,
+            "mean_queue_ms": round(self.total_queue_time / n * 1000, 1),
+            "mean_render_ms": round(self.total_render_time / n * 1000, 1),
+        }
+
+
+def _add_render_steps(timer: Timer, render_time: float):
+    """Split the time since the timer's last step into time spent waiting for a
+    worker (including transfer of the result) and time spent rendering."""
+    step = timer._add_step("render_queue")
+    step.delta = max(step.delta - render_time, 0)
+    step.time -= render_time
+    step.total -= render_time
+    timer._add_step("render")
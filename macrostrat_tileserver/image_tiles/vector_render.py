@@ -0,0 +1,359 @@
+"""
+Rasterize `carto` vector tiles using the CartoCSS rules in `style.mss`, so that image
+tiles can be drawn from cached vector tiles instead of querying PostGIS through Mapnik.
+
+Only the parts of CartoCSS used by our stylesheet are supported: layer classes,
+attachments, zoom and attribute filters, and polygon and line symbolizers.
+"""
+
+import re
+from io import BytesIO
+from math import hypot
+from pathlib import Path
+from typing import Any, NamedTuple, Optional
+
+from mapbox_vector_tile import decode
+
+from .config import tile_size
+
+try:
+    from PIL import Image, ImageColor, ImageDraw
+except ImportError:
+    Image = None
+
+__here__ = Path(__file__).parent
+
+_comments = re.compile(r"/\*.*?\*/", re.S)
+_layer_class = re.compile(r"\.([\w-]+)")
+_attachment = re.compile(r"::([\w-]+)")
+_filter = re.compile(r'\[\s*([\w-]+)\s*(<=|>=|!=|=|<|>)\s*("[^"]*"|[^\]\s]+)\s*\]')
+_field = re.compile(r"^\[([\w-]+)\]$")
+
+
+class Selector(NamedTuple):
+    layer_class: Optional[str] = None
+    attachment: Optional[str] = None
+    filters: tuple = ()
+
+    def combine(self, child: "Selector") -> "Selector":
+        return Selector(
+            child.layer_class or self.layer_class,
+            child.attachment or self.attachment,
+            self.filters + child.filters,
+        )
+
+
+class Rule(NamedTuple):
+    selector: Selector
+    declarations: dict[str, str]
+    index: int
+
+
+def _parse_value(value: str) -> Any:
+    if value.startswith('"'):
+        return value[1:-1]
+    if value == "null":
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def parse_selector(text: str) -> Selector:
+    filters = tuple(
+        (key, op, _parse_value(value)) for key, op, value in _filter.findall(text)
+    )
+    # Remove filters before looking for classes, since values may contain dots
+    text = _filter.sub("", text)
+    layer_class = _layer_class.search(text)
+    attachment = _attachment.search(text)
+    return Selector(
+        layer_class.group(1) if layer_class else None,
+        attachment.group(1) if attachment else None,
+        filters,
+    )
+
+
+def parse_carto(source: str) -> list[Rule]:
+    """Flatten a CartoCSS stylesheet into a list of rules."""
+    source = _comments.sub("", source)
+    rules = []
+    _parse_block(source, 0, [Selector()], rules)
+    return rules
+
+
+def _parse_block(source: str, pos: int, selectors: list, rules: list) -> int:
+    declarations = {}
+    rules.extend(Rule(s, declarations, len(rules)) for s in selectors)
+    buf = ""
+    while pos < len(source):
+        c = source[pos]
+        pos += 1
+        if c == "{":
+            parts = [parse_selector(s) for s in buf.split(",") if s.strip()]
+            children = [s.combine(p) for s in selectors for p in parts] or selectors
+            pos = _parse_block(source, pos, children, rules)
+            buf = ""
+        elif c in ";}":
+            key, sep, value = buf.partition(":")
+            if sep and key.strip():
+                declarations[key.strip()] = value.strip()
+            buf = ""
+            if c == "}":
+                return pos
+        else:
+            buf += c
+    return pos
+
+
+def _matches(value: Any, op: str, expected: Any) -> bool:
+    if isinstance(expected, float):
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return op == "!="
+    if op == "=":
+        return value == expected
+    if op == "!=":
+        return value != expected
+    if value is None or expected is None:
+        return False
+    if op == "<":
+        return value < expected
+    if op == "<=":
+        return value <= expected
+    if op == ">":
+        return value > expected
+    return value >= expected
+
+
+class CartoStyle:
+    """Resolved symbolizer properties for features, following CartoCSS precedence:
+    more specific rules win, and later rules win among equally specific ones."""
+
+    def __init__(self, source: str):
+        rules = [r for r in parse_carto(source) if r.declarations]
+        self.rules = sorted(
+            rules,
+            key=lambda r: (
+                r.selector.layer_class is not None,
+                len(r.selector.filters),
+                r.index,
+            ),
+        )
+        # Attachments are drawn in the order they first appear
+        self.attachments = [None]
+        for rule in rules:
+            if rule.selector.attachment not in self.attachments:
+                self.attachments.append(rule.selector.attachment)
+        self.fields = sorted(
+            {k for r in rules for k, _, _ in r.selector.filters if k != "zoom"}
+        )
+        self._cache = {}
+
+    @classmethod
+    def from_file(cls, path: Path = __here__ / "style.mss") -> "CartoStyle":
+        return cls(Path(path).read_text())
+
+    def properties(
+        self, layer_class: str, attachment: Optional[str], zoom: int, props: dict
+    ) -> dict[str, str]:
+        key = (layer_class, attachment, zoom, *(props.get(f) for f in self.fields))
+        res = self._cache.get(key)
+        if res is not None:
+            return res
+        res = {}
+        values = {**props, "zoom": zoom}
+        for rule in self.rules:
+            s = rule.selector
+            if s.layer_class not in (None, layer_class) or s.attachment != attachment:
+                continue
+            if all(_matches(values.get(k), op, v) for k, op, v in s.filters):
+                res.update(rule.declarations)
+        self._cache[key] = res
+        return res
+
+
+def _resolve(value: str, props: dict) -> Any:
+    field = _field.match(value)
+    if field is not None:
+        return props.get(field.group(1))
+    return value
+
+
+def _color(value: Any, opacity: float = 1) -> Optional[tuple]:
+    try:
+        r, g, b, *a = ImageColor.getrgb(str(value))
+    except ValueError:
+        return None
+    alpha = a[0] if a else 255
+    return (r, g, b, round(alpha * opacity))
+
+
+def _dashes(coords: list, pattern: list[float]):
+    """Split a line into the segments that are drawn with a dash pattern."""
+    if sum(pattern) <= 0:
+        yield coords
+        return
+    i = 0
+    remaining = pattern[0]
+    on = True
+    current = [coords[0]]
+    for (x0, y0), (x1, y1) in zip(coords, coords[1:]):
+        length = hypot(x1 - x0, y1 - y0)
+        pos = 0
+        while length - pos > remaining:
+            pos += remaining
+            t = pos / length
+            point = (x0 + (x1 - x0) * t, y0 + (y1 - y0) * t)
+            if on:
+                current.append(point)
+                yield current
+            current = [point]
+            on = not on
+            i = (i + 1) % len(pattern)
+            remaining = pattern[i]
+        remaining -= length - pos
+        if on:
+            current.append((x1, y1))
+    if on and len(current) > 1:
+        yield current
+
+
+def _rings(geometry: dict) -> list[list]:
+    if geometry["type"] == "Polygon":
+        return [geometry["coordinates"]]
+    if geometry["type"] == "MultiPolygon":
+        return geometry["coordinates"]
+    return []
+
+
+def _lines(geometry: dict) -> list[list]:
+    kind = geometry["type"]
+    if kind == "LineString":
+        return [geometry["coordinates"]]
+    if kind == "MultiLineString":
+        return geometry["coordinates"]
+    # Polygon outlines
+    return [ring for polygon in _rings(geometry) for ring in polygon]
+
+
+def _fill_polygon(im, draw, polygon: list, color: tuple):
+    exterior = polygon[0]
+    if len(polygon) == 1 and color[3] == 255:
+        draw.polygon(exterior, fill=color)
+        return
+    # Draw through a mask to cut out holes and blend transparent fills
+    xs = [p[0] for p in exterior]
+    ys = [p[1] for p in exterior]
+    x0, y0 = max(int(min(xs)), 0), max(int(min(ys)), 0)
+    x1, y1 = min(int(max(xs)) + 1, im.width), min(int(max(ys)) + 1, im.height)
+    if x1 <= x0 or y1 <= y0:
+        return
+    mask = Image.new("L", (x1 - x0, y1 - y0), 0)
+    mask_draw = ImageDraw.Draw(mask)
+    for i, ring in enumerate(polygon):
+        ring = [(x - x0, y - y0) for x, y in ring]
+        mask_draw.polygon(ring, fill=color[3] if i == 0 else 0)
+    im.paste(color[:3] + (255,), (x0, y0, x1, y1), mask)
+
+
+def _draw_feature(
+    im, draw, geometry: dict, props: dict, symbolizer: dict, k: float, scale: float
+):
+    fill = symbolizer.get("polygon-fill")
+    if fill is not None:
+        opacity = float(symbolizer.get("polygon-opacity", 1))
+        color = _color(_resolve(fill, props), opacity)
+        if color is not None and color[3] > 0:
+            for polygon in _rings(geometry):
+                polygon = [[(x * k, y * k) for x, y in ring] for ring in polygon]
+                _fill_polygon(im, draw, polygon, color)
+
+    if not any(key.startswith("line-") for key in symbolizer):
+        return
+    # Line widths are in pixels at standard resolution
+    width = float(symbolizer.get("line-width", 1)) * scale
+    opacity = float(symbolizer.get("line-opacity", 1))
+    color = _color(_resolve(symbolizer.get("line-color", "#000000"), props), opacity)
+    if width <= 0 or color is None or color[3] == 0:
+        return
+    dasharray = symbolizer.get("line-dasharray")
+    joint = "curve" if symbolizer.get("line-join") == "round" else None
+    for line in _lines(geometry):
+        line = [(x * k, y * k) for x, y in line]
+        if len(line) < 2:
+            continue
+        segments = [line]
+        if dasharray is not None:
+            pattern = [float(v) * scale for v in dasharray.split(",")]
+            segments = _dashes(line, pattern)
+        for segment in segments:
+            draw.line(segment, fill=color, width=max(round(width), 1), joint=joint)
+
+
+def rasterize_tile(
+    data: bytes,
+    z: int,
+    style: CartoStyle,
+    size: int = tile_size,
+    scale_factor: int = 1,
+    format: str = "png",
+    supersample: int = 2,
+    layers=("units", "lines"),
+) -> bytes:
+    """Draw a vector tile as an image. Tiles are drawn at a multiple of the output
+    size and downsampled, since Pillow doesn't antialias shapes."""
+    size *= scale_factor
+    px = size * supersample
+    im = Image.new("RGBA", (px, px), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(im)
+
+    decoded = decode(data, default_options={"y_coord_down": True}) if data else {}
+    for layer_class in layers:
+        layer = decoded.get(layer_class)
+        if layer is None:
+            continue
+        k = px / layer["extent"]
+        for attachment in style.attachments:
+            for feature in layer["features"]:
+                props = feature["properties"]
+                symbolizer = style.properties(layer_class, attachment, z, props)
+                if symbolizer:
+                    _draw_feature(
+                        im,
+                        draw,
+                        feature["geometry"],
+                        props,
+                        symbolizer,
+                        k,
+                        scale_factor * supersample,
+                    )
+
+    if supersample > 1:
+        im = im.resize((size, size), Image.LANCZOS)
+    buf = BytesIO()
+    if format == "jpg":
+        # JPEG has no transparency, so flatten onto white
+        background = Image.new("RGB", im.size, (255, 255, 255))
+        background.paste(im, mask=im)
+        background.save(buf, "JPEG", quality=85)
+    else:
+        im.save(buf, format.upper())
+    return buf.getvalue()
+
+
+# Set when a worker process starts
+_style: CartoStyle = None
+
+
+def init_vector_worker(style_source: str):
+    global _style
+    _style = CartoStyle(style_source)
+
+
+def render_vector_tile(
+    data: bytes, z: int, scale_factor: int = 1, format: str = "png"
+) -> bytes:
+    return rasterize_tile(data, z, _style, scale_factor=scale_factor, format=format)
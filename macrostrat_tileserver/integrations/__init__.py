@@ -1,9 +1,12 @@
 from pathlib import Path
-from buildpg import render
 from fastapi import APIRouter, Request, Response
 from timvt.resources.enums import MimeTypes
 from macrostrat.utils import get_logger
 
+from ..utils.admission import admission
+from ..utils.statements import compile_statement, statements
+from ..utils.timeouts import query_timeouts, until_disconnected
+
 router = APIRouter()
 
 __here__ = Path(__file__).parent
@@ -21,26 +24,34 @@ async def integrations_tile(
     y: int,
 ):
     """Get a tile from the tileserver."""
-    pool = request.app.state.pool
-    async with pool.acquire() as con:
-        data = await run_layer_query(
-            con,
-            "integrations",
-            organization=organization,
-            type=type,
-            z=z,
-            x=x,
-            y=y,
-        )
+    pool = request.app.state.read_pool
+
+    async def query():
+        async with pool.acquire() as con:
+            return await run_layer_query(
+                con,
+                "integrations",
+                organization=organization,
+                type=type,
+                z=z,
+                x=x,
+                y=y,
+                timeout=query_timeouts.timeout_for("integrations", z),
+            )
+
+    async with admission.render("integrations"):
+        data = await until_disconnected(request, query())
     kwargs = {}
     kwargs.setdefault("media_type", MimeTypes.pbf.value)
     return Response(data, **kwargs)
 
 
 async def run_layer_query(con, layer_name, **params):
-    query = get_layer_sql(layer_name)
-    q, p = render(query, layer_name="default", **params)
-    return await con.fetchval(q, *p)
+    statement = statements.get(
+        ("integrations", layer_name),
+        lambda: compile_statement(get_layer_sql(layer_name)),
+    )
+    return await statements.fetchval(con, statement, layer_name="default", **params)
 
 
 def get_layer_sql(layer: str, layer_name="default"):
@@ -0,0 +1,230 @@
+"""
+Targeted invalidation of cached tiles when a map source changes.
+
+Only cached tiles that intersect the source's footprint (`maps.sources.rgeom`) are
+removed, rather than the whole cache. Invalidation can be requested from the CLI,
+over HTTP, or from the database, e.g. after re-ingesting a source:
+
+    SELECT tile_cache.invalidate_source(123);
+
+Triggers on `maps.sources` request invalidation when a source's footprint changes,
+recording the previous footprint so that tiles outside a shrunken footprint are
+removed as well. Requests are announced on the `tile_cache_invalidation` channel.
+Every tileserver worker listens on it, but only the worker that claims a request
+deletes its tiles; it then announces the deletion so that each worker purges its
+in-memory cache. Messages with an `ingestion_slug` instead signal that the tables of
+a map being ingested have changed.
+"""
+
+import asyncio
+from json import dumps, loads
+from typing import Any, Callable, Optional
+
+import asyncpg
+import morecantile
+from buildpg import render
+from fastapi import APIRouter, Header, HTTPException, Request
+from macrostrat.utils import get_logger
+
+from .cache import tile_memory_cache
+from .utils import prepared_statement
+
+log = get_logger(__name__)
+
+router = APIRouter()
+
+invalidation_channel = "tile_cache_invalidation"
+
+# Profiles whose tiles aren't in modern geographic coordinates, so that a source's
+# footprint can't be used to find them.
+unprojected_profiles = {"carto-slim-rotated"}
+
+
+def tile_ranges(bounds, minzoom: int, maxzoom: int):
+    """Get the range of tile indices covering a bounding box at each zoom level."""
+    tms = morecantile.tms.get("WebMercatorQuad")
+    west, south, east, north = bounds
+    for z in range(minzoom, maxzoom + 1):
+        ul = tms.tile(west, north, z, truncate=True)
+        lr = tms.tile(east, south, z, truncate=True)
+        yield z, ul.x, lr.x, ul.y, lr.y
+
+
+async def get_source_bounds(conn, source_id: int) -> Optional[tuple]:
+    """Get the bounding box of a map source's footprint, in geographic coordinates."""
+    q, p = render(
+        """
+        SELECT ST_XMin(rgeom), ST_YMin(rgeom), ST_XMax(rgeom), ST_YMax(rgeom)
+        FROM maps.sources
+        WHERE source_id = :source_id
+          AND rgeom IS NOT NULL
+        """,
+        source_id=source_id,
+    )
+    bounds = await conn.fetchrow(q, *p)
+    if bounds is None:
+        return None
+    return tuple(bounds)
+
+
+async def get_source_footprint(conn, source_id: int):
+    """Get the bounding box of a map source's current footprint together with the
+    footprint of a pending invalidation request, and the time of that request."""
+    q, p = render(prepared_statement("get-source-footprint"), source_id=source_id)
+    row = await conn.fetchrow(q, *p)
+    bounds = (row["west"], row["south"], row["east"], row["north"])
+    if row["west"] is None:
+        bounds = None
+    return bounds, row["requested"]
+
+
+def get_tile_ranges(bounds, profiles: list[dict]):
+    if bounds is None or len(profiles) == 0:
+        return []
+    minzoom = min(p["minzoom"] for p in profiles)
+    maxzoom = max(p["maxzoom"] for p in profiles)
+    return list(tile_ranges(bounds, minzoom, maxzoom))
+
+
+async def get_cached_profiles(conn) -> list[dict]:
+    rows = await conn.fetch("SELECT id, name, minzoom, maxzoom FROM tile_cache.profile")
+    return [dict(r) for r in rows if r["name"] not in unprojected_profiles]
+
+
+async def invalidate_source_tiles(
+    conn, source_id: int, *, claim: bool = False
+) -> Optional[int]:
+    """Delete cached tiles that intersect a source's footprint, or the footprint it
+    had before a pending invalidation request. Returns the number of tiles deleted.
+
+    With `claim`, tiles are only deleted if this connection claims the pending
+    request, so that a request is handled by a single worker; `None` is returned
+    if it was claimed elsewhere. Workers are notified of the deletion so that they
+    purge their in-memory caches.
+    """
+    profiles = await get_cached_profiles(conn)
+    bounds, requested = await get_source_footprint(conn, source_id)
+    if claim and requested is None:
+        return None
+    ranges = get_tile_ranges(bounds, profiles)
+    # A request is claimed even if the source has no footprint left
+    z, xmin, xmax, ymin, ymax = map(list, zip(*ranges)) if ranges else ([],) * 5
+    q, p = render(
+        prepared_statement("invalidate-source-tiles"),
+        source_id=source_id,
+        requested=requested,
+        claim=claim,
+        profiles=[p["id"] for p in profiles],
+        z=z,
+        xmin=xmin,
+        xmax=xmax,
+        ymin=ymin,
+        ymax=ymax,
+    )
+    async with conn.transaction():
+        claimed, n_deleted = await conn.fetchrow(q, *p)
+        if claim and not claimed:
+            return None
+        # Delivered once the deletion is committed
+        await notify_tiles_deleted(conn, source_id, bounds)
+
+    log.info("Invalidated %s cached tiles for source %s", n_deleted, source_id)
+    return n_deleted
+
+
+def purge_memory_cache(ranges, profiles: list[int]):
+    """Remove tiles within the given ranges from this worker's in-memory cache."""
+    if not ranges:
+        return
+    ranges = {z: (xmin, xmax, ymin, ymax) for z, xmin, xmax, ymin, ymax in ranges}
+    profiles = set(profiles)
+
+    def _matches(key):
+        profile, z, x, y = key[:4]
+        if profile not in profiles or z not in ranges:
+            return False
+        xmin, xmax, ymin, ymax = ranges[z]
+        return xmin <= x <= xmax and ymin <= y <= ymax
+
+    tile_memory_cache.delete_where(_matches)
+
+
+async def notify_tiles_deleted(conn, source_id: int, bounds: Optional[tuple]):
+    """Tell every tileserver worker that a source's cached tiles within the given
+    bounds were deleted, so that they can be purged from in-memory caches."""
+    payload = dumps(
+        {
+            "source_id": source_id,
+            "deleted": True,
+            "bounds": list(bounds) if bounds is not None else None,
+        }
+    )
+    await conn.execute("SELECT pg_notify($1, $2)", invalidation_channel, payload)
+
+
+class InvalidationListener:
+    """Listen for source changes on a dedicated database connection."""
+
+    def __init__(self, on_ingestion_change: Callable[[str], Any] = None):
+        self._on_ingestion_change = on_ingestion_change
+        self._conn: Optional[asyncpg.Connection] = None
+        self._pool = None
+        self._tasks: set[asyncio.Task] = set()
+
+    async def start(self, database_url: str, pool):
+        self._pool = pool
+        self._conn = await asyncpg.connect(database_url)
+        await self._conn.add_listener(invalidation_channel, self._on_notification)
+
+    async def close(self):
+        if self._conn is None:
+            return
+        await self._conn.remove_listener(invalidation_channel, self._on_notification)
+        await self._conn.close()
+        self._conn = None
+
+    def _on_notification(self, conn, pid, channel, payload):
+        try:
+            message = loads(payload)
+            if "ingestion_slug" in message:
+                if self._on_ingestion_change is not None:
+                    self._on_ingestion_change(str(message["ingestion_slug"]))
+                return
+            source_id = int(message["source_id"])
+        except (ValueError, KeyError, TypeError):
+            log.warning("Invalid tile cache invalidation message: %s", payload)
+            return
+        task = asyncio.ensure_future(self._invalidate(source_id, message))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _invalidate(self, source_id: int, message: dict):
+        async with self._pool.acquire() as conn:
+            if not message.get("deleted", False):
+                # Only the worker that claims the request deletes the tiles, and
+                # then notifies the others
+                await invalidate_source_tiles(conn, source_id, claim=True)
+                return
+            profiles = await get_cached_profiles(conn)
+            bounds = message.get("bounds")
+            if bounds is None:
+                bounds, _ = await get_source_footprint(conn, source_id)
+        purge_memory_cache(
+            get_tile_ranges(bounds, profiles), [p["id"] for p in profiles]
+        )
+
+
+@router.post("/invalidate/source/{source_id}", include_in_schema=False)
+async def invalidate_source(
+    request: Request,
+    source_id: int,
+    authorization: Optional[str] = Header(None),
+):
+    """Remove cached tiles for a map source that has changed."""
+    token = request.app.state.admin_token
+    if token is None or authorization != f"Bearer {token}":
+        raise HTTPException(status_code=403, detail="Not authorized")
+
+    async with request.app.state.pool.acquire() as conn:
+        n_deleted = await invalidate_source_tiles(conn, source_id)
+    return {"source_id": source_id, "tiles_deleted": n_deleted}
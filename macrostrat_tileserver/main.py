@@ -1,5 +1,5 @@
 from os import environ
-from typing import Any, List, Optional
+from typing import Any, List, Optional, Union
 
 from buildpg import render
 from fastapi import FastAPI, Request
@@ -8,7 +8,6 @@ from starlette.middleware.cors import CORSMiddleware
 from starlette.middleware import Middleware
 from starlette.requests import Request
 from starlette.responses import JSONResponse
-from starlette_cramjam.middleware import CompressionMiddleware
 from timvt.db import (
     close_db_connection,
     connect_to_db,
@@ -19,17 +18,40 @@ from titiler.core.errors import DEFAULT_STATUS_CODES, add_exception_handlers
 from titiler.core.factory import TilerFactory
 from pydantic_settings import SettingsConfigDict
 
+from .archives.layer import ArchiveLayer
+from .cache import (
+    tile_access_tracker,
+    tile_cache_evictor,
+    tile_cache_writer,
+    tile_memory_cache,
+)
+from .eviction import EvictionPolicy
 from .cached_tiler import CachedStoredFunction, CachedVectorTilerFactory
 from .function_layer import StoredFunction
-from .image_tiles import MapnikLayerFactory, prepare_image_tile_subsystem
+from .image_tiles import (
+    ImageRenderer,
+    MapnikLayerFactory,
+    image_tile_stats,
+    prepare_image_tile_subsystem,
+    shutdown_image_tile_subsystem,
+)
+from .invalidation import InvalidationListener
+from .invalidation import router as invalidation_router
 from .utils import DecimalJSONResponse
+from .utils.statements import statements
+from .utils.admission import Overloaded, admission
+from .utils.sublayers import sublayer_runner
+from .utils.timeouts import ClientDisconnected, QueryTimeout, query_timeouts
+from .utils.compression import CompressionMiddleware
 from .vendor.repeat_every import repeat_every
 from .paleogeography import PaleoGeographyLayer
+from .replicas import replica_pools
 from macrostrat.database import Database
 from pathlib import Path
 from time import time
 
 from .map_ingestion import register_map_ingestion_routes
+from .map_ingestion.metadata import map_metadata
 
 from typing import Any, Optional
 from buildpg import asyncpg
@@ -77,6 +99,68 @@ class TileServerSettings(PostgresSettings):
     # XDD embedding service URL
     xdd_embedding_service_url: Optional[str] = None
     rockd_database_url: Optional[str] = None
+    # In-memory tile cache (per worker). A size of zero disables it.
+    tile_memory_cache_size: int = 0
+    tile_memory_cache_ttl: float = 3600
+    # TTLs for individual cache profiles, e.g. {"carto": 86400}
+    tile_memory_cache_profile_ttl: dict[str, float] = {}
+    # Write-behind batching of cache inserts. A queue size of zero writes each tile directly.
+    tile_cache_write_queue_size: int = 5000
+    tile_cache_write_batch_size: int = 200
+    tile_cache_write_interval: float = 1.0
+    # Access times for cached tiles are accumulated in memory and flushed periodically.
+    # A sample rate below 1 records only a fraction of accesses.
+    tile_access_flush_interval: float = 30
+    tile_access_sample_rate: float = 1.0
+    # Pre-compressed variants stored with cached tiles (any of "br", "zstd", "gzip")
+    tile_cache_encodings: list[str] = []
+    # Total size of cached tiles in bytes (0 enforces only per-profile quotas)
+    tile_cache_max_bytes: int = 20 * 1024**3
+    tile_cache_eviction_policy: EvictionPolicy = EvictionPolicy.LRU
+    tile_cache_eviction_interval: float = 600
+    # Number of tiles deleted at a time, and batches per eviction run
+    tile_cache_eviction_batch_size: int = 1000
+    tile_cache_eviction_max_batches: int = 100
+    # Static layers served from local PMTiles or MBTiles archives, by layer ID
+    tile_archives: dict[str, Path] = {}
+    # Worker processes for Mapnik image tiles. Renders beyond the queue size are
+    # rejected with a 503 response. A render that times out after it has started
+    # keeps its worker busy until it finishes (reported as `abandoned`).
+    image_render_processes: int = 2
+    image_render_queue_size: int = 16
+    image_render_timeout: float = 30
+    # Image tiles are rendered in blocks of N×N tiles (1 renders tiles individually)
+    image_metatile_size: int = 2
+    # Compiled Mapnik styles, shared between server processes
+    image_style_cache_dir: Optional[Path] = None
+    # Draw image tiles with Mapnik, or from cached `carto` vector tiles
+    image_renderer: ImageRenderer = ImageRenderer.MAPNIK
+    # Read replicas of the main database, for tile renders and cache lookups. Replicas
+    # that lag further behind than `db_replica_max_lag` seconds aren't used.
+    database_replica_urls: list[str] = []
+    db_replica_max_lag: float = 30
+    db_replica_check_interval: float = 10
+    # Listen for map source changes and invalidate affected tiles
+    tile_cache_invalidation_listener: bool = True
+    # Bearer token for cache administration endpoints, which are disabled if unset
+    tile_cache_admin_token: Optional[str] = None
+    # Connections used at once to query the sublayers of a multi-layer tile
+    # (1 queries sublayers one after the other on a single connection)
+    tile_sublayer_concurrency: int = 2
+    # Seconds to keep the tables and queries of maps being ingested
+    ingestion_metadata_ttl: float = 300
+    # Time limit for tile queries in seconds (0 disables it), and limits for
+    # individual layers, by minimum zoom level, e.g. {"carto": {"0": 5, "9": 20}}
+    tile_query_timeout: float = 30
+    tile_query_timeouts: dict[str, Union[float, dict[int, float]]] = {}
+    # Admission control: concurrent lookups in the database cache and tile renders
+    # per worker, with tighter render limits for individual layers. Requests beyond the
+    # queue size, or that wait longer than the queue timeout, get a 503 response.
+    tile_cache_lookup_concurrency: int = 8
+    tile_render_concurrency: int = 4
+    tile_layer_render_concurrency: dict[str, int] = {}
+    tile_admission_queue_size: int = 64
+    tile_admission_queue_timeout: float = 5
     model_config = SettingsConfigDict(
         extra="allow",
     )
@@ -86,7 +170,15 @@ db_settings = TileServerSettings()
 db_settings.rockd_database_url
 
 app.state.timvt_function_catalog = FunctionRegistry()
+app.state.tile_cache_encodings = db_settings.tile_cache_encodings
+app.state.admin_token = db_settings.tile_cache_admin_token
 app.state.function_catalog = FunctionRegistry()
+# Routes reads to replicas, or to the primary (`app.state.pool`) if there are none
+app.state.read_pool = replica_pools
+
+invalidation_listener = InvalidationListener(
+    on_ingestion_change=map_metadata.invalidate
+)
 
 
 # Register Start/Stop application event handler to setup/stop the database connection
@@ -97,27 +189,90 @@ async def startup_event():
     setup_stderr_logs("macrostrat_tileserver", "timvt")
     await connect_to_db(app, db_settings)
     await connect_to_rockd_db(app, db_settings)
+    await replica_pools.start(
+        app.state.pool,
+        db_settings.database_replica_urls,
+        max_lag=db_settings.db_replica_max_lag,
+        min_size=db_settings.db_min_conn_size,
+        max_size=db_settings.db_max_conn_size,
+        max_queries=db_settings.db_max_queries,
+        max_inactive_connection_lifetime=db_settings.db_max_inactive_conn_lifetime,
+    )
+
+    tile_memory_cache.configure(
+        max_size=db_settings.tile_memory_cache_size,
+        ttl=db_settings.tile_memory_cache_ttl,
+        profile_ttl=db_settings.tile_memory_cache_profile_ttl,
+    )
+
+    tile_cache_writer.configure(
+        max_queue_size=db_settings.tile_cache_write_queue_size,
+        batch_size=db_settings.tile_cache_write_batch_size,
+        flush_interval=db_settings.tile_cache_write_interval,
+    )
+    tile_cache_writer.start(app.state.pool)
+
+    tile_access_tracker.configure(sample_rate=db_settings.tile_access_sample_rate)
+
+    tile_cache_evictor.configure(
+        max_size=db_settings.tile_cache_max_bytes,
+        policy=db_settings.tile_cache_eviction_policy,
+        batch_size=db_settings.tile_cache_eviction_batch_size,
+        max_batches=db_settings.tile_cache_eviction_max_batches,
+    )
+
+    sublayer_runner.configure(concurrency=db_settings.tile_sublayer_concurrency)
+    map_metadata.configure(ttl=db_settings.ingestion_metadata_ttl)
+    query_timeouts.configure(
+        default=db_settings.tile_query_timeout,
+        layers=db_settings.tile_query_timeouts,
+    )
+    admission.configure(
+        cache_concurrency=db_settings.tile_cache_lookup_concurrency,
+        render_concurrency=db_settings.tile_render_concurrency,
+        layer_concurrency=db_settings.tile_layer_render_concurrency,
+        max_queue_size=db_settings.tile_admission_queue_size,
+        queue_timeout=db_settings.tile_admission_queue_timeout,
+    )
+
+    if db_settings.tile_cache_invalidation_listener:
+        await invalidation_listener.start(str(db_settings.database_url), app.state.pool)
 
     # Apply fixtures
     # apply_fixtures(db_settings.database_url)
     # await register_table_catalog(app, schemas=["sources"])
-    prepare_image_tile_subsystem()
+    await prepare_image_tile_subsystem(
+        processes=db_settings.image_render_processes,
+        max_queue_size=db_settings.image_render_queue_size,
+        timeout=db_settings.image_render_timeout,
+        metatile_size=db_settings.image_metatile_size,
+        style_cache_dir=db_settings.image_style_cache_dir,
+        renderer=db_settings.image_renderer,
+    )
 
 
 @app.on_event("startup")
-@repeat_every(seconds=600)  # 10 minutes
+@repeat_every(seconds=db_settings.tile_cache_eviction_interval)
 async def truncate_tile_cache_if_needed() -> None:
-    """Truncate the tile cache if it's too big."""
+    """Evict tiles if the cache is over its size budget."""
     pool = app.state.pool
-    async with pool.acquire() as conn:
-        max_size = 1e6
+    # Make sure eviction sees up-to-date access times
+    await tile_access_tracker.flush(pool)
+    await tile_cache_evictor.run(pool)
 
-        q, p = render(
-            "SELECT tile_cache.remove_excess_tiles(:max_size)",
-            max_size=max_size,
-        )
 
-        await conn.execute(q, *p)
+@app.on_event("startup")
+@repeat_every(seconds=db_settings.db_replica_check_interval, wait_first=True)
+async def check_replicas() -> None:
+    """Check that read replicas are reachable and up to date."""
+    await replica_pools.check()
+
+
+@app.on_event("startup")
+@repeat_every(seconds=db_settings.tile_access_flush_interval, wait_first=True)
+async def flush_tile_access_times() -> None:
+    """Record when cached tiles were last used."""
+    await tile_access_tracker.flush(app.state.pool)
 
 
 def apply_fixtures(url: str):
@@ -132,6 +287,12 @@ def apply_fixtures(url: str):
 @app.on_event("shutdown")
 async def shutdown_event():
     """Application shutdown: de-register the database connection."""
+    await invalidation_listener.close()
+    shutdown_image_tile_subsystem()
+    # Write any queued tiles before the pool goes away
+    await tile_cache_writer.close()
+    await tile_access_tracker.flush(app.state.pool)
+    await replica_pools.close()
     await close_db_connection(app)
 
 
@@ -147,6 +308,18 @@ cog = TilerFactory()
 
 app.include_router(cog.router, prefix="/cog", tags=["Cloud Optimized GeoTIFF"])
 add_exception_handlers(app, DEFAULT_STATUS_CODES)
+# Timed out tile queries, and tiles abandoned by the client ("client closed request")
+add_exception_handlers(app, {QueryTimeout: 504, ClientDisconnected: 499})
+
+
+@app.exception_handler(Overloaded)
+async def overloaded(request: Request, exc: Overloaded):
+    """Shed load quickly, and ask clients to retry shortly."""
+    return JSONResponse(
+        {"detail": str(exc)},
+        status_code=503,
+        headers={"Retry-After": str(exc.retry_after)},
+    )
 
 
 # Register endpoints.
@@ -160,27 +333,56 @@ mvt_tiler = CachedVectorTilerFactory(
 # Note: these are defined somewhat redundantly.
 # Our eventual goal will be to store these configurations in the database.
 
-cached_functions = [
-    "tile_layers.carto",
-    "tile_layers.carto_slim",
-]
-
-
-functions = [
+# Functions are mapped to the query parameters they accept, which are used to
+# normalize requests. Functions mapped to None receive all query parameters.
+
+cached_functions = {
+    "tile_layers.carto": {},
+    "tile_layers.carto_slim": {},
+}
+
+# Functions for the sublayers of multi-layer tiles, which are queried concurrently
+function_sublayers = {
+    "tile_layers.carto": {
+        "units": "tile_layers.carto_bedrock",
+        "lines": "tile_layers.carto_lines",
+    },
+    "tile_layers.carto_slim": {
+        "units": "tile_layers.carto_slim_bedrock",
+        "lines": "tile_layers.carto_slim_lines",
+    },
+}
+
+
+functions = {
+    "corelle_macrostrat.igcp_orogens": None,
+    "corelle_macrostrat.igcp_orogens_rotated": None,
+    "weaver_api.weaver_tile": None,
+    "tile_layers.map": {"source_id": int},
+    "tile_layers.all_maps": {},
+}
+
+# Functions defined outside of this repository's fixtures, which we can't be sure
+# are read-only. They run in a transaction that is rolled back, on the primary.
+transactional_functions = {
     "corelle_macrostrat.igcp_orogens",
     "corelle_macrostrat.igcp_orogens_rotated",
     "weaver_api.weaver_tile",
-    "tile_layers.map",
-    "tile_layers.all_maps",
-]
-
-layers = [CachedStoredFunction(l) for l in cached_functions] + [
-    StoredFunction(l) for l in functions
+}
+
+layers = [
+    CachedStoredFunction(k, v, sublayers=function_sublayers.get(k))
+    for k, v in cached_functions.items()
+] + [
+    StoredFunction(k, v, transactional=k in transactional_functions)
+    for k, v in functions.items()
 ]
 
 
 layers.append(PaleoGeographyLayer())
 
+layers += [ArchiveLayer.open(k, v) for k, v in db_settings.tile_archives.items()]
+
 for layer in layers:
     app.state.function_catalog.register(layer)
 
@@ -225,6 +427,30 @@ async def index(request: Request):
     return JSONResponse({"message": "Macrostrat Tileserver"})
 
 
+@app.get("/cache/stats", include_in_schema=False)
+async def cache_stats(request: Request):
+    """Tile cache statistics for this worker."""
+    return JSONResponse(
+        {
+            "memory": tile_memory_cache.stats(),
+            "renders": mvt_tiler.renders.stats(),
+            "writer": tile_cache_writer.stats(),
+            "access": tile_access_tracker.stats(),
+            "eviction": tile_cache_evictor.stats(),
+            "image_renders": image_tile_stats(),
+            "statements": statements.stats(),
+            "sublayers": sublayer_runner.stats(),
+            "ingestion_metadata": map_metadata.stats(),
+            "queries": query_timeouts.stats(),
+            "admission": admission.stats(),
+            "replicas": replica_pools.stats(),
+        }
+    )
+
+
+app.include_router(invalidation_router, prefix="/cache")
+
+
 @app.get("/refresh", include_in_schema=False)
 async def refresh(request: Request):
     """Refresh the table catalog."""
@@ -1,9 +1,12 @@
 from pathlib import Path
 
-from buildpg import render
 from fastapi import APIRouter, Request, Response
 from timvt.resources.enums import MimeTypes
 
+from ..utils.admission import admission
+from ..utils.statements import compile_statement, statements
+from ..utils.timeouts import query_timeouts, until_disconnected
+
 router = APIRouter()
 
 __here__ = Path(__file__).parent
@@ -17,7 +20,7 @@ async def rgeom(
     y: int,
 ):
     """Get a tile from the tileserver."""
-    return await get_rgeom(request.app.state.pool, z=z, x=x, y=y)
+    return await get_rgeom(request, z=z, x=x, y=y)
 
 
 @router.get("/bounds/{slug}/{z}/{x}/{y}")
@@ -29,28 +32,35 @@ async def rgeom_slug(
     y: int,
 ):
     """Get a tile from the tileserver."""
-    return await get_rgeom(
-        request.app.state.pool, where="slug = :slug", z=z, x=x, y=y, slug=slug
-    )
+    return await get_rgeom(request, where="slug = :slug", z=z, x=x, y=y, slug=slug)
+
+
+async def get_rgeom(request, *, where="is_finalized = true", **params):
+    pool = request.app.state.read_pool
+    timeout = query_timeouts.timeout_for("map-bounds", params["z"])
 
+    async def query():
+        async with pool.acquire() as con:
+            return await run_layer_query(
+                con, "bounds", where=where, timeout=timeout, **params
+            )
 
-async def get_rgeom(pool, *, where="is_finalized = true", **params):
-    async with pool.acquire() as con:
-        data = await run_layer_query(con, "bounds", where=where, **params)
+    async with admission.render("map-bounds"):
+        data = await until_disconnected(request, query())
     kwargs = {}
     kwargs.setdefault("media_type", MimeTypes.pbf.value)
     return Response(data, **kwargs)
 
 
 async def run_layer_query(con, layer_name, *, where="true", **params):
-    query = get_layer_sql(layer_name, where=where)
-    q, p = render(query, layer_name=layer_name, **params)
-
-    # Overcomes a shortcoming in buildpg that deems casting to an array as unsafe
-    # https://github.com/samuelcolvin/buildpg/blob/e2a16abea5c7607b53c501dbae74a5765ba66e15/buildpg/components.py#L21
-    q = q.replace("textarray", "text[]")
-
-    return await con.fetchval(q, *p)
+    def build():
+        statement = compile_statement(get_layer_sql(layer_name, where=where))
+        # Overcomes a shortcoming in buildpg that deems casting to an array as unsafe
+        # https://github.com/samuelcolvin/buildpg/blob/e2a16abea5c7607b53c501dbae74a5765ba66e15/buildpg/components.py#L21
+        return statement._replace(sql=statement.sql.replace("textarray", "text[]"))
+
+    statement = statements.get(("map_bounds", layer_name, where), build)
+    return await statements.fetchval(con, statement, layer_name=layer_name, **params)
 
 
 def get_layer_sql(layer: str, *, where="true"):
@@ -1,14 +1,23 @@
+from functools import partial
 from pathlib import Path
+from typing import Optional
 
-from buildpg import render, Renderer
-from fastapi import APIRouter, Request, Response
-from timvt.resources.enums import MimeTypes
+from buildpg import render
+from fastapi import APIRouter, HTTPException, Request, Response
 from titiler.core.models.mapbox import TileJSON
-from asyncpg import UndefinedTableError
+from asyncpg import UndefinedColumnError, UndefinedTableError
 from enum import Enum
 from macrostrat.utils import get_logger
+from macrostrat.utils.timer import Timer
 from macrostrat.database.utils import format as format_sql
 
+from ..utils import TileResponse
+from ..utils.admission import admission
+from ..utils.statements import Statement, compile_statement, statements
+from ..utils.sublayers import sublayer_runner
+from ..utils.timeouts import query_timeouts, until_disconnected
+from .metadata import MapMetadata, map_metadata
+
 print_sql_statements = False
 
 router = APIRouter()
@@ -42,24 +51,24 @@ async def tilejson(
 
     tile_endpoint = str(url_path)
 
-    bounds_query = f"""
-    SELECT geom FROM sources.{slug}_polygons
-    UNION
-    SELECT geom FROM sources.{slug}_lines
-    UNION
-    SELECT geom FROM sources.{slug}_points
-    """
-
-    sql = get_bounds(bounds_query, geometry_column="geom")
     pool = request.app.state.pool
-    async with pool.acquire() as con:
-        bounds = await con.fetchval(sql)
+    metadata = await get_map_metadata(pool, slug)
+    if metadata is None:
+        raise HTTPException(status_code=404, detail=f"No tables found for {slug}")
+
+    if metadata.bounds is None:
+        bounds_query = "\nUNION ALL\n".join(
+            f"SELECT geom FROM {table}" for table in metadata.tables.values()
+        )
+        sql = get_bounds(bounds_query, geometry_column="geom")
+        async with pool.acquire() as con:
+            metadata.bounds = await con.fetchval(sql)
 
     return {
         "minzoom": 0,
         "maxzoom": 18,
         "name": slug,
-        "bounds": bounds,
+        "bounds": metadata.bounds,
         "tiles": [tile_endpoint],
     }
 
@@ -72,69 +81,106 @@ async def tile(
     x: int,
     y: int,
 ):
-
-    # if feature_type != FeatureType.polygons:
-    #    return Response(status_code=404, content="Only polygons are supported for now")
-
     """Get a tile from the tileserver."""
     pool = request.app.state.pool
+    timer = Timer()
+
+    timeout = query_timeouts.timeout_for("ingestion", z)
 
-    data = b""
-    success = False
-    for layer in FeatureType:
+    async with admission.render("ingestion"):
         try:
-            data += await get_layer(pool, slug, layer, z=z, x=x, y=y)
-            success = True
-        except UndefinedTableError:
-            pass
-    if not success:
+            data = await until_disconnected(
+                request, get_tile(pool, slug, timer, z=z, x=x, y=y, timeout=timeout)
+            )
+        except (UndefinedTableError, UndefinedColumnError):
+            # The map's tables changed since its metadata was loaded
+            map_metadata.invalidate(slug)
+            data = await until_disconnected(
+                request, get_tile(pool, slug, timer, z=z, x=x, y=y, timeout=timeout)
+            )
+
+    if data is None:
         return Response(status_code=404, content=f"No tables found for {slug}")
+    return TileResponse(data, timer)
+
+
+async def get_tile(pool, slug, timer, **params) -> Optional[bytes]:
+    metadata = await get_map_metadata(pool, slug)
+    timer._add_step("metadata")
+    if metadata is None:
+        return None
+
+    # Feature tables are queried concurrently, on separate connections. Their SQL
+    # is specific to each map, so it isn't kept in the connections' statement caches.
+    return await sublayer_runner.run(
+        pool,
+        {
+            layer_name: partial(
+                statements.fetchval,
+                statement=statement,
+                cache_statement=False,
+                layer_name=layer_name,
+                **params,
+            )
+            for layer_name, statement in metadata.layers.items()
+        },
+        timer=timer,
+    )
+
 
-    kwargs = {}
-    kwargs.setdefault("media_type", MimeTypes.pbf.value)
-    return Response(data, **kwargs)
+async def get_map_metadata(pool, slug) -> Optional[MapMetadata]:
+    return await map_metadata.get(slug, partial(load_map_metadata, pool))
 
 
-async def get_layer(pool, slug, layer: FeatureType, **params):
+async def load_map_metadata(pool, slug) -> Optional[MapMetadata]:
+    """Find the feature tables for a map and compile their tile queries."""
+    tables = {f"{slug}_{layer.value}": layer for layer in FeatureType}
     async with pool.acquire() as con:
-        table_name = f"{slug}_{layer}"
-        alias = "s"
-        column_dict = await get_table_columns(con, table_name, schema="sources")
-        log.debug("Columns: %s", column_dict)
-        columns = [
-            format_column(k, v, cast_empty_strings=True, table_alias=alias)
-            for k, v in column_dict.items()
-            if k != "geom"
+        columns = await get_table_columns(con, list(tables), schema="sources")
+
+    layers = {}
+    table_names = {}
+    for table, layer in tables.items():
+        if table not in columns:
+            continue
+        table_name = f"sources.{_wrap_with_quotes(table)}"
+        log.debug("Columns for %s: %s", table_name, columns[table])
+        layers[layer.value] = layer_statement(table_name, layer, columns[table])
+        table_names[layer.value] = table_name
+
+    if len(layers) == 0:
+        return None
+    return MapMetadata(slug, layers, table_names)
+
+
+def layer_statement(table_name, layer: FeatureType, column_dict) -> Statement:
+    alias = "s"
+    columns = [
+        format_column(k, v, cast_empty_strings=True, table_alias=alias)
+        for k, v in column_dict.items()
+        if k != "geom"
+    ]
+    columns.append("tile_layers.tile_geom(s.geom, :envelope) AS geometry")
+
+    joins = None
+    if layer == FeatureType.polygons:
+        joins = [
+            "LEFT JOIN macrostrat.intervals i0 ON s.b_interval = i0.id",
+            "LEFT JOIN macrostrat.intervals i1 ON s.t_interval = i1.id",
+        ]
+
+        b_age = "i0.age_bottom"
+        t_age = "i1.age_top"
+        # Eventually we will allow b_age and t_age to be set directly
+        # b_age = "coalesce(s.b_age, i0.age_bottom)"
+        # t_age = "coalesce(s.t_age, i1.age_top)"
+        columns += [
+            b_age + "::float AS b_age",
+            t_age + "::float AS t_age",
+            _color_subquery(b_age, t_age, "color"),
         ]
-        columns.append("tile_layers.tile_geom(s.geom, :envelope) AS geometry")
-
-        joins = None
-        if layer == FeatureType.polygons:
-            joins = [
-                "LEFT JOIN macrostrat.intervals i0 ON s.b_interval = i0.id",
-                "LEFT JOIN macrostrat.intervals i1 ON s.t_interval = i1.id",
-            ]
-
-            b_age = "i0.age_bottom"
-            t_age = "i1.age_top"
-            # Eventually we will allow b_age and t_age to be set directly
-            # b_age = "coalesce(s.b_age, i0.age_bottom)"
-            # t_age = "coalesce(s.t_age, i1.age_top)"
-            columns += [
-                b_age + "::float AS b_age",
-                t_age + "::float AS t_age",
-                _color_subquery(b_age, t_age, "color"),
-            ]
-
-        return await run_layer_query(
-            con,
-            f"sources.{table_name}",
-            columns,
-            joins=joins,
-            table_alias=alias,
-            layer_name=f"{layer}",
-            **params,
-        )
+
+    return build_layer_query(table_name, columns, joins=joins, table_alias=alias)
 
 
 string_data_types = [
@@ -166,16 +212,13 @@ def _color_subquery(b_age, t_age, alias):
     ) AS {alias}"""
 
 
-async def run_layer_query(
-    con,
+def build_layer_query(
     table_name,
     columns,
     *,
     joins=None,
-    layer_name="default",
     table_alias=None,
-    **params,
-):
+) -> Statement:
     _cols = ", ".join(columns)
     query = f"SELECT {_cols} FROM {table_name}"
     if table_alias:
@@ -185,18 +228,11 @@ async def run_layer_query(
         query += "\n" + "\n".join(joins)
 
     query = extend_sql(query)
-    params = dict(layer_name=layer_name, **params)
 
     if print_sql_statements:
-        log.debug(
-            "Running query:\n%s\nParameters: %s",
-            format_sql(query, reindent=True),
-            params,
-        )
-
-    q, p = render(query, **params)
+        log.debug("Compiled query:\n%s", format_sql(query, reindent=True))
 
-    return await con.fetchval(q, *p)
+    return compile_statement(query)
 
 
 def _wrap_with_quotes(col):
@@ -221,7 +257,7 @@ def extend_sql(sql):
 
 def get_bounds(base_query, geometry_column="geometry"):
     return f"""WITH b AS (
-        SELECT ST_Union(a.{geometry_column}::box2d)::box2d env
+        SELECT ST_Extent(a.{geometry_column}) env
         FROM ({base_query}) a
     )
     SELECT ARRAY[ST_XMin(env), ST_YMin(env), ST_XMax(env), ST_YMax(env)]
@@ -229,20 +265,23 @@ def get_bounds(base_query, geometry_column="geometry"):
     """
 
 
-async def get_table_columns(con, table, schema="sources"):
+async def get_table_columns(con, tables, schema="sources"):
+    """Get the columns of each table that exists, in order."""
     base_sql = f"""
-    SELECT column_name, data_type
+    SELECT table_name, column_name, data_type
     FROM information_schema.columns
-    WHERE table_name = :table
-    AND table_schema = :schema;
+    WHERE table_name = ANY(:tables)
+    AND table_schema = :schema
+    ORDER BY table_name, ordinal_position;
     """
 
-    q, p = render(base_sql, table=table, schema=schema)
+    q, p = render(base_sql, tables=tables, schema=schema)
     res = await con.fetch(q, *p)
-    if len(res) == 0:
-        raise UndefinedTableError(f"Table {schema}.{table} not found")
 
-    return {i[0]: i[1] for i in res}
+    columns = {}
+    for table, column, data_type in res:
+        columns.setdefault(table, {})[column] = data_type
+    return columns
 
 
 def register_map_ingestion_routes(app):
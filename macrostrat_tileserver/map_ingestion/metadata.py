@@ -0,0 +1,83 @@
+"""
+A per-worker cache of metadata for maps being ingested: which feature tables exist,
+their compiled tile queries, and their bounds. This saves catalog lookups on every
+tile while a map is being reviewed.
+
+Entries expire after a TTL, and can be dropped when a map's tables change, e.g. with
+
+    NOTIFY tile_cache_invalidation, '{"ingestion_slug": "my_map"}';
+"""
+
+from time import monotonic
+from typing import Any, Awaitable, Callable, Optional
+
+from ..utils import SingleFlight
+from ..utils.statements import Statement
+
+
+class MapMetadata:
+    def __init__(self, slug: str, layers: dict[str, Statement], tables: dict[str, str]):
+        self.slug = slug
+        # Tile queries and table names for each feature table that exists, by layer
+        self.layers = layers
+        self.tables = tables
+        # Computed on first use, since only TileJSON requests need them
+        self.bounds: Optional[list[float]] = None
+        self.loaded = monotonic()
+
+
+class MapMetadataCache:
+    """Metadata for each map, loaded on first use.
+
+    Maps without any feature tables are not cached, so that a map appears as soon
+    as it is ingested.
+    """
+
+    def __init__(self, ttl: float = 300):
+        self._maps: dict[str, MapMetadata] = {}
+        self._loading = SingleFlight()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.configure(ttl=ttl)
+
+    def configure(self, *, ttl: float = 300):
+        self.ttl = ttl
+
+    async def get(
+        self, slug: str, load: Callable[[str], Awaitable[Optional[MapMetadata]]]
+    ) -> Optional[MapMetadata]:
+        entry = self._maps.get(slug)
+        if entry is not None and monotonic() - entry.loaded < self.ttl:
+            self.hits += 1
+            return entry
+        self.misses += 1
+        entry, is_leader = await self._loading.run(slug, load, slug)
+        if is_leader:
+            if entry is None:
+                self._maps.pop(slug, None)
+            else:
+                self._maps[slug] = entry
+        return entry
+
+    def invalidate(self, slug: Optional[str] = None):
+        """Forget metadata for a map (or for all maps), e.g. after its schema changes."""
+        if slug is None:
+            self._maps.clear()
+        else:
+            self._maps.pop(slug, None)
+        self.invalidations += 1
+
+    def __contains__(self, slug: str):
+        return slug in self._maps
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "maps": len(self._maps),
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+        }
+
+
+map_metadata = MapMetadataCache()
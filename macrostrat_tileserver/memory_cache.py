@@ -0,0 +1,141 @@
+"""
+An in-process "L1" tile cache that sits in front of the PostgreSQL tile cache.
+Each worker process holds its own instance, so hot tiles can be served without
+touching the database at all.
+"""
+
+from collections import OrderedDict
+from time import monotonic
+from typing import Any, Callable, Hashable, Iterable, Optional
+
+from macrostrat.utils import get_logger
+
+log = get_logger(__name__)
+
+
+class MemoryTileCache:
+    """A least-recently-used tile cache bounded by the total size of stored tiles in bytes.
+
+    The cache is disabled when `max_size` is zero.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 0,
+        ttl: float = 3600,
+        profile_ttl: Optional[dict[str, float]] = None,
+    ):
+        self._tiles: OrderedDict[Hashable, tuple[Any, int, float]] = OrderedDict()
+        self._profile_names: dict[Any, str] = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.configure(max_size=max_size, ttl=ttl, profile_ttl=profile_ttl)
+
+    def configure(
+        self,
+        *,
+        max_size: int = 0,
+        ttl: float = 3600,
+        profile_ttl: Optional[dict[str, float]] = None,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.profile_ttl = profile_ttl or {}
+        self._evict()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def register_profile(self, profile: Any, name: str):
+        """Associate a cache profile identifier (e.g., a database ID) with the
+        profile name used to configure its TTL."""
+        self._profile_names[profile] = name
+
+    def ttl_for(self, profile: Any) -> float:
+        name = self._profile_names.get(profile, profile)
+        return self.profile_ttl.get(name, self.ttl)
+
+    def get(self, key: tuple) -> Any:
+        return self.get_first([key])
+
+    def get_first(self, keys: Iterable[tuple]) -> Any:
+        """Get the value of the first of several keys (e.g., the variants of a tile,
+        in order of preference) that is cached. This counts as a single lookup."""
+        if not self.enabled:
+            return None
+        for key in keys:
+            value = self._lookup(key)
+            if value is not None:
+                self.hits += 1
+                return value
+        self.misses += 1
+        return None
+
+    def _lookup(self, key: tuple) -> Any:
+        entry = self._tiles.get(key)
+        if entry is None:
+            return None
+        value, _, expires = entry
+        if expires < monotonic():
+            self._remove(key)
+            return None
+        self._tiles.move_to_end(key)
+        return value
+
+    def set(self, key: tuple, value: Any, size: Optional[int] = None):
+        """Store a value, which counts against the budget as `size` bytes
+        (by default, its length)."""
+        if not self.enabled or value is None:
+            return
+        if size is None:
+            size = len(value)
+        if size > self.max_size:
+            # Don't let a single huge tile flush the entire cache
+            return
+        profile = key[0]
+        self._remove(key)
+        self._tiles[key] = (value, size, monotonic() + self.ttl_for(profile))
+        self.size += size
+        self._evict()
+
+    def delete(self, key: tuple):
+        self._remove(key)
+
+    def delete_where(self, predicate: Callable[[tuple], bool]) -> int:
+        """Remove all entries whose key matches a predicate."""
+        keys = [k for k in self._tiles if predicate(k)]
+        for key in keys:
+            self._remove(key)
+        return len(keys)
+
+    def clear(self):
+        self._tiles.clear()
+        self.size = 0
+
+    def _remove(self, key: tuple):
+        entry = self._tiles.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def _evict(self):
+        while self._tiles and self.size > self.max_size:
+            _, (_, size, _) = self._tiles.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+
+    def __len__(self):
+        return len(self._tiles)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "max_size": self.max_size,
+            "size": self.size,
+            "tiles": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
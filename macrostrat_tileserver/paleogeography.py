@@ -9,6 +9,7 @@ class PaleoGeographyLayer(CachedStoredFunction):
     def __init__(self):
         super().__init__(
             "corelle_macrostrat.carto_slim_rotated",
+            parameters={"model_id": int, "t_step": int},
         )
 
     async def validate_request(self, pool, tile, tms, **kwargs):
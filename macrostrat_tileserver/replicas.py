@@ -0,0 +1,184 @@
+"""
+Routing of read-only queries (tile renders and tile cache lookups) to read replicas of
+the main database. Cache writes, eviction and other maintenance always use the primary.
+
+Replicas are used round-robin. They are checked periodically, and a replica that can't
+be reached, or whose replay lags too far behind the primary, is skipped until it
+recovers. When no replica is available, reads fall back to the primary.
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+from time import monotonic
+from typing import Any, Optional
+
+import asyncpg
+from buildpg import asyncpg as buildpg_asyncpg
+from macrostrat.utils import get_logger
+
+log = get_logger(__name__)
+
+# Seconds since the last replayed transaction, or zero if the replica has replayed
+# everything it has received (e.g., when the primary is idle)
+replication_lag_query = """
+SELECT CASE
+  WHEN NOT pg_is_in_recovery() THEN 0
+  WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+  ELSE coalesce(extract(epoch FROM now() - pg_last_xact_replay_timestamp()), 0)
+END
+"""
+
+# Errors that mean a replica can't serve reads right now
+connection_errors = (
+    OSError,
+    asyncio.TimeoutError,
+    asyncpg.PostgresConnectionError,
+    asyncpg.InterfaceError,
+    asyncpg.CannotConnectNowError,
+)
+
+
+class Replica:
+    def __init__(self, url: str):
+        self.url = url
+        self.pool: Optional[buildpg_asyncpg.BuildPgPool] = None
+        self.healthy = False
+        self.lag: Optional[float] = None
+        self.error: Optional[str] = None
+        self.checked: Optional[float] = None
+        self.reads = 0
+        self.failures = 0
+
+    @property
+    def name(self) -> str:
+        # Don't expose credentials in logs and stats
+        return self.url.rsplit("@", 1)[-1]
+
+    def mark_failed(self, exc: BaseException):
+        if self.healthy:
+            log.warning("Replica %s is unavailable: %s", self.name, exc)
+        self.healthy = False
+        self.error = str(exc) or type(exc).__name__
+        self.failures += 1
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "healthy": self.healthy,
+            "lag_s": None if self.lag is None else round(self.lag, 1),
+            "error": self.error,
+            "reads": self.reads,
+            "failures": self.failures,
+        }
+
+
+class ReplicaPools:
+    """A pool-like router for read-only queries. `acquire()` checks out a connection
+    from the next healthy replica, or from the primary if there is none."""
+
+    def __init__(self):
+        self.primary = None
+        self.replicas: list[Replica] = []
+        self.max_lag = 30.0
+        self.check_timeout = 5.0
+        self._pool_args = {}
+        self._next = 0
+        self.primary_reads = 0
+        self.fallbacks = 0
+        self.busy_fallbacks = 0
+
+    async def start(
+        self,
+        primary,
+        urls: list[str],
+        *,
+        max_lag: float = 30,
+        check_timeout: float = 5,
+        **pool_args,
+    ):
+        self.primary = primary
+        self.replicas = [Replica(url) for url in urls]
+        self.max_lag = max_lag
+        self.check_timeout = check_timeout
+        self._pool_args = pool_args
+        await self.check()
+
+    async def close(self):
+        await asyncio.gather(
+            *(r.pool.close() for r in self.replicas if r.pool is not None)
+        )
+
+    async def check(self):
+        """Connect to replicas that aren't connected yet, and check replication lag."""
+        await asyncio.gather(*(self._check(r) for r in self.replicas))
+
+    async def _check(self, replica: Replica):
+        replica.checked = monotonic()
+        try:
+            if replica.pool is None:
+                replica.pool = await asyncio.wait_for(
+                    buildpg_asyncpg.create_pool_b(replica.url, **self._pool_args),
+                    self.check_timeout,
+                )
+            async with replica.pool.acquire(timeout=self.check_timeout) as conn:
+                lag = await conn.fetchval(
+                    replication_lag_query, timeout=self.check_timeout
+                )
+        except (*connection_errors, asyncpg.PostgresError) as exc:
+            replica.mark_failed(exc)
+            return
+
+        replica.lag = float(lag)
+        if replica.lag > self.max_lag:
+            replica.mark_failed(RuntimeError(f"Replication lag is {lag:.0f} s"))
+            return
+        if not replica.healthy:
+            log.info("Replica %s is available", replica.name)
+        replica.healthy = True
+        replica.error = None
+
+    def _choose(self) -> Optional[Replica]:
+        n = len(self.replicas)
+        for i in range(n):
+            replica = self.replicas[(self._next + i) % n]
+            if replica.healthy:
+                self._next = (self._next + i + 1) % n
+                return replica
+        return None
+
+    @asynccontextmanager
+    async def acquire(self):
+        replica = self._choose()
+        conn = None
+        if replica is not None:
+            try:
+                conn = await replica.pool.acquire(timeout=self.check_timeout)
+            except asyncio.TimeoutError:
+                # The replica is busy rather than down, so only this read falls back
+                self.fallbacks += 1
+                self.busy_fallbacks += 1
+            except connection_errors as exc:
+                replica.mark_failed(exc)
+                self.fallbacks += 1
+
+        if conn is None:
+            self.primary_reads += 1
+            async with self.primary.acquire() as conn:
+                yield conn
+            return
+
+        replica.reads += 1
+        try:
+            yield conn
+        finally:
+            await replica.pool.release(conn)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "primary_reads": self.primary_reads,
+            "fallbacks": self.fallbacks,
+            "busy_fallbacks": self.busy_fallbacks,
+            "replicas": {r.name: r.stats() for r in self.replicas},
+        }
+
+
+replica_pools = ReplicaPools()
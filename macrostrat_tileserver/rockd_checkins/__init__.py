@@ -1,8 +1,10 @@
 from pathlib import Path
-from buildpg import render
 from fastapi import APIRouter, Request, Response
 from timvt.resources.enums import MimeTypes
 
+from ..utils.statements import compile_statement, statements
+from ..utils.timeouts import query_timeouts, until_disconnected
+
 router = APIRouter()
 
 __here__ = Path(__file__).parent
@@ -17,23 +19,30 @@ async def rgeom(
 ):
     """Get a tile from the tileserver."""
     rockd_pool = request.app.state.rockd_pool
-    async with rockd_pool.acquire() as con:
-        data = await run_layer_query(
-            con,
-            "checkins",
-            z=z,
-            x=x,
-            y=y,
-        )
+
+    async def query():
+        async with rockd_pool.acquire() as con:
+            return await run_layer_query(
+                con,
+                "checkins",
+                z=z,
+                x=x,
+                y=y,
+                timeout=query_timeouts.timeout_for("rockd-checkins", z),
+            )
+
+    data = await until_disconnected(request, query())
     kwargs = {}
     kwargs.setdefault("media_type", MimeTypes.pbf.value)
     return Response(data, **kwargs)
 
 
 async def run_layer_query(con, layer_name, **params):
-    query = get_layer_sql(layer_name)
-    q, p = render(query, layer_name=layer_name, **params)
-    return await con.fetchval(q, *p)
+    statement = statements.get(
+        ("rockd_checkins", layer_name),
+        lambda: compile_statement(get_layer_sql(layer_name)),
+    )
+    return await statements.fetchval(con, statement, layer_name=layer_name, **params)
 
 
 def get_layer_sql(layer: str):
@@ -0,0 +1,176 @@
+"""
+Pre-warm the tile cache by rendering tiles directly through a layer.
+
+Tiles are enumerated in a fixed order, so progress can be recorded as the number of
+tiles that have been completed without gaps. An interrupted seed picks up from its
+checkpoint when it is run again with the same arguments.
+"""
+
+import asyncio
+import json
+from pathlib import Path
+from time import perf_counter
+from typing import Any, AsyncIterator, Iterable, Optional
+
+import morecantile
+from buildpg import asyncpg, render
+from macrostrat.utils import get_logger
+from morecantile import Tile
+
+from .cache import get_cache_profile, set_cached_tile
+from .invalidation import get_source_bounds, tile_ranges
+from .utils import prepared_statement
+
+log = get_logger(__name__)
+
+tms = morecantile.tms.get("WebMercatorQuad")
+
+
+def bbox_tiles(bounds, minzoom: int, maxzoom: int) -> Iterable[Tile]:
+    """Tiles covering a bounding box, in order of zoom level."""
+    for z in range(minzoom, maxzoom + 1):
+        yield from tms.tiles(*bounds, [z], truncate=True)
+
+
+async def source_tiles(
+    pool: asyncpg.BuildPgPool, source_id: int, minzoom: int, maxzoom: int
+) -> AsyncIterator[Tile]:
+    """Tiles that intersect a map source's footprint, in order of zoom level."""
+    async with pool.acquire() as conn:
+        bounds = await get_source_bounds(conn, source_id)
+    if bounds is None:
+        raise ValueError(f"Source {source_id} has no footprint")
+    for z, xmin, xmax, ymin, ymax in tile_ranges(bounds, minzoom, maxzoom):
+        q, p = render(
+            prepared_statement("source-tiles"),
+            source_id=source_id,
+            z=z,
+            xmin=xmin,
+            xmax=xmax,
+            ymin=ymin,
+            ymax=ymax,
+        )
+        # Don't hold a connection that seeding workers could be using
+        async with pool.acquire() as conn:
+            rows = await conn.fetch(q, *p)
+        for row in rows:
+            yield Tile(row["x"], row["y"], z)
+
+
+class SeedCheckpoint:
+    """Seeding progress, stored as a JSON file alongside a description of the job.
+
+    A checkpoint for a different job is ignored.
+    """
+
+    def __init__(self, path: Optional[Path], job: dict[str, Any]):
+        self.path = path
+        self.job = job
+        self.completed = 0
+        # Tiles that are done, but follow one that is still in progress
+        self._done: set[int] = set()
+        if path is not None and path.exists():
+            data = json.loads(path.read_text())
+            if data.get("job") == job:
+                self.completed = data["completed"]
+
+    def mark_done(self, index: int):
+        self._done.add(index)
+        while self.completed in self._done:
+            self._done.remove(self.completed)
+            self.completed += 1
+
+    def save(self):
+        if self.path is None:
+            return
+        tmpfile = self.path.with_suffix(".tmp")
+        tmpfile.write_text(json.dumps({"job": self.job, "completed": self.completed}))
+        tmpfile.replace(self.path)
+
+    def remove(self):
+        if self.path is not None:
+            self.path.unlink(missing_ok=True)
+
+
+async def _enumerate(tiles):
+    i = 0
+    if hasattr(tiles, "__aiter__"):
+        async for tile in tiles:
+            yield i, tile
+            i += 1
+    else:
+        for tile in tiles:
+            yield i, tile
+            i += 1
+
+
+async def seed_tiles(
+    pool: asyncpg.BuildPgPool,
+    layer,
+    tiles: Iterable[Tile] | AsyncIterator[Tile],
+    params: Optional[dict[str, Any]] = None,
+    *,
+    concurrency: int = 10,
+    checkpoint: SeedCheckpoint,
+    encodings: Iterable[str] = (),
+    save_interval: int = 500,
+):
+    """Render tiles with a pool of workers and write them to the cache.
+
+    Returns the number of tiles seeded and the number that failed. Failed tiles
+    hold the checkpoint back, so they are retried when seeding is resumed.
+    """
+    params = layer.normalize_params(params or {})
+    profile = await get_cache_profile(pool, layer.id)
+    if profile is None:
+        raise ValueError(f"Layer {layer.id} does not have a cache profile")
+
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+    n_seeded = 0
+    n_failed = 0
+    start = perf_counter()
+
+    async def worker():
+        nonlocal n_seeded, n_failed
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            index, tile = item
+            try:
+                content = await layer.get_tile(pool, tile, tms, **params)
+                await set_cached_tile(
+                    pool, profile.id, params, tile, content, encodings
+                )
+            except Exception as exc:
+                n_failed += 1
+                log.error("Failed to seed tile %s: %s", tile, exc)
+                continue
+            n_seeded += 1
+            checkpoint.mark_done(index)
+            if n_seeded % save_interval == 0:
+                checkpoint.save()
+                rate = n_seeded / (perf_counter() - start)
+                log.info(
+                    "Seeded %s tiles (z%s, %.1f tiles/s, %s failed)",
+                    n_seeded,
+                    tile.z,
+                    rate,
+                    n_failed,
+                )
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(concurrency)]
+    try:
+        async for index, tile in _enumerate(tiles):
+            if index < checkpoint.completed:
+                continue
+            await queue.put((index, tile))
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    finally:
+        for w in workers:
+            w.cancel()
+        checkpoint.save()
+
+    return n_seeded, n_failed
@@ -0,0 +1,13 @@
+CREATE TEMPORARY TABLE IF NOT EXISTS tile_cache_staging (
+  x integer NOT NULL,
+  y integer NOT NULL,
+  z integer NOT NULL,
+  args_hash bigint NOT NULL,
+  profile integer NOT NULL,
+  tile bytea NOT NULL,
+  tile_gzip bytea,
+  tile_br bytea,
+  tile_zstd bytea,
+  etag text
+)
+ON COMMIT DELETE ROWS;
@@ -0,0 +1,21 @@
+/* Evict a batch of tiles from a profile, in order of eviction priority */
+WITH victims AS (
+  SELECT x, y, z, args_hash, profile
+  FROM tile_cache.tile
+  WHERE profile = :profile
+    AND z > :pinned_maxzoom
+  ORDER BY :order_by
+  LIMIT :batch_size
+  FOR UPDATE SKIP LOCKED
+), deleted AS (
+  DELETE FROM tile_cache.tile t
+  USING victims v
+  WHERE t.x = v.x
+    AND t.y = v.y
+    AND t.z = v.z
+    AND t.args_hash = v.args_hash
+    AND t.profile = v.profile
+  RETURNING t.size
+)
+SELECT count(*) n_tiles, coalesce(sum(size), 0)::bigint size
+FROM deleted;
@@ -0,0 +1,9 @@
+/* Cached tiles for a layer within a range of tile indices */
+SELECT x, y, tile, tile_gzip, etag
+FROM tile_cache.tile
+WHERE profile = :profile
+  AND args_hash = :args_hash
+  AND z = :z
+  AND x BETWEEN :xmin AND :xmax
+  AND y BETWEEN :ymin AND :ymax
+  AND tile IS NOT NULL;
@@ -0,0 +1,12 @@
+INSERT INTO tile_cache.tile (x, y, z, args_hash, profile, tile, tile_gzip, tile_br, tile_zstd, etag)
+SELECT x, y, z, args_hash, profile, tile, tile_gzip, tile_br, tile_zstd, etag
+FROM tile_cache_staging
+ON CONFLICT (x, y, z, args_hash, profile)
+DO UPDATE
+SET 
+  tile = EXCLUDED.tile,
+  tile_gzip = EXCLUDED.tile_gzip,
+  tile_br = EXCLUDED.tile_br,
+  tile_zstd = EXCLUDED.tile_zstd,
+  etag = EXCLUDED.etag,
+  created = now();
@@ -0,0 +1,14 @@
+/* Storage used by each cache profile, and how much of it can be evicted.
+  Sizes come from the trigger-maintained counters in tile_cache.profile_usage,
+  so that this doesn't scan the tile table. */
+SELECT
+  p.id profile,
+  p.max_size,
+  p.min_size,
+  p.pinned_maxzoom,
+  coalesce(sum(u.size), 0)::bigint size,
+  coalesce(sum(u.size) FILTER (WHERE u.z > coalesce(p.pinned_maxzoom, -1)), 0)::bigint evictable
+FROM tile_cache.profile p
+LEFT JOIN tile_cache.profile_usage u
+  ON u.profile = p.id
+GROUP BY p.id;
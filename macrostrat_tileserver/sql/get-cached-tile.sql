@@ -1,18 +1,30 @@
 WITH cached_tile AS (
-  UPDATE tile_cache.tile
-    SET last_used = now()
-  WHERE x = :x
-    AND y = :y
-    AND z = :z
-    AND profile = :layer
-    AND args_hash = :params
-  RETURNING *
+  SELECT
+    t.*,
+    CASE :encoding::text
+      WHEN 'gzip' THEN t.tile_gzip
+      WHEN 'br' THEN t.tile_br
+      WHEN 'zstd' THEN t.tile_zstd
+    END AS encoded_tile,
+    coalesce(t.etag = ANY(:etags::text[]), false) AS not_modified
+  FROM tile_cache.tile t
+  WHERE t.x = :x
+    AND t.y = :y
+    AND t.z = :z
+    AND t.profile = :layer
+    AND t.args_hash = :params
 )
 SELECT
-  t.tile,
+  -- Tile data is only returned if the client doesn't already have it, and
+  -- the uncompressed tile only if there is no matching variant
+  CASE WHEN NOT t.not_modified AND t.encoded_tile IS NULL THEN t.tile END AS tile,
+  CASE WHEN NOT t.not_modified THEN t.encoded_tile END AS encoded_tile,
+  t.encoded_tile IS NOT NULL AS has_encoding,
+  t.not_modified,
+  t.etag,
   t.args_hash,
   p.id profile,
   p.content_type
 FROM cached_tile t
 JOIN tile_cache.profile p
-  ON t.profile = p.id
\ No newline at end of file
+  ON t.profile = p.id
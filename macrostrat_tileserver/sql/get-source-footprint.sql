@@ -0,0 +1,26 @@
+/* Bounding box of a map source's current footprint, together with the footprint it had
+  before any pending invalidation request, and the time of that request */
+WITH footprint AS (
+  SELECT rgeom geom
+  FROM maps.sources
+  WHERE source_id = :source_id
+    AND rgeom IS NOT NULL
+  UNION ALL
+  SELECT previous_footprint
+  FROM tile_cache.source_invalidation
+  WHERE source_id = :source_id
+    AND previous_footprint IS NOT NULL
+), extent AS (
+  SELECT ST_Extent(geom) env FROM footprint
+)
+SELECT
+  ST_XMin(env) west,
+  ST_YMin(env) south,
+  ST_XMax(env) east,
+  ST_YMax(env) north,
+  (
+    SELECT requested
+    FROM tile_cache.source_invalidation
+    WHERE source_id = :source_id
+  ) requested
+FROM extent;
@@ -0,0 +1,48 @@
+/* Remove cached tiles that intersect a map source's footprint, or the footprint it had
+  before a pending invalidation request.
+  Candidate tiles are limited to precomputed index ranges for each zoom level,
+  then checked against the footprints.
+
+  The pending request is claimed (deleted) in the same statement. With :claim set,
+  tiles are only deleted if the request is claimed, so that when several workers
+  receive the same notification, only one of them deletes the tiles. A request that
+  was updated since it was read (:requested) is left for its own notification. */
+WITH request AS (
+  DELETE FROM tile_cache.source_invalidation
+  WHERE source_id = :source_id
+    AND requested = :requested
+  RETURNING previous_footprint
+), footprint AS (
+  SELECT rgeom geom
+  FROM maps.sources
+  WHERE source_id = :source_id
+    AND rgeom IS NOT NULL
+  UNION ALL
+  SELECT previous_footprint
+  FROM request
+  WHERE previous_footprint IS NOT NULL
+), deleted AS (
+  DELETE FROM tile_cache.tile t
+  USING
+    unnest(
+      :z::integer[],
+      :xmin::integer[],
+      :xmax::integer[],
+      :ymin::integer[],
+      :ymax::integer[]
+    ) AS r(z, xmin, xmax, ymin, ymax)
+  WHERE (NOT :claim OR EXISTS (SELECT 1 FROM request))
+    AND t.profile = ANY(:profiles::integer[])
+    AND t.z = r.z
+    AND t.x BETWEEN r.xmin AND r.xmax
+    AND t.y BETWEEN r.ymin AND r.ymax
+    AND EXISTS (
+      SELECT 1
+      FROM footprint f
+      WHERE ST_Intersects(ST_Transform(tile_utils.envelope(t.x, t.y, t.z), 4326), f.geom)
+    )
+  RETURNING 1
+)
+SELECT
+  EXISTS (SELECT 1 FROM request) claimed,
+  (SELECT count(*) FROM deleted) n_deleted;
@@ -1,14 +1,22 @@
-INSERT INTO tile_cache.tile (x, y, z, args_hash, profile, tile)
+INSERT INTO tile_cache.tile (x, y, z, args_hash, profile, tile, tile_gzip, tile_br, tile_zstd, etag)
 VALUES (
   :x,
   :y,
   :z,
-  :params,
+  :args_hash,
   :profile,
-  :tile
+  :tile,
+  :tile_gzip,
+  :tile_br,
+  :tile_zstd,
+  :etag
 )
 ON CONFLICT (x, y, z, args_hash, profile)
 DO UPDATE
 SET 
   tile = EXCLUDED.tile,
-  created = now();
\ No newline at end of file
+  tile_gzip = EXCLUDED.tile_gzip,
+  tile_br = EXCLUDED.tile_br,
+  tile_zstd = EXCLUDED.tile_zstd,
+  etag = EXCLUDED.etag,
+  created = now();
@@ -0,0 +1,9 @@
+/* Tiles at a zoom level that intersect a map source's footprint, in a stable order */
+SELECT x, y
+FROM
+  maps.sources s,
+  generate_series(:xmin::integer, :xmax::integer) x,
+  generate_series(:ymin::integer, :ymax::integer) y
+WHERE s.source_id = :source_id
+  AND ST_Intersects(ST_Transform(tile_utils.envelope(x, y, :z), 4326), s.rgeom)
+ORDER BY x, y;
@@ -0,0 +1,19 @@
+/* Apply access times and counts that were accumulated in memory by the tileserver */
+UPDATE tile_cache.tile t
+SET
+  last_used = greatest(t.last_used, to_timestamp(a.last_used)),
+  hits = t.hits + a.hits
+FROM unnest(
+  :x::integer[],
+  :y::integer[],
+  :z::integer[],
+  :args_hash::bigint[],
+  :profile::integer[],
+  :last_used::double precision[],
+  :hits::integer[]
+) AS a(x, y, z, args_hash, profile, last_used, hits)
+WHERE t.x = a.x
+  AND t.y = a.y
+  AND t.z = a.z
+  AND t.args_hash = a.args_hash
+  AND t.profile = a.profile;
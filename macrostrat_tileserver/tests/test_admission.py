@@ -0,0 +1,77 @@
+"""
+Tests for admission control of tile requests, which don't require a database.
+"""
+
+import asyncio
+
+import pytest
+
+from macrostrat_tileserver.utils.admission import (
+    AdmissionController,
+    Limiter,
+    Overloaded,
+)
+
+
+async def _hold(slot, delay):
+    async with slot:
+        await asyncio.sleep(delay)
+
+
+def test_limiter_rejects_when_queue_is_full():
+    limiter = Limiter("render", 1, max_queue_size=1, queue_timeout=None)
+
+    async def run():
+        active = asyncio.ensure_future(_hold(limiter.slot(), 0.05))
+        queued = asyncio.ensure_future(_hold(limiter.slot(), 0))
+        await asyncio.sleep(0.01)
+        assert limiter.active == 1 and limiter.waiting == 1
+        with pytest.raises(Overloaded):
+            await _hold(limiter.slot(), 0)
+        await asyncio.gather(active, queued)
+
+    asyncio.run(run())
+    stats = limiter.stats()
+    assert stats["admitted"] == 2
+    assert stats["rejected"] == 1
+    assert stats["max_queued"] == 1
+    assert stats["max_wait_ms"] >= 30
+
+
+def test_limiter_queue_timeout():
+    limiter = Limiter("cache", 1, queue_timeout=0.01)
+
+    async def run():
+        active = asyncio.ensure_future(_hold(limiter.slot(), 0.05))
+        await asyncio.sleep(0)
+        with pytest.raises(Overloaded):
+            await _hold(limiter.slot(), 0)
+        await active
+
+    asyncio.run(run())
+    assert limiter.timeouts == 1
+    assert limiter.waiting == 0
+
+
+def test_layer_render_limits():
+    admission = AdmissionController(
+        render_concurrency=4, layer_concurrency={"carto-slim-rotated": 1}
+    )
+    running = {"carto-slim-rotated": 0, "carto": 0}
+    peak = dict(running)
+
+    async def render(layer):
+        async with admission.render(layer):
+            running[layer] += 1
+            peak[layer] = max(peak[layer], running[layer])
+            await asyncio.sleep(0.01)
+            running[layer] -= 1
+
+    async def run():
+        layers = ["carto-slim-rotated"] * 3 + ["carto"] * 3
+        await asyncio.gather(*(render(layer) for layer in layers))
+
+    asyncio.run(run())
+    # The rotated layer is limited on its own, without holding back other layers
+    assert peak == {"carto-slim-rotated": 1, "carto": 3}
+    assert admission.stats()["layers"]["carto-slim-rotated"]["admitted"] == 3
@@ -0,0 +1,80 @@
+"""
+Tests for reading and writing tile archives.
+"""
+
+import gzip
+import sqlite3
+
+import pytest
+
+from macrostrat_tileserver.archives import (
+    MBTilesWriter,
+    PMTilesWriter,
+    open_archive,
+)
+from macrostrat_tileserver.utils import tile_etag
+
+tiles = {
+    (0, 0, 0): b"world",
+    (1, 0, 0): b"empty",
+    (1, 1, 0): b"empty",
+    (1, 0, 1): b"empty",
+    (1, 1, 1): b"land",
+}
+
+metadata = dict(name="test", bounds=(-180, -85, 180, 85), minzoom=0, maxzoom=1)
+
+
+def _write(writer):
+    for (z, x, y), data in tiles.items():
+        writer.write(z, x, y, gzip.compress(data), tile_etag(data))
+    writer.close(metadata)
+    return writer
+
+
+def test_mbtiles_writer(tmp_path):
+    path = tmp_path / "test.mbtiles"
+    writer = _write(MBTilesWriter(path))
+    assert writer.tiles_written == 5
+    assert writer.unique_tiles == 3
+
+    conn = sqlite3.connect(path)
+    # Rows are flipped to the TMS scheme
+    (data,) = conn.execute(
+        "SELECT tile_data FROM tiles WHERE zoom_level = 1 AND tile_column = 1 AND tile_row = 0"
+    ).fetchone()
+    assert gzip.decompress(data) == b"land"
+    assert conn.execute("SELECT count(*) FROM images").fetchone() == (3,)
+
+
+def test_pmtiles_writer(tmp_path):
+    reader = pytest.importorskip("pmtiles.reader")
+
+    path = tmp_path / "test.pmtiles"
+    writer = _write(PMTilesWriter(path))
+    assert writer.unique_tiles == 3
+
+    with path.open("rb") as f:
+        archive = reader.Reader(reader.MmapSource(f))
+        for (z, x, y), data in tiles.items():
+            assert gzip.decompress(archive.get(z, x, y)) == data
+        assert archive.header()["tile_contents_count"] == 3
+        assert archive.metadata()["name"] == "test"
+
+
+@pytest.mark.parametrize("format", ["mbtiles", "pmtiles"])
+def test_archive_reader(tmp_path, format):
+    if format == "pmtiles":
+        pytest.importorskip("pmtiles")
+    path = tmp_path / f"test.{format}"
+    writer = MBTilesWriter(path) if format == "mbtiles" else PMTilesWriter(path)
+    _write(writer)
+
+    archive = open_archive(path)
+    assert archive.encoding == "gzip"
+    assert archive.minzoom == 0
+    assert archive.maxzoom == 1
+    for (z, x, y), data in tiles.items():
+        assert gzip.decompress(archive.get(z, x, y)) == data
+    assert archive.get(2, 0, 0) is None
+    archive.close()
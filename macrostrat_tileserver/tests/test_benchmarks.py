@@ -0,0 +1,206 @@
+"""
+Benchmarks for tile serving hot paths. These compare timings, so they are skipped
+unless requested; they print their measurements, which can be collected with
+`pytest -s -m benchmark --benchmark`.
+"""
+
+from random import Random
+from time import perf_counter, process_time
+
+import pytest
+from mapbox_vector_tile import decode, encode
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.responses import Response
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from macrostrat_tileserver.utils.compression import CompressionMiddleware, encode_tile
+
+
+def _make_tile(n_features=500, seed=0):
+    """A synthetic vector tile with a realistic amount of geometry and attributes."""
+    rng = Random(seed)
+    features = []
+    for i in range(n_features):
+        x, y = rng.randint(0, 4000), rng.randint(0, 4000)
+        coords = [(x + rng.randint(0, 90), y + rng.randint(0, 90)) for _ in range(12)]
+        coords.append(coords[0])
+        features.append(
+            {
+                "geometry": {"type": "Polygon", "coordinates": [coords]},
+                "properties": {
+                    "map_id": i,
+                    "source_id": rng.randint(1, 300),
+                    "color": f"#{rng.randint(0, 0xFFFFFF):06x}",
+                    "name": rng.choice(["Mancos Shale", "Dakota Sandstone", "Unit"]),
+                },
+            }
+        )
+    return encode({"name": "units", "features": features})
+
+
+def _cpu_per_request(client, path, headers, n=50):
+    client.get(path, headers=headers)
+    start = process_time()
+    for _ in range(n):
+        res = client.get(path, headers=headers)
+    return (process_time() - start) / n, res
+
+
+@pytest.mark.benchmark
+def test_precompressed_tile_cpu_per_hit():
+    tile = _make_tile()
+    variants = encode_tile(tile, ["gzip"])
+
+    async def dynamic(request):
+        return Response(tile, media_type="application/x-protobuf")
+
+    async def precompressed(request):
+        return Response(
+            variants["gzip"],
+            media_type="application/x-protobuf",
+            headers={"Content-Encoding": "gzip", "Vary": "Accept-Encoding"},
+        )
+
+    app = Starlette(
+        routes=[Route("/dynamic", dynamic), Route("/precompressed", precompressed)],
+        middleware=[Middleware(CompressionMiddleware, minimum_size=0)],
+    )
+    headers = {"Accept-Encoding": "gzip"}
+
+    with TestClient(app) as client:
+        before, res_before = _cpu_per_request(client, "/dynamic", headers)
+        after, res_after = _cpu_per_request(client, "/precompressed", headers)
+
+    # Both responses decode to the same tile, and neither is compressed twice
+    assert res_before.headers["Content-Encoding"] == "gzip"
+    assert res_after.headers["Content-Encoding"] == "gzip"
+    assert decode(res_before.content) == decode(res_after.content) == decode(tile)
+
+    print(
+        f"\nCPU per cache hit ({len(tile)} byte tile): "
+        f"{before * 1000:.2f} ms compressed on the fly, "
+        f"{after * 1000:.2f} ms pre-compressed"
+    )
+    assert after < before
+
+
+_mapnik_style = """<?xml version="1.0" encoding="utf-8"?>
+<Map srs="+proj=merc +a=6378137 +b=6378137 +lat_ts=0.0 +lon_0=0.0 +x_0=0.0 +y_0=0.0 +k=1.0 +units=m +nadgrids=@null +wktext +no_defs +over">
+  <Style name="units">
+    <Rule>
+      <PolygonSymbolizer fill="#c8a2c8" />
+      <LineSymbolizer stroke="#333333" stroke-width="0.5" />
+    </Rule>
+  </Style>
+  <Layer name="units" srs="+proj=longlat +ellps=WGS84 +datum=WGS84 +no_defs">
+    <StyleName>units</StyleName>
+    <Datasource>
+      <Parameter name="type">csv</Parameter>
+      <Parameter name="inline">
+wkt
+{rows}
+      </Parameter>
+    </Datasource>
+  </Layer>
+</Map>
+"""
+
+
+def _mapnik_styles():
+    rng = Random(0)
+    rows = []
+    for _ in range(2000):
+        x, y = rng.uniform(-120, -100), rng.uniform(30, 45)
+        ring = [(x, y), (x + 0.3, y), (x + 0.3, y + 0.2), (x, y + 0.2), (x, y)]
+        coords = ", ".join(f"{a:.4f} {b:.4f}" for a, b in ring)
+        rows.append(f'"POLYGON(({coords}))"')
+    xml = _mapnik_style.format(rows="\n".join(rows))
+    return {scale: xml for scale in ("tiny", "small", "medium", "large")}
+
+
+@pytest.mark.benchmark
+def test_mapnik_map_reuse_renders_per_second():
+    mapnik = pytest.importorskip("mapnik")
+    from macrostrat_tileserver.image_tiles import render
+
+    styles = _mapnik_styles()
+    tiles = [(6, 11, 24), (6, 12, 24), (6, 11, 25), (6, 12, 25)] * 5
+
+    def render_with_new_map(z, x, y):
+        # Previous behavior: parse the style for every tile
+        map = mapnik.Map(render.tile_size, render.tile_size)
+        mapnik.load_map_from_string(map, styles["medium"])
+        bbox = render.tms.get("WebMercatorQuad").xy_bounds(x, y, z)
+        map.zoom_to_box(mapnik.Box2d(bbox.left, bbox.top, bbox.right, bbox.bottom))
+        im = mapnik.Image(render.tile_size, render.tile_size)
+        mapnik.render(map, im)
+        return im.tostring("png")
+
+    def renders_per_second(func):
+        start = perf_counter()
+        for tile in tiles:
+            func(*tile)
+        return len(tiles) / (perf_counter() - start)
+
+    render.init_worker(styles)
+    before = renders_per_second(render_with_new_map)
+    after = renders_per_second(render.render_tile)
+
+    assert render.render_tile(*tiles[0]) == render_with_new_map(*tiles[0])
+    assert render._maps.maps_created == len(styles)
+
+    print(
+        f"\nMapnik renders per second: {before:.1f} parsing the style per tile, "
+        f"{after:.1f} reusing parsed maps"
+    )
+    assert after > before
+
+
+@pytest.mark.benchmark
+def test_stored_function_tile_latency(db):
+    import asyncio
+
+    import morecantile
+    from buildpg import asyncpg
+    from morecantile import Tile
+
+    from macrostrat_tileserver.function_layer import StoredFunction
+
+    quad = morecantile.tms.get("WebMercatorQuad")
+    # A small tile, where fixed per-query overhead dominates
+    tiles = [Tile(1554, 3078, 13), Tile(0, 0, 1)] * 100
+
+    async def mean_latency(layer, pool):
+        for tile in tiles[:10]:
+            await layer.get_tile(pool, tile, quad)
+        start = perf_counter()
+        for tile in tiles:
+            await layer.get_tile(pool, tile, quad)
+        return (perf_counter() - start) / len(tiles)
+
+    async def run():
+        url = db.engine.url.set(drivername="postgresql")
+        pool = await asyncpg.create_pool_b(
+            url.render_as_string(hide_password=False), min_size=1, max_size=1
+        )
+        try:
+            transactional = StoredFunction("tile_layers.carto", {}, transactional=True)
+            single = StoredFunction("tile_layers.carto", {})
+            a = await mean_latency(transactional, pool)
+            b = await mean_latency(single, pool)
+            tile = tiles[0]
+            assert await single.get_tile(pool, tile, quad) == (
+                await transactional.get_tile(pool, tile, quad)
+            )
+            return a, b
+        finally:
+            await pool.close()
+
+    before, after = asyncio.run(run())
+    print(
+        f"\nStored function tile latency: {before * 1000:.2f} ms with BEGIN/ROLLBACK, "
+        f"{after * 1000:.2f} ms as a single statement"
+    )
+    assert after < before
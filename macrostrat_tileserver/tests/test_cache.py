@@ -0,0 +1,237 @@
+"""
+Tests for tile caching utilities that don't require a database
+"""
+
+import asyncio
+
+import pytest
+from starlette.requests import Request
+
+from macrostrat_tileserver import cache
+from macrostrat_tileserver.cache import create_params_hash, tile_memory_cache
+from macrostrat_tileserver.cache_writer import TileAccessTracker
+from macrostrat_tileserver.memory_cache import MemoryTileCache
+from macrostrat_tileserver.utils import SingleFlight, request_etags, tile_etag
+from macrostrat_tileserver.utils.output import representation_etag
+from macrostrat_tileserver.utils.compression import preferred_encoding
+
+
+def test_memory_cache_disabled():
+    cache = MemoryTileCache()
+    key = (1, 0, 0, 0, 0)
+    cache.set(key, b"tile")
+    assert cache.get(key) is None
+    assert len(cache) == 0
+
+
+def test_memory_cache_byte_budget():
+    cache = MemoryTileCache(max_size=10)
+    cache.set((1, 0, 0, 0, 0), b"aaaa")
+    cache.set((1, 1, 0, 0, 0), b"bbbb")
+    # Touch the first tile so that the second is least recently used
+    assert cache.get((1, 0, 0, 0, 0)) == b"aaaa"
+    cache.set((1, 1, 1, 0, 0), b"cccc")
+    assert cache.size == 8
+    assert cache.get((1, 1, 0, 0, 0)) is None
+    assert cache.get((1, 1, 1, 0, 0)) == b"cccc"
+    assert cache.hits == 2
+    assert cache.misses == 1
+    assert cache.evictions == 1
+
+
+def test_memory_cache_counts_one_lookup_per_tile():
+    cache = MemoryTileCache(max_size=100)
+    cache.set((1, 0, 0, 0, 0, None), b"aaaa")
+    # The compressed variant isn't cached, but the uncompressed tile is
+    variants = [(1, 0, 0, 0, 0, "br"), (1, 0, 0, 0, 0, None)]
+    assert cache.get_first(variants) == b"aaaa"
+    assert cache.get_first([(1, 1, 0, 0, 0, "br"), (1, 1, 0, 0, 0, None)]) is None
+    assert cache.hits == 1
+    assert cache.misses == 1
+
+
+def test_memory_cache_profile_ttl():
+    cache = MemoryTileCache(max_size=100, profile_ttl={"carto": -1})
+    cache.register_profile(1, "carto")
+    cache.set((1, 0, 0, 0, 0), b"aaaa")
+    cache.set((2, 0, 0, 0, 0), b"bbbb")
+    assert cache.get((1, 0, 0, 0, 0)) is None
+    assert cache.get((2, 0, 0, 0, 0)) == b"bbbb"
+
+
+class _ProfilePool:
+    """Stands in for a connection pool, returning the current profile row."""
+
+    def __init__(self, row):
+        self.row = row
+        self.queries = 0
+
+    def acquire(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def fetchrow(self, query, *args):
+        self.queries += 1
+        return self.row
+
+
+def test_cache_profiles_are_reloaded(monkeypatch):
+    pool = _ProfilePool(dict(id=1, name="test-profile", max_age=60))
+    monkeypatch.setattr(cache, "_cache_profiles", {})
+
+    async def run():
+        first = await cache.get_cache_profile(pool, "test-profile")
+        pool.row = dict(id=1, name="test-profile", max_age=3600)
+        # Profiles are memoized...
+        assert await cache.get_cache_profile(pool, "test-profile") == first
+        # ...until their TTL expires
+        monkeypatch.setattr(cache, "cache_profile_ttl", 0)
+        return await cache.get_cache_profile(pool, "test-profile")
+
+    profile = asyncio.run(run())
+    assert profile.max_age == 3600
+    assert pool.queries == 2
+
+
+def test_single_flight_coalesces_renders():
+    renders = SingleFlight()
+    calls = []
+
+    async def render(key):
+        calls.append(key)
+        await asyncio.sleep(0.01)
+        return b"tile"
+
+    async def main():
+        return await asyncio.gather(
+            *(renders.run("carto/0/0/0", render, "carto/0/0/0") for _ in range(5))
+        )
+
+    results = asyncio.run(main())
+    assert len(calls) == 1
+    assert all(content == b"tile" for content, _ in results)
+    assert sum(is_leader for _, is_leader in results) == 1
+    assert "carto/0/0/0" not in renders
+
+
+def test_access_tracker_bounded():
+    tracker = TileAccessTracker(max_pending=2)
+    tracker.record(0, 0, 0, 0, 1)
+    tracker.record(0, 0, 0, 0, 1)
+    tracker.record(1, 0, 1, 0, 1)
+    tracker.record(1, 1, 1, 0, 1)
+    assert tracker.stats()["pending"] == 2
+    assert tracker.dropped == 1
+
+    tracker = TileAccessTracker(sample_rate=0)
+    tracker.record(0, 0, 0, 0, 1)
+    assert tracker.stats()["pending"] == 0
+
+
+def test_params_hash_is_canonical():
+    a = create_params_hash({"model_id": 1, "t_step": 10})
+    b = create_params_hash({"t_step": 10, "model_id": 1})
+    assert a == b
+    assert a != create_params_hash({"model_id": 1, "t_step": 15})
+    assert -(2**63) <= a < 2**63
+    assert create_params_hash({}) == create_params_hash(None) == 0
+
+
+def test_layer_params_are_normalized():
+    from macrostrat_tileserver.function_layer import StoredFunction
+
+    layer = StoredFunction("tile_layers.map", {"source_id": int})
+    params = layer.normalize_params({"source_id": "251", "v": "12345"})
+    assert params == {"source_id": 251}
+
+    with pytest.raises(ValueError):
+        layer.normalize_params({"source_id": "abc"})
+
+    # Layers without a parameter schema receive everything
+    layer = StoredFunction("weaver_api.weaver_tile")
+    assert layer.normalize_params({"v": "1"}) == {"v": "1"}
+
+
+def test_preferred_encoding():
+    stored = ["gzip", "br"]
+    assert preferred_encoding("gzip, deflate, br", stored) == "br"
+    assert preferred_encoding("gzip, br;q=0.5", stored) == "gzip"
+    assert preferred_encoding("deflate", stored) is None
+    assert preferred_encoding("*", stored) == "br"
+    assert preferred_encoding("gzip, br", []) is None
+
+
+def test_etags_ignore_encoding():
+    etag = tile_etag(b"tile")
+    header = ", ".join(
+        [representation_etag(etag, "br"), 'W/"other"', representation_etag(etag)]
+    )
+    request = Request(
+        {"type": "http", "headers": [(b"if-none-match", header.encode())]}
+    )
+    assert request_etags(request) == [etag, "other", etag]
+
+
+def test_source_invalidation_ranges():
+    from macrostrat_tileserver.invalidation import purge_memory_cache, tile_ranges
+
+    # Roughly the state of Utah
+    ranges = list(tile_ranges((-114.05, 37.0, -109.04, 42.0), 0, 6))
+    assert ranges[0] == (0, 0, 0, 0, 0)
+    assert ranges[-1] == (6, 11, 12, 23, 24)
+
+    cache = tile_memory_cache
+    cache.configure(max_size=1000)
+    try:
+        cache.set((1, 6, 12, 24, 0, None), b"inside")
+        cache.set((1, 6, 13, 24, 0, None), b"outside")
+        cache.set((2, 6, 12, 24, 0, None), b"other profile")
+        purge_memory_cache(ranges, [1])
+        assert cache.get((1, 6, 12, 24, 0, None)) is None
+        assert cache.get((1, 6, 13, 24, 0, None)) == b"outside"
+        assert cache.get((2, 6, 12, 24, 0, None)) == b"other profile"
+    finally:
+        cache.clear()
+        cache.configure(max_size=0)
+
+
+def test_eviction_plan():
+    from macrostrat_tileserver.eviction import ProfileUsage, plan_eviction
+
+    usage = [
+        # Over its quota, and mostly pinned
+        ProfileUsage(1, size=500, evictable=150, max_size=300),
+        # A large profile, which should bear most of the remaining eviction
+        ProfileUsage(2, size=800, evictable=800),
+        # Within its reservation
+        ProfileUsage(3, size=100, evictable=100, min_size=100),
+    ]
+    plan = plan_eviction(usage, max_size=1000)
+    assert plan[1] == 150
+    assert 3 not in plan
+    assert plan[2] == 250
+
+    # Quotas are enforced without an overall budget
+    assert plan_eviction(usage, max_size=0) == {1: 150}
+
+
+def test_seed_checkpoint(tmp_path):
+    from macrostrat_tileserver.seed import SeedCheckpoint
+
+    path = tmp_path / "seed.json"
+    job = {"layer": "carto", "minzoom": 0, "maxzoom": 4}
+    checkpoint = SeedCheckpoint(path, job)
+    for i in (0, 1, 3, 4):
+        checkpoint.mark_done(i)
+    # Tile 2 is still in progress
+    assert checkpoint.completed == 2
+    checkpoint.save()
+
+    assert SeedCheckpoint(path, job).completed == 2
+    # A different job starts over
+    assert SeedCheckpoint(path, {**job, "maxzoom": 5}).completed == 0
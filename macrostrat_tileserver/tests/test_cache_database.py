@@ -0,0 +1,258 @@
+"""
+Tests for the tile cache's SQL statements (writes, access times, eviction and
+invalidation), run against the test database.
+"""
+
+import asyncio
+from time import time
+
+import pytest
+from buildpg import asyncpg
+
+from macrostrat_tileserver.cache_writer import (
+    CachedTileRecord,
+    TileAccessTracker,
+    TileCacheWriter,
+)
+from macrostrat_tileserver.eviction import TileCacheEvictor
+from macrostrat_tileserver.invalidation import invalidate_source_tiles
+
+profile_name = "test-cache-sql"
+
+
+@pytest.fixture
+def run_with_pool(db):
+    """Run a coroutine function with a connection pool and the ID of an empty cache
+    profile used only by these tests."""
+    url = db.engine.url.set(drivername="postgresql")
+
+    async def _run(func):
+        pool = await asyncpg.create_pool_b(
+            url.render_as_string(hide_password=False), min_size=1, max_size=2
+        )
+        try:
+            async with pool.acquire() as conn:
+                profile = await conn.fetchval(
+                    """
+                    INSERT INTO tile_cache.profile
+                      (name, format, content_type, minzoom, maxzoom)
+                    VALUES ($1, 'pbf', 'application/x-protobuf', 0, 14)
+                    ON CONFLICT (name) DO UPDATE
+                    SET max_size = NULL, min_size = NULL, pinned_maxzoom = NULL
+                    RETURNING id
+                    """,
+                    profile_name,
+                )
+                await conn.execute(
+                    "DELETE FROM tile_cache.tile WHERE profile = $1", profile
+                )
+            return await func(pool, profile)
+        finally:
+            await pool.close()
+
+    return lambda func: asyncio.run(_run(func))
+
+
+async def _write_tiles(pool, records):
+    writer = TileCacheWriter(max_queue_size=100, flush_interval=60)
+    writer.start(pool)
+    for record in records:
+        await writer.put(record)
+    # Closing the writer flushes the queued tiles
+    await writer.close()
+    assert writer.errors == 0
+    return writer
+
+
+async def _cached_tiles(pool, profile) -> dict:
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(
+            """
+            SELECT z, x, y, tile, etag, hits, last_used
+            FROM tile_cache.tile
+            WHERE profile = $1
+            """,
+            profile,
+        )
+    return {(r["z"], r["x"], r["y"]): r for r in rows}
+
+
+def _tile(profile, z, x, y, content=b"tile", **kwargs):
+    return CachedTileRecord(x, y, z, 0, profile, content, **kwargs)
+
+
+def test_flush_cached_tiles(run_with_pool):
+    async def run(pool, profile):
+        await _write_tiles(pool, [_tile(profile, 1, 0, 0, b"old", etag="a")])
+        writer = await _write_tiles(
+            pool,
+            [
+                _tile(profile, 1, 0, 0, b"stale", etag="b"),
+                _tile(profile, 1, 0, 0, b"new", etag="c"),
+                _tile(profile, 1, 1, 0, b"other", etag="d"),
+            ],
+        )
+        # Repeated writes of a tile in one batch are reduced to the last one
+        assert writer.tiles_written == 2
+        return await _cached_tiles(pool, profile)
+
+    tiles = run_with_pool(run)
+    assert set(tiles) == {(1, 0, 0), (1, 1, 0)}
+    # Existing tiles are replaced
+    assert tiles[(1, 0, 0)]["tile"] == b"new"
+    assert tiles[(1, 0, 0)]["etag"] == "c"
+    assert tiles[(1, 1, 0)]["tile"] == b"other"
+
+
+def test_update_tile_access(run_with_pool):
+    async def run(pool, profile):
+        await _write_tiles(pool, [_tile(profile, 1, 0, 0), _tile(profile, 1, 1, 0)])
+        tracker = TileAccessTracker()
+        for _ in range(3):
+            tracker.record(0, 0, 1, 0, profile)
+        # Accesses of tiles that aren't cached are ignored
+        tracker.record(0, 0, 1, 0, -1)
+        await tracker.flush(pool)
+        assert tracker.errors == 0
+        return await _cached_tiles(pool, profile)
+
+    start = time()
+    tiles = run_with_pool(run)
+    assert tiles[(1, 0, 0)]["hits"] == 3
+    assert tiles[(1, 0, 0)]["last_used"].timestamp() >= start - 1
+    assert tiles[(1, 1, 0)]["hits"] == 0
+
+
+def test_evict_tiles(run_with_pool):
+    async def run(pool, profile):
+        content = b"x" * 100
+        await _write_tiles(
+            pool,
+            [
+                _tile(profile, 0, 0, 0, content),
+                _tile(profile, 2, 0, 0, content),
+                _tile(profile, 2, 1, 0, content),
+                _tile(profile, 2, 2, 0, content),
+            ],
+        )
+        async with pool.acquire() as conn:
+            # The pinned tile is the least recently used, and x sets the order of
+            # the others
+            await conn.execute(
+                """
+                UPDATE tile_cache.tile
+                SET last_used = now() - make_interval(hours => 10 - x - z * 2)
+                WHERE profile = $1
+                """,
+                profile,
+            )
+            await conn.execute(
+                """
+                UPDATE tile_cache.profile
+                SET max_size = 250, pinned_maxzoom = 0
+                WHERE id = $1
+                """,
+                profile,
+            )
+
+        evictor = TileCacheEvictor(max_size=0, batch_size=1, batch_pause=0)
+        await evictor.run(pool)
+        assert evictor.errors == 0
+        return profile, evictor, await _cached_tiles(pool, profile)
+
+    profile, evictor, tiles = run_with_pool(run)
+    # Usage is measured before eviction
+    assert evictor.last_usage[profile] == 400
+    # Least recently used tiles are evicted until the profile is within its quota,
+    # and pinned tiles are kept
+    assert set(tiles) == {(0, 0, 0), (2, 2, 0)}
+    assert evictor.tiles_evicted == 2
+    assert evictor.bytes_evicted == 200
+
+
+def test_profile_usage_counters(run_with_pool):
+    async def run(pool, profile):
+        await _write_tiles(
+            pool,
+            [
+                _tile(profile, 1, 0, 0, b"x" * 10),
+                _tile(profile, 1, 1, 0, b"x" * 20),
+                _tile(profile, 2, 0, 0, b"x" * 30),
+            ],
+        )
+        # Replace a tile, and delete another
+        await _write_tiles(pool, [_tile(profile, 1, 0, 0, b"x" * 50)])
+        async with pool.acquire() as conn:
+            await conn.execute(
+                "DELETE FROM tile_cache.tile WHERE profile = $1 AND z = 2", profile
+            )
+            rows = await conn.fetch(
+                """
+                SELECT z, size, n_tiles FROM tile_cache.profile_usage
+                WHERE profile = $1
+                """,
+                profile,
+            )
+        return {r["z"]: (r["size"], r["n_tiles"]) for r in rows}
+
+    usage = run_with_pool(run)
+    assert usage[1] == (70, 2)
+    assert usage.get(2, (0, 0)) == (0, 0)
+
+
+def test_invalidate_source_tiles(run_with_pool):
+    async def run(pool, profile):
+        await _write_tiles(
+            pool,
+            [
+                # Within the footprint of source 251
+                _tile(profile, 13, 1554, 3078),
+                _tile(profile, 10, 194, 384),
+                # On the other side of the world
+                _tile(profile, 13, 1554 + 4096, 3078),
+            ],
+        )
+        async with pool.acquire() as conn:
+            n_deleted = await invalidate_source_tiles(conn, 251)
+        return n_deleted, await _cached_tiles(pool, profile)
+
+    n_deleted, tiles = run_with_pool(run)
+    assert set(tiles) == {(13, 1554 + 4096, 3078)}
+    # Cached tiles of other layers may also have been deleted
+    assert n_deleted >= 2
+
+
+def test_invalidate_previous_source_footprint(run_with_pool):
+    async def run(pool, profile):
+        await _write_tiles(
+            pool,
+            [_tile(profile, 13, 1554, 3078), _tile(profile, 10, 194, 384)],
+        )
+        async with pool.acquire() as conn:
+            tr = conn.transaction()
+            await tr.start()
+            try:
+                # Shrink the footprint of source 251 to a point far from its tiles,
+                # which requests invalidation with the previous footprint
+                await conn.execute(
+                    """
+                    UPDATE maps.sources
+                    SET rgeom = ST_Buffer(ST_SetSRID(ST_MakePoint(0, 0), 4326), 0.01)
+                    WHERE source_id = 251
+                    """
+                )
+                n_deleted = await invalidate_source_tiles(conn, 251, claim=True)
+                # The request can only be claimed once
+                claimed_again = await invalidate_source_tiles(conn, 251, claim=True)
+                n_remaining = await conn.fetchval(
+                    "SELECT count(*) FROM tile_cache.tile WHERE profile = $1",
+                    profile,
+                )
+            finally:
+                await tr.rollback()
+        return n_deleted, claimed_again, n_remaining
+
+    n_deleted, claimed_again, n_remaining = run_with_pool(run)
+    assert n_deleted >= 2
+    assert claimed_again is None
+    assert n_remaining == 0
@@ -0,0 +1,178 @@
+"""
+Tests for image tile rendering infrastructure that don't require Mapnik.
+"""
+
+import asyncio
+import os
+from time import sleep
+
+import pytest
+from macrostrat.utils.timer import Timer
+
+from macrostrat_tileserver.image_tiles.render_pool import RenderPool, RenderPoolFull
+
+
+def test_render_pool_sheds_load():
+    async def run():
+        pool = RenderPool(processes=1, max_queue_size=1, timeout=5)
+        await pool.start()
+        try:
+            timer = Timer()
+            assert await pool.run(bytes, 2, timer=timer) == b"\x00\x00"
+            assert "render_queue;dur=" in timer.server_timings()
+
+            tasks = [asyncio.ensure_future(pool.run(sleep, 0.2)) for _ in range(3)]
+            res = await asyncio.gather(*tasks, return_exceptions=True)
+            # One render runs, one waits, and one is rejected
+            assert res[:2] == [None, None]
+            assert isinstance(res[2], RenderPoolFull)
+            assert pool.stats()["rejected"] == 1
+        finally:
+            pool.close()
+
+    asyncio.run(run())
+
+
+def test_render_pool_counts_abandoned_renders():
+    async def run():
+        pool = RenderPool(processes=1, max_queue_size=1, timeout=0.2)
+        await pool.start()
+        try:
+            with pytest.raises(asyncio.TimeoutError):
+                await pool.run(sleep, 0.5)
+            # The render has started, so its worker is still busy
+            stats = pool.stats()
+            assert stats["abandoned"] == 1
+            assert stats["abandoned_running"] == 1
+            assert stats["in_progress"] == 1
+            await asyncio.sleep(0.5)
+            assert pool.stats()["abandoned_running"] == 0
+            assert pool.stats()["in_progress"] == 0
+        finally:
+            pool.close()
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize(
+    "tile,origin",
+    [
+        ((0, 0, 0), (0, 0, 1)),
+        ((3, 2, 2), (2, 2, 2)),
+        ((7, 5, 4), (6, 4, 2)),
+    ],
+)
+def test_metatile_origin(tile, origin):
+    from morecantile import Tile
+
+    from macrostrat_tileserver.image_tiles.config import metatile_origin
+
+    x, y, z = tile
+    assert metatile_origin(Tile(x, y, z), 2) == origin
+
+
+def test_compiled_styles_are_cached(tmp_path, monkeypatch):
+    from macrostrat_tileserver.image_tiles import mapnik_styles
+
+    # A stand-in for the carto compiler that records each compilation
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    carto = bin_dir / "carto"
+    carto.write_text(
+        "#!/bin/sh\n"
+        'if [ "$1" = "--version" ]; then echo 1.2.0; exit 0; fi\n'
+        f"echo compiled >> {tmp_path / 'log'}\n"
+        "echo '<Map/>'\n"
+    )
+    carto.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}:{os.environ['PATH']}")
+    mapnik_styles.carto_version.cache_clear()
+
+    cache_dir = tmp_path / "styles"
+    scales = ["tiny", "small"]
+    styles = mapnik_styles.build_mapnik_styles(scales, cache_dir=cache_dir)
+    assert styles == {s: "<Map/>\n" for s in scales}
+    assert mapnik_styles.build_mapnik_styles(scales, cache_dir=cache_dir) == styles
+
+    # Each scale is compiled once
+    assert (tmp_path / "log").read_text().count("compiled") == 2
+    assert len(list(cache_dir.glob("*.xml"))) == 2
+    mapnik_styles.carto_version.cache_clear()
+
+
+def test_carto_style_precedence():
+    from macrostrat_tileserver.image_tiles.vector_render import CartoStyle
+
+    style = CartoStyle.from_file()
+    units = style.properties("units", None, 5, {"color": "#ff0000"})
+    assert units["polygon-fill"] == "[color]"
+    assert units["line-width"] == "0.8"
+    # Water polygons are transparent
+    water = style.properties("units", None, 5, {"color": ""})
+    assert water["polygon-opacity"] == "0"
+
+    dike = style.properties("lines", None, 4, {"type": "dike", "direction": ""})
+    assert dike == {"line-color": "#FF4136", "line-width": "0.3"}
+    hatch = style.properties("lines", "hatch", 10, {"type": "vein", "direction": ""})
+    assert hatch["line-dasharray"] == "1, 20"
+
+
+def test_rasterize_vector_tile():
+    Image = pytest.importorskip("PIL.Image")
+    from io import BytesIO
+
+    from mapbox_vector_tile import encode
+
+    from macrostrat_tileserver.image_tiles.vector_render import (
+        CartoStyle,
+        rasterize_tile,
+    )
+
+    data = encode(
+        [
+            {
+                "name": "units",
+                "features": [
+                    {
+                        "geometry": "POLYGON((0 0,4096 0,4096 2048,0 2048,0 0))",
+                        "properties": {"color": "#ff0000"},
+                    }
+                ],
+            }
+        ]
+    )
+    im = Image.open(BytesIO(rasterize_tile(data, 5, CartoStyle.from_file())))
+    assert im.size == (512, 512)
+    # Tiles are y-up in the encoder, so the unit covers the bottom of the tile
+    assert im.getpixel((256, 400)) == (255, 0, 0, 255)
+    assert im.getpixel((256, 100))[3] == 0
+
+
+def test_image_variants_are_cached_separately():
+    from macrostrat_tileserver.cache import create_params_hash
+    from macrostrat_tileserver.image_tiles.config import ImageFormat, variant_params
+
+    # Standard PNG tiles keep their existing cache key
+    assert create_params_hash(variant_params(1, ImageFormat.PNG)) == 0
+    hashes = {
+        create_params_hash(variant_params(scale_factor, format))
+        for scale_factor in (1, 2)
+        for format in ImageFormat
+    }
+    assert len(hashes) == 6
+
+
+@pytest.mark.parametrize("format", ["png", "webp", "jpg"])
+def test_rasterize_high_dpi_formats(format):
+    Image = pytest.importorskip("PIL.Image")
+    from io import BytesIO
+
+    from macrostrat_tileserver.image_tiles.vector_render import (
+        CartoStyle,
+        rasterize_tile,
+    )
+
+    data = rasterize_tile(b"", 5, CartoStyle.from_file(), scale_factor=2, format=format)
+    im = Image.open(BytesIO(data))
+    assert im.size == (1024, 1024)
+    assert im.format == {"jpg": "JPEG"}.get(format, format.upper())
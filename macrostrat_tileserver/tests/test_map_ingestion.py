@@ -0,0 +1,52 @@
+"""
+Tests for the metadata cache for maps being ingested, which don't require a database.
+"""
+
+import asyncio
+
+from macrostrat_tileserver.map_ingestion.metadata import MapMetadata, MapMetadataCache
+
+
+def test_map_metadata_is_cached():
+    cache = MapMetadataCache(ttl=60)
+    loads = []
+
+    async def load(slug):
+        loads.append(slug)
+        await asyncio.sleep(0.01)
+        if slug == "missing":
+            return None
+        return MapMetadata(slug, {}, {})
+
+    async def run():
+        # Concurrent requests for a map load its metadata once
+        maps = await asyncio.gather(*(cache.get("test_map", load) for _ in range(3)))
+        assert all(m is maps[0] for m in maps)
+        assert await cache.get("test_map", load) is maps[0]
+
+        # Maps without tables aren't cached, so that they appear once ingested
+        assert await cache.get("missing", load) is None
+        assert await cache.get("missing", load) is None
+
+        cache.invalidate("test_map")
+        assert await cache.get("test_map", load) is not maps[0]
+
+    asyncio.run(run())
+    assert loads == ["test_map", "missing", "missing", "test_map"]
+    assert "test_map" in cache and "missing" not in cache
+
+
+def test_map_metadata_expires():
+    cache = MapMetadataCache(ttl=0)
+    loads = []
+
+    async def load(slug):
+        loads.append(slug)
+        return MapMetadata(slug, {}, {})
+
+    async def run():
+        await cache.get("test_map", load)
+        await cache.get("test_map", load)
+
+    asyncio.run(run())
+    assert len(loads) == 2
@@ -0,0 +1,126 @@
+"""
+Tests for routing of reads to replicas, using stand-in connection pools.
+"""
+
+import asyncio
+
+from macrostrat_tileserver.replicas import Replica, ReplicaPools
+
+
+class _Connection:
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def fetchval(self, query, timeout=None):
+        return self.pool.lag
+
+
+class _Pool:
+    def __init__(self, name, lag=0.0, fail=False, busy=False):
+        self.name = name
+        self.lag = lag
+        self.fail = fail
+        self.busy = busy
+        self.released = 0
+
+    async def _acquire(self, timeout=None):
+        if self.fail:
+            raise ConnectionRefusedError(f"{self.name} is down")
+        if self.busy:
+            raise asyncio.TimeoutError()
+        return _Connection(self)
+
+    def acquire(self, timeout=None):
+        pool = self
+
+        class _Acquire:
+            def __await__(self):
+                return pool._acquire(timeout).__await__()
+
+            async def __aenter__(self):
+                return await pool._acquire(timeout)
+
+            async def __aexit__(self, *args):
+                pool.released += 1
+
+        return _Acquire()
+
+    async def release(self, conn):
+        self.released += 1
+
+
+def _router(*pools, max_lag=30):
+    router = ReplicaPools()
+    router.primary = _Pool("primary")
+    router.max_lag = max_lag
+    for pool in pools:
+        replica = Replica(f"postgresql://user:secret@{pool.name}/macrostrat")
+        replica.pool = pool
+        router.replicas.append(replica)
+    return router
+
+
+async def _read(router):
+    async with router.acquire() as conn:
+        return conn.pool.name
+
+
+def test_replicas_are_used_round_robin():
+    router = _router(_Pool("a"), _Pool("b"), _Pool("c", lag=60))
+
+    async def run():
+        await router.check()
+        return [await _read(router) for _ in range(4)]
+
+    # The lagging replica is skipped
+    assert asyncio.run(run()) == ["a", "b", "a", "b"]
+    stats = router.stats()
+    assert stats["replicas"]["a/macrostrat"]["reads"] == 2
+    assert stats["replicas"]["c/macrostrat"]["healthy"] is False
+    assert stats["replicas"]["c/macrostrat"]["lag_s"] == 60
+    assert all(p.released == 3 for p in (r.pool for r in router.replicas[:2]))
+
+
+def test_reads_fall_back_to_primary():
+    down = _Pool("a")
+    router = _router(down)
+
+    async def run():
+        await router.check()
+        down.fail = True
+        first = await _read(router)
+        # The failed replica isn't tried again until it passes a check
+        second = await _read(router)
+        down.fail = False
+        await router.check()
+        third = await _read(router)
+        return first, second, third
+
+    assert asyncio.run(run()) == ("primary", "primary", "a")
+    stats = router.stats()
+    assert stats["fallbacks"] == 1
+    assert stats["primary_reads"] == 2
+    assert stats["replicas"]["a/macrostrat"]["failures"] == 1
+
+
+def test_busy_replica_stays_in_rotation():
+    busy = _Pool("a")
+    router = _router(busy)
+
+    async def run():
+        await router.check()
+        busy.busy = True
+        first = await _read(router)
+        busy.busy = False
+        return first, await _read(router)
+
+    assert asyncio.run(run()) == ("primary", "a")
+    stats = router.stats()
+    assert stats["busy_fallbacks"] == 1
+    assert stats["replicas"]["a/macrostrat"]["healthy"] is True
+    assert stats["replicas"]["a/macrostrat"]["failures"] == 0
+
+
+def test_no_replicas():
+    router = _router()
+    assert asyncio.run(_read(router)) == "primary"
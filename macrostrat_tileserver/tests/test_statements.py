@@ -0,0 +1,100 @@
+"""
+Tests for the registry of compiled tile queries, which don't require a database.
+"""
+
+import asyncio
+
+import pytest
+from buildpg import V
+
+from macrostrat_tileserver.utils.statements import StatementRegistry, compile_statement
+from macrostrat_tileserver.utils.timeouts import QueryTimeout
+
+
+def test_compile_statement():
+    statement = compile_statement(
+        "SELECT ST_AsMVT(q, :layer_name) FROM :table q WHERE q.z = :z AND :z > 0",
+        table=V("carto.polygons"),
+    )
+    assert statement.sql == (
+        "SELECT ST_AsMVT(q, $1) FROM carto.polygons q WHERE q.z = $2 AND $2 > 0"
+    )
+    assert statement.args({"z": 3, "layer_name": "units", "x": 1}) == ["units", 3]
+
+
+class _Connection:
+    def __init__(self):
+        self.queries = []
+
+    async def fetchval(self, sql, *args, timeout=None):
+        self.queries.append(sql)
+        return (sql, args)
+
+
+def test_statements_are_compiled_once():
+    registry = StatementRegistry()
+    builds = []
+
+    def build():
+        builds.append(1)
+        return compile_statement("SELECT tile_layers.carto(:x, :y, :z)")
+
+    async def run():
+        conns = [_Connection(), _Connection()]
+        for _ in range(3):
+            for conn in conns:
+                statement = registry.get("carto", build)
+                res = await registry.fetchval(conn, statement, x=1, y=2, z=3)
+                assert res == ("SELECT tile_layers.carto($1, $2, $3)", (1, 2, 3))
+        return conns
+
+    conns = asyncio.run(run())
+    assert len(builds) == 1
+    # Every request sends identical SQL, so asyncpg's statement cache can reuse it
+    assert all(len(set(c.queries)) == 1 for c in conns)
+    assert registry.stats()["compiled"] == 1
+    assert registry.stats()["executed"] == 6
+
+
+class _PreparedStatement:
+    def __init__(self, sql):
+        self.sql = sql
+
+    async def fetchval(self, *args, timeout=None):
+        return (self.sql, args)
+
+
+class _UncachedConnection(_Connection):
+    async def fetchval(self, sql, *args, timeout=None):
+        raise AssertionError("Statement should not be cached")
+
+    async def prepare(self, sql):
+        self.queries.append(sql)
+        return _PreparedStatement(sql)
+
+
+def test_uncached_statements():
+    registry = StatementRegistry()
+    statement = compile_statement('SELECT count(*) FROM sources."test_map_polygons"')
+    conn = _UncachedConnection()
+    res = asyncio.run(registry.fetchval(conn, statement, cache_statement=False))
+    assert res == (statement.sql, ())
+    assert conn.queries == [statement.sql]
+
+
+class _SlowConnection:
+    async def fetchval(self, sql, *args, timeout=None):
+        await asyncio.wait_for(asyncio.sleep(1), timeout)
+
+
+def test_statement_timeout():
+    registry = StatementRegistry()
+    statement = compile_statement("SELECT tile_layers.carto(:x, :y, :z)")
+
+    async def run():
+        await registry.fetchval(
+            _SlowConnection(), statement, timeout=0.01, x=1, y=2, z=3
+        )
+
+    with pytest.raises(QueryTimeout):
+        asyncio.run(run())
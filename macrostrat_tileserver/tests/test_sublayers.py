@@ -0,0 +1,76 @@
+"""
+Tests for concurrent sublayer queries, which don't require a database.
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+
+from macrostrat.utils.timer import Timer
+
+from macrostrat_tileserver.utils.sublayers import SublayerRunner
+
+
+class _Pool:
+    def __init__(self):
+        self.acquired = 0
+        self.in_use = 0
+        self.max_in_use = 0
+
+    @asynccontextmanager
+    async def acquire(self):
+        self.acquired += 1
+        self.in_use += 1
+        self.max_in_use = max(self.max_in_use, self.in_use)
+        try:
+            yield object()
+        finally:
+            self.in_use -= 1
+
+
+def _query(content, delay):
+    async def query(con):
+        await asyncio.sleep(delay)
+        return content
+
+    return query
+
+
+def _queries():
+    return {
+        "units": _query(b"units", 0.02),
+        "lines": _query(b"lines", 0.01),
+        "empty": _query(None, 0),
+    }
+
+
+def test_sublayers_run_concurrently():
+    pool = _Pool()
+    timer = Timer()
+    runner = SublayerRunner(concurrency=3)
+    content = asyncio.run(runner.run(pool, _queries(), timer=timer))
+
+    # Layers are joined in order, regardless of which finished first
+    assert content == b"unitslines"
+    assert pool.acquired == 3
+    assert pool.max_in_use == 3
+
+    names = [t.name for t in timer.timings]
+    assert names == ["start", "get_tile", "units", "lines", "empty"]
+    get_tile, units, lines, _ = timer.timings[1:]
+    assert units.delta >= 0.02 and lines.delta >= 0.01
+    # The wall time is that of the slowest sublayer, not the sum
+    assert get_tile.delta < units.delta + lines.delta
+    assert "units;dur=" in timer.server_timings()
+
+
+def test_sublayer_concurrency_limit():
+    pool = _Pool()
+    asyncio.run(SublayerRunner(concurrency=2).run(pool, _queries()))
+    assert pool.max_in_use == 2
+
+    # Without concurrency, sublayers share a single connection
+    pool = _Pool()
+    runner = SublayerRunner(concurrency=1)
+    assert asyncio.run(runner.run(pool, _queries())) == b"unitslines"
+    assert pool.acquired == 1
+    assert runner.stats()["queries"] == 3
@@ -2,6 +2,8 @@
 Tests for Macrostrat's tileserver v2
 """
 
+from time import sleep
+
 import pytest
 from mapbox_vector_tile import decode
 
@@ -68,3 +70,32 @@ def test_get_empty_tile(client):
     tile = res.content
     # Check that there are features
     assert len(tile) == 0
+
+
+def _get_cached_tile(client, path, **kwargs):
+    """Request a tile from the cache, waiting for it to be written (cache writes
+    are batched in the background)."""
+    for _ in range(40):
+        res = client.get(path, params={"cache": "force"}, **kwargs)
+        if res.status_code != 404:
+            return res
+        sleep(0.25)
+    return res
+
+
+def test_cached_tile_not_modified(client):
+    path = "/carto/10/194/384"
+    headers = {"Accept-Encoding": "identity"}
+    res = client.get(path, headers=headers)
+    assert res.status_code == 200
+
+    res = _get_cached_tile(client, path, headers=headers)
+    assert res.status_code == 200
+    assert res.headers["X-Tile-Cache"] == "hit"
+    etag = res.headers["ETag"]
+
+    res = _get_cached_tile(client, path, headers={**headers, "If-None-Match": etag})
+    assert res.status_code == 304
+    assert res.content == b""
+    assert res.headers["ETag"] == etag
+    assert res.headers["X-Tile-Cache"] == "hit"
@@ -0,0 +1,86 @@
+"""
+Tests for tile query time limits and cancellation, which don't require a database.
+"""
+
+import asyncio
+
+import pytest
+
+from macrostrat_tileserver.utils import SingleFlight
+from macrostrat_tileserver.utils.timeouts import (
+    ClientDisconnected,
+    QueryTimeouts,
+    until_disconnected,
+)
+
+
+def test_query_timeouts_by_layer_and_zoom():
+    timeouts = QueryTimeouts(
+        default=30, layers={"carto": {"0": 5, "9": 20}, "filterable": 10, "map": 0}
+    )
+    assert timeouts.timeout_for("carto", 0) == 5
+    assert timeouts.timeout_for("carto", 8) == 5
+    assert timeouts.timeout_for("carto", 12) == 20
+    assert timeouts.timeout_for("filterable", 3) == 10
+    assert timeouts.timeout_for("carto-slim", 3) == 30
+    # A limit of zero disables the timeout
+    assert timeouts.timeout_for("map", 3) is None
+
+
+class _Request:
+    def __init__(self, disconnect_after: float):
+        self.disconnect_after = disconnect_after
+        self.messages = [{"type": "http.request", "body": b"", "more_body": False}]
+
+    async def receive(self):
+        if self.messages:
+            return self.messages.pop(0)
+        await asyncio.sleep(self.disconnect_after)
+        return {"type": "http.disconnect"}
+
+
+def test_tiles_are_cancelled_on_disconnect():
+    cancelled = []
+
+    async def query(delay):
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            cancelled.append(delay)
+            raise
+        return b"tile"
+
+    async def run():
+        assert await until_disconnected(_Request(1), query(0.01)) == b"tile"
+        with pytest.raises(ClientDisconnected):
+            await until_disconnected(_Request(0.01), query(1))
+
+    asyncio.run(run())
+    assert cancelled == [1]
+
+
+def test_single_flight_cancels_abandoned_work():
+    renders = SingleFlight(cancel_abandoned=True)
+    cancelled = []
+
+    async def render():
+        try:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def run():
+        waiters = [asyncio.ensure_future(renders.run("key", render)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        # Work continues while any caller is still waiting
+        waiters[0].cancel()
+        await asyncio.sleep(0.01)
+        assert not cancelled
+        waiters[1].cancel()
+        await asyncio.sleep(0.01)
+        assert cancelled == [True]
+        assert "key" not in renders
+
+    asyncio.run(run())
+    assert renders.stats()["abandoned"] == 1
@@ -3,7 +3,15 @@ from enum import Enum
 from pathlib import Path
 
 from .cache import CacheMode, CacheStatus
-from .output import TileResponse, DecimalJSONResponse, VectorTileResponse
+from .output import (
+    TileResponse,
+    DecimalJSONResponse,
+    VectorTileResponse,
+    join_layers,
+    request_etags,
+    tile_etag,
+)
+from .single_flight import SingleFlight
 
 
 def scales_for_zoom(z: int, dz: int = 0):
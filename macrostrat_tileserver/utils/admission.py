@@ -0,0 +1,144 @@
+"""
+Admission control for tile requests. Work that needs a database connection is admitted
+through concurrency limits with bounded wait queues, so that a load spike is shed with
+fast `503` responses instead of piling up on the connection pool.
+
+Cache lookups and renders are limited separately, so that slow renders can't starve
+cache hits, and individual layers can be limited further so that an expensive layer
+(e.g., `carto-slim-rotated`) can't take over the pool.
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+from time import perf_counter
+from typing import Any, Optional
+
+
+class Overloaded(Exception):
+    """Too much work is already waiting to be admitted."""
+
+    def __init__(self, limiter: str, retry_after: int = 1):
+        super().__init__(f"Too many tile requests are waiting ({limiter})")
+        self.limiter = limiter
+        self.retry_after = retry_after
+
+
+class Limiter:
+    """A concurrency limit with a bounded queue of waiting tasks.
+
+    Tasks that arrive when `max_queue_size` tasks are already waiting, or that wait
+    longer than `queue_timeout` seconds (if set), are rejected with `Overloaded`.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        concurrency: int,
+        max_queue_size: int = 64,
+        queue_timeout: Optional[float] = 5,
+    ):
+        self.name = name
+        self.concurrency = concurrency
+        self.max_queue_size = max_queue_size
+        self.queue_timeout = queue_timeout or None
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self.active = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    @asynccontextmanager
+    async def slot(self):
+        if self._semaphore.locked() and self.waiting >= self.max_queue_size:
+            self.rejected += 1
+            raise Overloaded(self.name)
+
+        start = perf_counter()
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise Overloaded(self.name) from None
+        finally:
+            self.waiting -= 1
+
+        wait_time = perf_counter() - start
+        self.admitted += 1
+        self.total_wait_time += wait_time
+        self.max_wait_time = max(self.max_wait_time, wait_time)
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self._semaphore.release()
+
+    def stats(self) -> dict[str, Any]:
+        n = max(self.admitted, 1)
+        return {
+            "concurrency": self.concurrency,
+            "active": self.active,
+            "queued": self.waiting,
+            "max_queued": self.max_waiting,
+            "max_queue_size": self.max_queue_size,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+            "mean_wait_ms": round(self.total_wait_time / n * 1000, 1),
+            "max_wait_ms": round(self.max_wait_time * 1000, 1),
+        }
+
+
+class AdmissionController:
+    def __init__(self, **kwargs):
+        self.configure(**kwargs)
+
+    def configure(
+        self,
+        *,
+        cache_concurrency: int = 8,
+        render_concurrency: int = 4,
+        layer_concurrency: Optional[dict[str, int]] = None,
+        max_queue_size: int = 64,
+        queue_timeout: Optional[float] = 5,
+    ):
+        queue = dict(max_queue_size=max_queue_size, queue_timeout=queue_timeout)
+        self.cache = Limiter("cache", cache_concurrency, **queue)
+        self.renders = Limiter("render", render_concurrency, **queue)
+        self.layers = {
+            layer: Limiter(f"render:{layer}", n, **queue)
+            for layer, n in (layer_concurrency or {}).items()
+        }
+
+    def cache_lookup(self):
+        """Admit a lookup in the database tile cache."""
+        return self.cache.slot()
+
+    @asynccontextmanager
+    async def render(self, layer: str):
+        """Admit a render of a tile for a layer."""
+        limiter = self.layers.get(layer)
+        if limiter is None:
+            async with self.renders.slot():
+                yield
+            return
+        # Wait for the layer's limit first, so that its queue doesn't hold render slots
+        async with limiter.slot():
+            async with self.renders.slot():
+                yield
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "cache": self.cache.stats(),
+            "render": self.renders.stats(),
+            "layers": {k: v.stats() for k, v in self.layers.items()},
+        }
+
+
+admission = AdmissionController()
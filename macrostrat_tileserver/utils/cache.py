@@ -10,3 +10,5 @@ class CacheStatus(str, Enum):
     hit = "hit"
     miss = "miss"
     bypass = "bypass"
+    # The tile was rendered for a concurrent request that was already in progress
+    coalesced = "coalesced"
@@ -0,0 +1,127 @@
+"""
+Pre-compressed tile variants. Tiles are encoded once when they are written to the
+cache, and served with the matching `Content-Encoding` on cache hits instead of being
+recompressed by the middleware on every request.
+"""
+
+import re
+from typing import Iterable, Optional
+
+import cramjam
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import Message, Receive, Scope, Send
+from starlette_cramjam.middleware import CompressionMiddleware as _CompressionMiddleware
+from starlette_cramjam.middleware import (
+    CompressionResponder,
+    get_compression_backend,
+)
+
+# Supported encodings, in order of server preference
+tile_encoders = {
+    "br": cramjam.brotli,
+    "zstd": cramjam.zstd,
+    "gzip": cramjam.gzip,
+}
+
+_accept_encoding_pattern = re.compile(r"^(?P<name>[a-z]+|\*)(;q=(?P<q>[\d.]+))?$")
+
+
+def encode_tile(content: bytes, encodings: Iterable[str]) -> dict[str, bytes]:
+    """Compress tile content with each of the given encodings."""
+    if not content:
+        return {}
+    return {
+        name: bytes(tile_encoders[name].compress(content))
+        for name in encodings
+        if name in tile_encoders
+    }
+
+
+def preferred_encoding(accept_encoding: str, encodings: Iterable[str]) -> Optional[str]:
+    """Choose the best available encoding for an `Accept-Encoding` header."""
+    accepted = {}
+    for value in accept_encoding.replace(" ", "").lower().split(","):
+        match = _accept_encoding_pattern.match(value)
+        if match is None:
+            continue
+        try:
+            q = float(match.group("q") or 1)
+        except ValueError:
+            q = 0
+        accepted[match.group("name")] = q
+
+    encodings = set(encodings)
+    best, best_q = None, 0
+    for name in (n for n in tile_encoders if n in encodings):
+        q = accepted.get(name, accepted.get("*", 0))
+        if q > best_q:
+            best, best_q = name, q
+    return best
+
+
+def _tag_etag(headers: MutableHeaders, encoding: str):
+    """Give a strong ETag an encoding suffix, since each encoding of a tile
+    is a distinct representation."""
+    etag = headers.get("ETag")
+    if etag is None or etag.startswith("W/"):
+        return
+    if any(etag.endswith(f'-{name}"') for name in tile_encoders):
+        return
+    headers["ETag"] = etag[:-1] + f'-{encoding}"'
+
+
+class _PassthroughResponder(CompressionResponder):
+    """Don't recompress responses that already declare a `Content-Encoding`,
+    or that have no body."""
+
+    passthrough = False
+
+    async def send_with_compression(self, message: Message) -> None:
+        if message["type"] == "http.response.start":
+            headers = MutableHeaders(raw=message["headers"])
+            if "content-encoding" in headers:
+                self.passthrough = True
+            elif message["status"] in (204, 304):
+                # The client's copy would have been compressed by this middleware
+                self.passthrough = True
+                _tag_etag(headers, self.encoding_name)
+        if self.passthrough:
+            await self.send(message)
+            return
+        if message["type"] == "http.response.body" and not self.started:
+            self._tag_compressed_representation(message)
+        await super().send_with_compression(message)
+
+    def _tag_compressed_representation(self, message: Message):
+        headers = MutableHeaders(raw=self.initial_message["headers"])
+        if headers.get("Content-Type") in self.exclude_mediatype:
+            return
+        body = message.get("body", b"")
+        if len(body) < self.minimum_size and not message.get("more_body", False):
+            return
+        _tag_etag(headers, self.encoding_name)
+
+
+class CompressionMiddleware(_CompressionMiddleware):
+    """Compression middleware that passes pre-compressed responses through unchanged."""
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http":
+            headers = Headers(scope=scope)
+            accepted_encoding = headers.get("Accept-Encoding", "")
+
+            skip = any(x.fullmatch(scope["path"]) for x in self.exclude_path)
+
+            backend = get_compression_backend(accepted_encoding, self.compression)
+            if not skip and backend:
+                responder = _PassthroughResponder(
+                    self.app,
+                    backend.compress.Compressor(),
+                    backend.name,
+                    self.minimum_size,
+                    self.exclude_mediatype,
+                )
+                await responder(scope, receive, send)
+                return
+
+        await self.app(scope, receive, send)
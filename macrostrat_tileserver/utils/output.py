@@ -1,22 +1,73 @@
 import decimal
 import json
 import typing
+from hashlib import blake2b
 
 from starlette.responses import JSONResponse, Response
 from timvt.resources.enums import MimeTypes
 from .cache import CacheStatus
 
-def TileResponse(content, timer, cache_status: CacheStatus = None, **kwargs):
+def TileResponse(
+    content,
+    timer,
+    cache_status: CacheStatus = None,
+    content_encoding: str = None,
+    etag: str = None,
+    max_age: int = None,
+    not_modified: bool = False,
+    **kwargs,
+):
     kwargs["headers"] = {
         "Server-Timing": timer.server_timings(),
         **kwargs.pop("headers", {}),
     }
     if cache_status is not None:
         kwargs["headers"]["X-Tile-Cache"] = cache_status
+    if content_encoding is not None:
+        # Pre-compressed content; the compression middleware passes this through
+        kwargs["headers"]["Content-Encoding"] = content_encoding
+        kwargs["headers"]["Vary"] = "Accept-Encoding"
+    if etag is not None:
+        kwargs["headers"]["ETag"] = representation_etag(etag, content_encoding)
+    if max_age is not None:
+        kwargs["headers"]["Cache-Control"] = f"public, max-age={max_age}"
     kwargs.setdefault("media_type", MimeTypes.pbf.value)
+    if not_modified:
+        kwargs["headers"].pop("Content-Encoding", None)
+        return Response(status_code=304, **kwargs)
     return Response(content, **kwargs)
 
 
+def tile_etag(content: bytes) -> str:
+    """A strong validator for tile content."""
+    return blake2b(content or b"", digest_size=16).hexdigest()
+
+
+def representation_etag(etag: str, content_encoding: str = None) -> str:
+    """Format an ETag header. Each encoding of a tile is a distinct representation."""
+    if content_encoding is not None:
+        etag = f"{etag}-{content_encoding}"
+    return f'"{etag}"'
+
+
+def request_etags(request) -> list[str]:
+    """Get tile ETags from a request's If-None-Match header, ignoring encodings."""
+    header = request.headers.get("If-None-Match")
+    if header is None:
+        return []
+    etags = []
+    for value in header.split(","):
+        value = value.strip()
+        if value.startswith("W/"):
+            value = value[2:]
+        value = value.strip('"')
+        base, _, encoding = value.rpartition("-")
+        if base and encoding in ("gzip", "br", "zstd"):
+            value = base
+        etags.append(value)
+    return etags
+
+
 class DecimalEncoder(json.JSONEncoder):
     def default(self, o):
         if isinstance(o, decimal.Decimal):
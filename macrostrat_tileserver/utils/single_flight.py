@@ -0,0 +1,74 @@
+"""
+Deduplication of concurrent work, so that a tile that is requested by many clients
+at once is only rendered a single time.
+"""
+
+import asyncio
+from typing import Any, Awaitable, Callable, Hashable
+
+
+class SingleFlight:
+    """Coalesce concurrent calls that share a key into a single in-flight task.
+
+    The first caller for a key (the "leader") starts the work; callers that arrive
+    while it is running ("followers") await the leader's result. The work runs in its
+    own task, so a leader that is cancelled (e.g., by a client disconnect) does not
+    cancel the work for its followers. With `cancel_abandoned`, the work is cancelled
+    once every caller waiting for it has been cancelled.
+    """
+
+    def __init__(self, cancel_abandoned: bool = False):
+        self._inflight: dict[Hashable, asyncio.Task] = {}
+        self._waiters: dict[asyncio.Task, int] = {}
+        self.cancel_abandoned = cancel_abandoned
+        self.leaders = 0
+        self.followers = 0
+        self.abandoned = 0
+
+    async def run(
+        self, key: Hashable, func: Callable[..., Awaitable[Any]], *args, **kwargs
+    ) -> tuple[Any, bool]:
+        """Run `func` for `key`, or join a run that is already in progress.
+
+        Returns the result and whether this call led the work.
+        """
+        task = self._inflight.get(key)
+        if task is not None:
+            self.followers += 1
+            return await self._wait(task), False
+
+        task = asyncio.ensure_future(func(*args, **kwargs))
+        self._inflight[key] = task
+        task.add_done_callback(lambda t: self._done(key, t))
+        self.leaders += 1
+        return await self._wait(task), True
+
+    async def _wait(self, task: asyncio.Task) -> Any:
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            n_waiters = self._waiters.pop(task) - 1
+            if n_waiters > 0:
+                self._waiters[task] = n_waiters
+            elif self.cancel_abandoned and not task.done():
+                task.cancel()
+                self.abandoned += 1
+
+    def _done(self, key: Hashable, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # Mark exceptions as retrieved if every waiter has gone away
+        if not task.cancelled():
+            task.exception()
+
+    def __contains__(self, key: Hashable):
+        return key in self._inflight
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "in_flight": len(self._inflight),
+            "leaders": self.leaders,
+            "followers": self.followers,
+            "abandoned": self.abandoned,
+        }
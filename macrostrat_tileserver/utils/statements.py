@@ -0,0 +1,99 @@
+"""
+A registry of tile queries. Each query is rendered to SQL once, so that hot tile
+requests skip SQL rendering. The rendered SQL is identical for every request, so
+asyncpg's statement cache (bounded by `statement_cache_size` on each connection) also
+prepares it only once per connection, skipping server-side parsing and planning.
+"""
+
+import asyncio
+from typing import Any, Callable, Hashable, NamedTuple
+
+from buildpg import render
+
+from .timeouts import QueryTimeout, query_timeouts
+
+
+class Statement(NamedTuple):
+    """SQL with positional parameters, and the names of values for each one."""
+
+    sql: str
+    params: tuple[str, ...]
+
+    def args(self, values: dict[str, Any]) -> list:
+        return [values[name] for name in self.params]
+
+
+class _Param:
+    __slots__ = ("name",)
+
+    def __init__(self, name: str):
+        self.name = name
+
+
+def compile_statement(sql: str, **fragments) -> Statement:
+    """Render a query with named parameters to positional form.
+
+    Fragments (e.g., buildpg `V` components) are rendered into the SQL, so they must be
+    reflected in the key a statement is registered under.
+    """
+    names = {n.split(render.sep)[0] for n in render.regex.findall(sql)}
+    names -= fragments.keys()
+    q, p = render(sql, **fragments, **{name: _Param(name) for name in names})
+    return Statement(q, tuple(param.name for param in p))
+
+
+class StatementRegistry:
+    def __init__(self):
+        self._statements: dict[Hashable, Statement] = {}
+        self.compiled = 0
+        self.executed = 0
+
+    def get(self, key: Hashable, build: Callable[[], Statement]) -> Statement:
+        """Get the statement for a key, building it on first use."""
+        statement = self._statements.get(key)
+        if statement is None:
+            statement = build()
+            self._statements[key] = statement
+            self.compiled += 1
+        return statement
+
+    async def fetchval(
+        self,
+        conn,
+        statement: Statement,
+        *,
+        timeout: float = None,
+        cache_statement: bool = True,
+        **values,
+    ) -> Any:
+        """Run a statement. Queries that run longer than `timeout` seconds are
+        cancelled on the server, and raise `QueryTimeout`.
+
+        Statements that are rarely reused (e.g., queries for a single map) should set
+        `cache_statement=False`, so that they don't push hot tile queries out of the
+        connection's statement cache.
+        """
+        args = statement.args(values)
+        self.executed += 1
+        try:
+            if not cache_statement:
+                # Prepared outside of the statement cache, and closed on the server
+                # once released
+                stmt = await conn.prepare(statement.sql)
+                return await stmt.fetchval(*args, timeout=timeout)
+            # asyncpg prepares the statement on first use on this connection, and
+            # prepares it again if a schema change invalidates it
+            return await conn.fetchval(statement.sql, *args, timeout=timeout)
+        except asyncio.TimeoutError:
+            query_timeouts.timeouts += 1
+            raise QueryTimeout(timeout) from None
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "statements": len(self._statements),
+            "compiled": self.compiled,
+            "executed": self.executed,
+        }
+
+
+statements = StatementRegistry()
@@ -0,0 +1,117 @@
+"""
+Concurrent generation of multi-layer tiles. Each sublayer (e.g., `units` and `lines`)
+is queried on its own pooled connection, so that the wall time of a tile is that of
+its slowest sublayer rather than the sum of all of them.
+"""
+
+import asyncio
+from time import perf_counter
+from typing import Any, Awaitable, Callable, Optional
+
+from macrostrat.utils.timer import Timer, Timing
+
+from .output import join_layers
+
+SublayerQuery = Callable[[Any], Awaitable[Optional[bytes]]]
+
+
+class SublayerRunner:
+    """Run the sublayer queries for a tile, each on a separate connection.
+
+    At most `concurrency` connections are used for a single tile, so that one request
+    can't take over the pool. A concurrency of 1 runs sublayers one after the other on
+    a single connection.
+    """
+
+    def __init__(self, concurrency: int = 2):
+        self.configure(concurrency=concurrency)
+        self.tiles = 0
+        self.queries = 0
+        self.total_wall_time = 0.0
+        self.total_query_time = 0.0
+
+    def configure(self, *, concurrency: int = 2):
+        self.concurrency = max(concurrency, 1)
+
+    @property
+    def concurrent(self) -> bool:
+        return self.concurrency > 1
+
+    async def run(
+        self,
+        pool,
+        queries: dict[str, SublayerQuery],
+        *,
+        timer: Timer = None,
+        step: str = "get_tile",
+    ) -> bytes:
+        """Run queries (by sublayer name) and join the resulting layers in order.
+
+        If a timer is given, the wall time is recorded as `step`, followed by the
+        time of each sublayer query.
+        """
+        start = perf_counter()
+        # Timings are recorded in the order of sublayers, not of completion
+        durations = dict.fromkeys(queries, 0.0)
+
+        async def run_query(con, name: str, query: SublayerQuery):
+            t = perf_counter()
+            res = await query(con)
+            durations[name] = perf_counter() - t
+            return res
+
+        if not self.concurrent:
+            async with pool.acquire() as con:
+                layers = [await run_query(con, k, q) for k, q in queries.items()]
+        else:
+            semaphore = asyncio.Semaphore(self.concurrency)
+
+            async def run_sublayer(name: str, query: SublayerQuery):
+                async with semaphore:
+                    async with pool.acquire() as con:
+                        return await run_query(con, name, query)
+
+            tasks = [
+                asyncio.ensure_future(run_sublayer(k, q)) for k, q in queries.items()
+            ]
+            try:
+                layers = await asyncio.gather(*tasks)
+            except BaseException:
+                # Don't leave sibling queries holding connections
+                for task in tasks:
+                    task.cancel()
+                raise
+
+        self.tiles += 1
+        self.queries += len(queries)
+        self.total_wall_time += perf_counter() - start
+        self.total_query_time += sum(durations.values())
+        if timer is not None:
+            _add_sublayer_steps(timer, step, durations)
+        return join_layers([layer for layer in layers if layer is not None])
+
+    def stats(self) -> dict[str, Any]:
+        n = max(self.tiles, 1)
+        return {
+            "concurrency": self.concurrency,
+            "tiles": self.tiles,
+            "queries": self.queries,
+            "mean_wall_ms": round(self.total_wall_time / n * 1000, 1),
+            "mean_query_ms": round(self.total_query_time / n * 1000, 1),
+        }
+
+
+def _add_sublayer_steps(timer: Timer, step: str, durations: dict[str, float]):
+    """Record the time of each sublayer query after the step that contains them.
+
+    Sublayers overlap, so they are recorded with their own durations and end at the
+    containing step, which keeps later steps measured from there.
+    """
+    end = timer._add_step(step)
+    for name, delta in durations.items():
+        timer.timings.append(
+            Timing(name=name, delta=delta, total=end.total, time=end.time)
+        )
+
+
+sublayer_runner = SublayerRunner()
@@ -0,0 +1,100 @@
+"""
+Time limits for tile queries, and cancellation of queries for clients that have gone
+away. When a user pans quickly, most in-flight tiles are abandoned; cancelling their
+queries returns connections to the pool for the tiles that are still wanted.
+
+Queries that exceed their time limit are cancelled on the server by asyncpg, and
+reported with a 504 response.
+"""
+
+import asyncio
+from contextlib import suppress
+from typing import Any, Awaitable, Optional, Union
+
+from starlette.requests import Request
+
+
+class QueryTimeout(Exception):
+    """A tile query ran longer than its time limit."""
+
+    def __init__(self, timeout: float):
+        super().__init__(f"Tile query timed out after {timeout:g} s")
+        self.timeout = timeout
+
+
+class ClientDisconnected(Exception):
+    """The client went away before its tile was ready."""
+
+
+class QueryTimeouts:
+    """Time limits (in seconds) for tile queries, by layer and zoom level.
+
+    Limits for a layer are either a number or a mapping from the minimum zoom level
+    at which each limit applies, e.g. `{"carto": {0: 5, 9: 20}}` allows 5 s for
+    `carto` tiles below zoom 9, and 20 s above. A limit of zero disables the timeout.
+    """
+
+    def __init__(
+        self,
+        default: float = 30,
+        layers: Optional[dict[str, Union[float, dict[int, float]]]] = None,
+    ):
+        self.configure(default=default, layers=layers)
+        self.timeouts = 0
+        self.cancelled = 0
+
+    def configure(
+        self,
+        *,
+        default: float = 30,
+        layers: Optional[dict[str, Union[float, dict[int, float]]]] = None,
+    ):
+        self.default = default
+        self.layers = {}
+        for layer, limits in (layers or {}).items():
+            if not isinstance(limits, dict):
+                limits = {0: limits}
+            self.layers[layer] = sorted((int(z), float(t)) for z, t in limits.items())
+
+    def timeout_for(self, layer: str, z: int) -> Optional[float]:
+        timeout = self.default
+        for minzoom, limit in self.layers.get(layer, []):
+            if z >= minzoom:
+                timeout = limit
+        return timeout or None
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "default": self.default,
+            "timeouts": self.timeouts,
+            "cancelled": self.cancelled,
+        }
+
+
+async def _wait_for_disconnect(request: Request):
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def until_disconnected(request: Request, awaitable: Awaitable) -> Any:
+    """Await a tile, cancelling it (and any queries it is running) if the client
+    disconnects first."""
+    task = asyncio.ensure_future(awaitable)
+    disconnected = asyncio.ensure_future(_wait_for_disconnect(request))
+    try:
+        await asyncio.wait({task, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        disconnected.cancel()
+        if not task.done():
+            task.cancel()
+            query_timeouts.cancelled += 1
+            with suppress(asyncio.CancelledError):
+                await task
+    if task.cancelled():
+        raise ClientDisconnected()
+    return task.result()
+
+
+query_timeouts = QueryTimeouts()
@@ -3,7 +3,7 @@ from json import dumps
 from typing import List
 from pathlib import Path
 
-from buildpg import V, render
+from buildpg import V
 from fastapi import APIRouter, Request, Query
 from httpx import AsyncClient
 from contextvars import ContextVar
@@ -11,6 +11,9 @@ from contextvars import ContextVar
 client = AsyncClient()
 
 from ..utils import scales_for_zoom, get_layer_sql, get_sql, VectorTileResponse
+from ..utils.admission import admission
+from ..utils.statements import compile_statement, statements
+from ..utils.timeouts import query_timeouts, until_disconnected
 
 from macrostrat.utils import get_logger
 
@@ -48,19 +51,24 @@ async def get_tile(
 
     query = get_layer_sql(__here__ / "queries", "units")
 
-    units_ = await fetchval(
-        pool,
-        query,
-        z=z,
-        x=x,
-        y=y,
-        mapsize=mapsize,
-        model_name=model_name,
-        linesize=linesize,
-        term_id=term_id,
-        # norm_method=norm_method,
-        layer_name="units",
-    )
+    async with admission.render("vector-search"):
+        units_ = await until_disconnected(
+            request,
+            fetchval(
+                pool,
+                query,
+                z=z,
+                x=x,
+                y=y,
+                mapsize=mapsize,
+                model_name=model_name,
+                linesize=linesize,
+                term_id=term_id,
+                # norm_method=norm_method,
+                layer_name="units",
+                timeout=query_timeouts.timeout_for("vector-search", z),
+            ),
+        )
 
     return VectorTileResponse(units_)
 
@@ -103,9 +111,11 @@ async def get_search_term_id(pool, term, model) -> int:
 
 
 async def fetchval(pool, query, **params):
-    q, p = render(query, **params)
+    statement = statements.get(
+        ("vector_search", query), lambda: compile_statement(query)
+    )
     async with pool.acquire() as con:
-        return await con.fetchval(q, *p)
+        return await statements.fetchval(con, statement, **params)
 
 
 @dataclass